@@ -0,0 +1,798 @@
+"""
+Benchmarks del gestor de contraseñas. Cada subcomando genera un vault sintético
+en un directorio temporal, así que no toca los archivos reales del usuario.
+
+Uso:
+    python benchmarks.py journal --rows 10000 --writes 200
+    python benchmarks.py crypto --rows 20000 --workers 1,2,4,8
+    python benchmarks.py binary --rows 100000
+    python benchmarks.py unlock --sizes 100,1000,10000,100000
+    python benchmarks.py search --rows 100000
+    python benchmarks.py imports --module main_gui --max-ms 800
+    python benchmarks.py face --source faces --fps 30
+    python benchmarks.py kdf --target-ms 100,250,500
+    python benchmarks.py rekey --rows 100000 --workers 1,2,4
+    python benchmarks.py bulk --rows 100000 --formats chrome,firefox,bitwarden,bitwarden-json
+    python benchmarks.py durability --rows 10000 --writes 100
+    python benchmarks.py users --users 1,4,16,64 --source faces
+    python benchmarks.py timing --rows 10000 --repeat 20
+"""
+import argparse
+import itertools
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from cryptography.fernet import Fernet
+
+from search import SearchIndex
+from crypto_engine import encrypt_many, decrypt_many
+import face_engine
+import face_verify
+import frame_source
+import bulk_io
+import kdf
+import rekey
+import storage
+import timing
+import users
+import utils
+from timing import percentil
+from vault import Vault, BinaryVault, DecryptCache, convert_csv_to_binary
+
+
+#-------------------------------------------------------------------------------------------------------------------------------
+
+"""Función para crear un CSV de contraseñas sintético con 'rows' entradas cifradas"""
+def crear_vault_sintetico(path, fernet, rows):
+    user_cifrado = fernet.encrypt(b'usuario@example.com').decode()
+    password_cifrada = fernet.encrypt(b'contrasena-de-prueba').decode()
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write('SITE,USER,PASSWORD\n')
+        for i in range(rows):
+            # Reutilizamos los tokens: el coste que medimos es el de almacenamiento, no el de cifrar
+            f.write(f'site{i:07d}.com,{user_cifrado},{password_cifrada}\n')
+
+#-------------------------------------------------------------------------------------------------------------------------------
+
+"""Función para imprimir una tabla sencilla de resultados"""
+def imprimir_tabla(cabeceras, filas):
+    anchos = [max(len(str(x)) for x in col) for col in zip(cabeceras, *filas)]
+    print('  '.join(str(c).ljust(a) for c, a in zip(cabeceras, anchos)))
+    for fila in filas:
+        print('  '.join(str(c).ljust(a) for c, a in zip(fila, anchos)))
+
+#-------------------------------------------------------------------------------------------------------------------------------
+
+"""Benchmark: coste de una escritura reescribiendo el CSV frente a añadir al journal"""
+def bench_journal(args):
+    fernet = Fernet(Fernet.generate_key())
+    tmpdir = tempfile.mkdtemp()
+    try:
+        base = os.path.join(tmpdir, 'base.csv')
+        crear_vault_sintetico(base, fernet, args.rows)
+        user_cifrado = fernet.encrypt(b'nuevo').decode()
+        password_cifrada = fernet.encrypt(b'nueva').decode()
+
+        filas = []
+        for modo in ('rewrite', 'journal'):
+            path = os.path.join(tmpdir, f'{modo}.csv')
+            shutil.copy(base, path)
+            vault = Vault(path)
+            if modo == 'journal':
+                # Umbral infinito: medimos solo el coste de la escritura, la compactación va aparte
+                vault.enable_journal(fernet, compactar_cada=float('inf'), sync=not args.no_sync)
+
+            t0 = time.perf_counter()
+            for i in range(args.writes):
+                vault.put(f'nuevo{i}.com', user_cifrado, password_cifrada)
+                vault.save()
+            por_escritura = (time.perf_counter() - t0) / args.writes
+
+            compactacion = ''
+            if modo == 'journal':
+                t0 = time.perf_counter()
+                vault.compact()
+                compactacion = f'{(time.perf_counter() - t0) * 1000:.1f}'
+            vault.close()
+            filas.append((modo, args.rows, f'{por_escritura * 1000:.3f}', f'{1 / por_escritura:.0f}', compactacion))
+
+        imprimir_tabla(('modo', 'filas', 'ms/escritura', 'escrituras/s', 'compactar ms'), filas)
+    finally:
+        shutil.rmtree(tmpdir)
+
+#-------------------------------------------------------------------------------------------------------------------------------
+
+"""Benchmark: filas por segundo de encrypt_many/decrypt_many según el número de workers"""
+def bench_crypto(args):
+    clave = Fernet.generate_key()
+    valores = [f'usuario{i}@example.com' for i in range(args.rows)]
+    tokens = encrypt_many(clave, valores, workers=1)
+
+    filas = []
+    for workers in [int(w) for w in args.workers.split(',')]:
+        t0 = time.perf_counter()
+        encrypt_many(clave, valores, workers=workers, executor=args.executor)
+        t_cifrar = time.perf_counter() - t0
+
+        t0 = time.perf_counter()
+        decrypt_many(clave, tokens, workers=workers, executor=args.executor)
+        t_descifrar = time.perf_counter() - t0
+
+        filas.append((workers, args.executor, args.rows, f'{args.rows / t_cifrar:.0f}', f'{args.rows / t_descifrar:.0f}'))
+
+    imprimir_tabla(('workers', 'pool', 'campos', 'cifrar/s', 'descifrar/s'), filas)
+
+#-------------------------------------------------------------------------------------------------------------------------------
+
+"""Benchmark: tiempo de carga/consulta y tamaño en disco del CSV cifrado en reposo frente al formato binario"""
+def bench_binary(args):
+    tmpdir = tempfile.mkdtemp()
+    try:
+        clave_path = os.path.join(tmpdir, 'clave.key')
+        utils.create_key(clave_path)
+        clave = utils.cargar_clave(clave_path)
+        csv_path = os.path.join(tmpdir, 'passwords.csv')
+        bin_path = os.path.join(tmpdir, 'passwords.vault')
+        crear_vault_sintetico(csv_path, Fernet(clave), args.rows)
+        convert_csv_to_binary(csv_path, bin_path, clave)
+        utils.cifrar_csv(csv_path, clave_path) # Comparamos con el archivo tal como queda en disco al cerrar la app
+        buscado = f'site{args.rows // 2:07d}.com'
+
+        filas = []
+        for formato in ('csv', 'binario'):
+            t0 = time.perf_counter()
+            vault = Vault(csv_path, clave) if formato == 'csv' else BinaryVault(bin_path, clave)
+            t_abrir = time.perf_counter() - t0
+
+            t0 = time.perf_counter()
+            for _ in range(1000):
+                vault.get(buscado)
+            t_get = (time.perf_counter() - t0) / 1000
+
+            t0 = time.perf_counter()
+            vault.sites()
+            t_sites = time.perf_counter() - t0
+
+            if formato == 'binario':
+                vault.close()
+            tam = os.path.getsize(csv_path if formato == 'csv' else bin_path)
+            filas.append((formato, args.rows, f'{t_abrir * 1000:.2f}', f'{t_get * 1e6:.2f}', f'{t_sites * 1000:.1f}', f'{tam / 1024:.0f}'))
+
+        imprimir_tabla(('formato', 'filas', 'abrir ms', 'get µs', 'listar ms', 'disco KiB'), filas)
+    finally:
+        shutil.rmtree(tmpdir)
+
+#-------------------------------------------------------------------------------------------------------------------------------
+
+"""Función para medir tiempo y pico de memoria Python de una llamada"""
+def medir(func, *args):
+    tracemalloc.start()
+    t0 = time.perf_counter()
+    resultado = func(*args)
+    dt = time.perf_counter() - t0
+    pico = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return resultado, dt, pico
+
+#-------------------------------------------------------------------------------------------------------------------------------
+
+"""Benchmark: latencia y memoria del desbloqueo descifrando el CSV frente a abrir el snapshot mmap"""
+def bench_unlock(args):
+    filas = []
+    for rows in [int(n) for n in args.sizes.split(',')]:
+        tmpdir = tempfile.mkdtemp()
+        try:
+            clave_path = os.path.join(tmpdir, 'clave.key')
+            utils.create_key(clave_path)
+            fernet = Fernet(utils.cargar_clave(clave_path))
+            csv_path = os.path.join(tmpdir, 'passwordsList.csv')
+            crear_vault_sintetico(csv_path, fernet, rows)
+            utils.cifrar_csv(csv_path, clave_path)
+            visibles = 15 # Filas que pinta la primera pantalla de la lista
+
+            def desbloqueo_snapshot():
+                vault = utils.open_snapshot(csv_path, clave_path)
+                vista = vault.site_view()
+                primeras = [vista[i] for i in range(min(visibles, len(vista)))]
+                vault.get(primeras[0])
+                return vault
+
+            def desbloqueo_descifrando():
+                utils.descifrar_csv(csv_path, clave_path)
+                vault = Vault(csv_path)
+                primeras = vault.sites()[:visibles]
+                vault.get(primeras[0])
+                return vault
+
+            vault, t_snap, mem_snap = medir(desbloqueo_snapshot)
+            vault.close()
+            _, t_csv, mem_csv = medir(desbloqueo_descifrando)
+            filas.append((rows, f'{t_snap * 1000:.2f}', f'{mem_snap / 1024:.0f}', f'{t_csv * 1000:.1f}', f'{mem_csv / 1024:.0f}'))
+        finally:
+            shutil.rmtree(tmpdir)
+
+    imprimir_tabla(('filas', 'snapshot ms', 'snapshot KiB', 'descifrar ms', 'descifrar KiB'), filas)
+
+#-------------------------------------------------------------------------------------------------------------------------------
+
+"""Benchmark: latencia de las consultas al índice de búsqueda mientras se escribe"""
+def bench_search(args):
+    rng = random.Random(1234)
+    dominios = ['mail', 'bank', 'shop', 'news', 'cloud', 'games', 'forum', 'travel', 'music', 'photo']
+    entradas = [(f'{rng.choice(dominios)}{i}.{rng.choice(["com", "es", "org", "net"])}', f'user{rng.randrange(10**6)}@example.com')
+                for i in range(args.rows)]
+
+    indice = SearchIndex()
+    t0 = time.perf_counter()
+    indice.add_many(entradas)
+    t_build = time.perf_counter() - t0
+
+    # Simulamos a alguien tecleando varias búsquedas letra a letra
+    consultas = []
+    for objetivo in ('bank4', 'user12', 'travel999', 'photo1234.es', '@example', 'zzz'):
+        consultas += [objetivo[:n] for n in range(1, len(objetivo) + 1)]
+
+    filas = []
+    for consulta in consultas:
+        tiempos = []
+        for _ in range(args.repeat):
+            t0 = time.perf_counter()
+            resultado = indice.search(consulta, limite=args.limit)
+            tiempos.append(time.perf_counter() - t0)
+        filas.append((consulta, len(resultado), f'{percentil(tiempos, 50) * 1000:.3f}', f'{max(tiempos) * 1000:.3f}'))
+
+    t0 = time.perf_counter()
+    for i in range(1000):
+        indice.add(f'nuevo{i}.com', f'nuevo{i}@example.com')
+    for i in range(1000):
+        indice.remove(f'nuevo{i}.com')
+    t_incremental = (time.perf_counter() - t0) / 2000
+
+    print(f"Índice de {args.rows} entradas construido en {t_build * 1000:.0f} ms; "
+          f"alta/baja incremental: {t_incremental * 1e6:.1f} µs")
+    imprimir_tabla(('consulta', 'resultados', 'p50 ms', 'max ms'), filas)
+
+#-------------------------------------------------------------------------------------------------------------------------------
+
+# No deben cargarse al arrancar (PIL no está en la lista porque customtkinter lo importa siempre)
+MODULOS_PESADOS = ('pandas', 'numpy', 'cv2')
+
+"""Función para parsear la salida de -X importtime: {módulo: (self µs, acumulado µs)}"""
+def parsear_importtime(salida):
+    tiempos = {}
+    for linea in salida.splitlines():
+        if not linea.startswith('import time:') or 'self [us]' in linea:
+            continue
+        propio, acumulado, nombre = linea[len('import time:'):].split('|')
+        tiempos[nombre.strip()] = (int(propio), int(acumulado))
+    return tiempos
+
+"""Benchmark: tiempo de importación en frío y comprobación de que no se cargan dependencias pesadas"""
+def bench_imports(args):
+    codigo = (f"import sys; import {args.module}; "
+              f"print(','.join(m for m in {MODULOS_PESADOS!r} if m in sys.modules))")
+    proc = subprocess.run([sys.executable, '-X', 'importtime', '-c', codigo],
+                          capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(__file__)))
+    if proc.returncode != 0:
+        print(proc.stderr[-2000:])
+        sys.exit(proc.returncode)
+
+    tiempos = parsear_importtime(proc.stderr)
+    total = tiempos.get(args.module, (0, 0))[1] / 1000
+    # Módulos de primer nivel (sin punto) que más tardan, incluyendo lo que importan
+    top = sorted(((n, t) for n, t in tiempos.items() if '.' not in n), key=lambda x: -x[1][1])[:args.top]
+    imprimir_tabla(('módulo', 'acumulado ms', 'propio ms'), [(n, f'{a / 1000:.1f}', f'{p / 1000:.1f}') for n, (p, a) in top])
+
+    cargados = [m for m in proc.stdout.strip().split(',') if m]
+    print(f"\nimport {args.module}: {total:.1f} ms")
+    fallos = []
+    if cargados:
+        fallos.append(f"dependencias pesadas cargadas al importar: {', '.join(cargados)}")
+    if args.max_ms and total > args.max_ms:
+        fallos.append(f"{total:.1f} ms supera el máximo de {args.max_ms} ms")
+    for fallo in fallos:
+        print("REGRESIÓN:", fallo)
+    sys.exit(1 if fallos else 0)
+
+#-------------------------------------------------------------------------------------------------------------------------------
+
+"""
+Benchmark: captura (enrolamiento) y verificación facial reproduciendo una carpeta de imágenes
+o un vídeo con frame_source.ReplaySource, sin cámara ni ventanas.
+"""
+def bench_face(args):
+    import cv2
+    import numpy as np
+
+    cascade = cv2.CascadeClassifier(face_engine.CASCADE_PATH)
+    lienzo = (frame_source.ANCHO, frame_source.ALTO) if not args.no_canvas else None
+    tmpdir = tempfile.mkdtemp()
+    try:
+        caras = os.path.join(tmpdir, 'faces')
+        os.makedirs(caras)
+        # Las caras de referencia (no las del usuario) se copian para entrenar el modelo base
+        for f in os.listdir(face_engine.FACES_DIR):
+            if f.lower().endswith(face_engine.EXTENSIONES) and not f.startswith('User'):
+                shutil.copy(os.path.join(face_engine.FACES_DIR, f), caras)
+
+        fuente = frame_source.ReplaySource(args.source, fps=args.fps, loop=True, lienzo=lienzo)
+        usuario = os.path.join(tmpdir, 'user_faces.npz')
+        enrolamiento = utils.create_dataset(cascade, source=fuente, muestras=args.samples, candidatos=args.candidates,
+                                            mostrar=False, user_faces_path=usuario)
+        fuente.release()
+        tam_usuario = os.path.getsize(usuario) if os.path.exists(usuario) else 0
+
+        t0 = time.perf_counter()
+        faces, ids, _ = face_engine.load_training_samples(caras, os.path.join(tmpdir, 'cache.npz'))
+        recortes_usuario = face_engine._load_user_faces(usuario) if tam_usuario else []
+        faces += recortes_usuario
+        ids += [face_engine.USER_LABEL] * len(recortes_usuario)
+        recognizer = cv2.face.LBPHFaceRecognizer_create()
+        recognizer.train(faces, np.array(ids))
+        t_train = time.perf_counter() - t0
+
+        filas = []
+        for predict_cada in (int(x) for x in args.predict_stride.split(',')):
+            fuente = frame_source.ReplaySource(args.source, fps=args.fps, loop=True, lienzo=lienzo)
+            _, stats = face_verify.verify('usuario', cascade, recognizer, fuente, mostrar=False,
+                                          tiempo_confirmacion=args.confirm, timeout=args.timeout,
+                                          escala=args.scale, predict_cada=predict_cada)
+            fuente.release()
+            fps = stats['frames_procesados'] / stats['duracion']
+            filas.append((predict_cada, f"{fps:.1f}", stats['frames_descartados'],
+                          f"{stats['procesado_p50_ms']:.1f}", f"{stats['procesado_p95_ms']:.1f}",
+                          f"{stats['latencia_p95_ms']:.1f}",
+                          '-' if stats['primer_reconocimiento'] is None else f"{stats['primer_reconocimiento']:.2f}",
+                          f"{stats['duracion']:.2f}", 'sí' if stats['desbloqueo'] is not None else 'no'))
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+    print(f"Enrolamiento: {enrolamiento['muestras']} de {enrolamiento['candidatos']} recortes conservados "
+          f"(selección {enrolamiento['seleccion'] * 1000:.0f} ms, {tam_usuario / 1024:.0f} KiB) en {enrolamiento['duracion']:.2f} s, "
+          f"{enrolamiento['fps']:.1f} fps, detección p50 {enrolamiento['deteccion_p50_ms']:.1f} ms / "
+          f"p95 {enrolamiento['deteccion_p95_ms']:.1f} ms")
+    print(f"Entrenamiento: {t_train * 1000:.0f} ms con {len(faces)} recortes\n")
+    imprimir_tabla(('predict cada', 'fps', 'descartados', 'procesado p50 ms', 'p95 ms', 'latencia p95 ms',
+                    'primer reconocimiento s', 'decisión s', 'desbloqueo'), filas)
+
+#-------------------------------------------------------------------------------------------------------------------------------
+
+"""
+Benchmark: latencia de desbloqueo de cada KDF calibrada frente al coste por intento para un
+atacante (tiempo y memoria por contraseña probada, y cuántas veces más cara que el SHA-256 antiguo).
+"""
+def bench_kdf(args):
+    import hashlib
+
+    # Referencia: el SHA-256 sin sal que se guardaba antes en master.key
+    n = 200000
+    t0 = time.perf_counter()
+    for i in range(n):
+        hashlib.sha256(b'contrasena-%d' % i).digest()
+    t_sha = (time.perf_counter() - t0) / n
+    filas = [('sha256 (antiguo)', '-', '-', f'{t_sha * 1000:.4f}', '0', f'{1 / t_sha:,.0f}', '1')]
+
+    nombres = args.kdfs.split(',') if args.kdfs else kdf.available()
+    for objetivo in [float(x) for x in args.target_ms.split(',')]:
+        for nombre in nombres:
+            t0 = time.perf_counter()
+            calibrada = kdf.calibrate(nombre, objetivo)
+            t_calibrar = time.perf_counter() - t0
+            almacenado = kdf.hash_password('contrasena', calibrada)
+            tiempos = []
+            for _ in range(args.repeat):
+                t0 = time.perf_counter()
+                kdf.verify_password('contrasena', almacenado)
+                tiempos.append(time.perf_counter() - t0)
+            t = percentil(tiempos, 50)
+            params = ','.join(f'{k}={v}' for k, v in calibrada.params.items())
+            filas.append((f'{nombre} @{objetivo:.0f} ms', params, f'{t_calibrar:.2f}', f'{t * 1000:.1f}',
+                          f'{calibrada.memoria / 2 ** 20:.0f}', f'{1 / t:,.1f}', f'{t / t_sha:,.0f}'))
+
+    imprimir_tabla(('kdf', 'parámetros', 'calibrar s', 'desbloqueo p50 ms', 'MiB/intento', 'intentos/s/núcleo', 'x sha256'), filas)
+
+    # Migración de un master.key antiguo en el primer desbloqueo
+    tmpdir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(tmpdir, 'master.key')
+        with open(path, 'w') as f:
+            f.write(hashlib.sha256(b'contrasena').hexdigest())
+        t0 = time.perf_counter()
+        utils.validate_master_key('contrasena', path)
+        t_migrar = time.perf_counter() - t0
+        t0 = time.perf_counter()
+        utils.validate_master_key('contrasena', path)
+        t_siguiente = time.perf_counter() - t0
+        print(f"\nMigración del master.key antiguo: {t_migrar * 1000:.0f} ms el primer desbloqueo, "
+              f"{t_siguiente * 1000:.0f} ms los siguientes.")
+    finally:
+        shutil.rmtree(tmpdir)
+
+#-------------------------------------------------------------------------------------------------------------------------------
+
+"""
+Benchmark: rotación de la clave del USB sobre un vault sintético cifrado. Para cada número de
+workers se rota una copia completa y otra que se interrumpe a mitad y se reanuda desde el checkpoint.
+"""
+def bench_rekey(args):
+    import threading
+
+    tmpdir = tempfile.mkdtemp()
+    try:
+        base = os.path.join(tmpdir, 'base')
+        os.mkdir(base)
+        clave_path = os.path.join(base, 'clave.key')
+        utils.create_key(clave_path)
+        clave = utils.cargar_clave(clave_path)
+        csv_path = os.path.join(base, 'passwordsList.csv')
+        # Tokens distintos en cada fila: rotar cuesta lo mismo, pero así se comprueba que no se mezclan
+        users = encrypt_many(clave, [f'usuario{i}@example.com' for i in range(args.rows)])
+        passwords = encrypt_many(clave, [f'contrasena-{i}' for i in range(args.rows)])
+        with open(csv_path, 'w', encoding='utf-8') as f:
+            f.write('SITE,USER,PASSWORD\n')
+            for i in range(args.rows):
+                f.write(f'site{i:07d}.com,{users[i]},{passwords[i]}\n')
+        utils.cifrar_csv(csv_path, clave_path)
+
+        filas = []
+        for workers in [int(n) for n in args.workers.split(',')]:
+            for interrumpir in (False, True):
+                copia = os.path.join(tmpdir, f'w{workers}{"i" if interrumpir else ""}')
+                shutil.copytree(base, copia)
+                csv_copia = os.path.join(copia, 'passwordsList.csv')
+                clave_copia = os.path.join(copia, 'clave.key')
+
+                cancelado = threading.Event()
+                def progreso(hecho, total):
+                    if interrumpir and hecho >= args.rows // 2:
+                        cancelado.set()
+                t0 = time.perf_counter()
+                stats = rekey.rotate_key(csv_copia, clave_copia, workers=workers, filas_por_lote=args.batch,
+                                         cancelado=cancelado, progreso=progreso, executor=args.executor)
+                reanudada = '-'
+                if not stats['completada']:
+                    stats = rekey.rotate_key(csv_copia, clave_copia, workers=workers, filas_por_lote=args.batch,
+                                             executor=args.executor)
+                    reanudada = stats['reanudada_desde']
+                dt = time.perf_counter() - t0
+
+                # Comprobación: la clave nueva abre el archivo y los tokens, y la anterior ya no
+                with open(clave_copia, 'rb') as f:
+                    nueva = f.read().strip()
+                with open(csv_copia, 'rb') as fin:
+                    muestra = list(itertools.islice(rekey._filas_origen(fin, nueva), 3))
+                assert nueva != clave and len(muestra) == 3
+                assert Fernet(nueva).decrypt(muestra[2][2].encode()) == b'contrasena-2'
+                assert not os.path.exists(csv_copia + rekey.SUFIJO_CHECKPOINT)
+                filas.append((workers, 'sí' if interrumpir else 'no', reanudada, f'{dt:.2f}',
+                              f'{args.rows / dt:,.0f}', f'{2 * args.rows / dt:,.0f}'))
+                shutil.rmtree(copia)
+    finally:
+        shutil.rmtree(tmpdir)
+
+    imprimir_tabla(('workers', 'interrumpida', 'reanudada en', 'total s', 'filas/s', 'tokens/s'), filas)
+
+#-------------------------------------------------------------------------------------------------------------------------------
+
+"""
+Benchmark: importación masiva de un volcado sintético de cada formato en un vault vacío, la misma
+importación otra vez (todo repetido: solo deduplicación) y exportación, en filas por segundo.
+"""
+def bench_bulk(args):
+    filas = []
+    for formato in args.formats.split(','):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            clave_path = os.path.join(tmpdir, 'clave.key')
+            utils.create_key(clave_path)
+            csv_path = os.path.join(tmpdir, 'passwordsList.csv')
+            extension = '.json' if formato.endswith('json') else '.csv'
+            volcado = os.path.join(tmpdir, 'export' + extension)
+            bulk_io.write_entries(volcado, ((f'site{i:07d}.com', f'usuario{i}@example.com', f'contrasena-{i}')
+                                            for i in range(args.rows)), formato)
+
+            nueva = utils.import_passwords(volcado, formato, csv_path, clave_path, workers=args.workers)
+            repetida = utils.import_passwords(volcado, formato, csv_path, clave_path, workers=args.workers)
+            assert nueva['importadas'] == args.rows and repetida['duplicadas'] == args.rows
+            salida = utils.export_passwords(os.path.join(tmpdir, 'salida' + extension), formato, csv_path, clave_path, workers=args.workers)
+            assert salida['exportadas'] == args.rows
+            filas.append((formato, f'{os.path.getsize(volcado) / 2 ** 20:.1f}', f'{nueva["filas_s"]:,.0f}',
+                          f'{repetida["filas_s"]:,.0f}', f'{salida["filas_s"]:,.0f}'))
+        finally:
+            shutil.rmtree(tmpdir)
+            utils.drop_search_index(csv_path)
+
+    print()
+    imprimir_tabla(('formato', 'volcado MiB', 'importar filas/s', 'deduplicar filas/s', 'exportar filas/s'), filas)
+
+#-------------------------------------------------------------------------------------------------------------------------------
+
+"""
+Benchmark: coste de la durabilidad por escritura. Compara el journal y la reescritura atómica del
+archivo (temporal + rename), con y sin fsync, en claro y cifrado en reposo, y el bloqueo de escritura.
+"""
+def bench_durability(args):
+    clave = Fernet.generate_key()
+    fernet = Fernet(clave)
+    user_cifrado = fernet.encrypt(b'nuevo').decode()
+    password_cifrada = fernet.encrypt(b'nueva').decode()
+    tmpdir = tempfile.mkdtemp()
+    sincronizar = storage.SINCRONIZAR
+    try:
+        base = os.path.join(tmpdir, 'base.csv')
+        crear_vault_sintetico(base, fernet, args.rows)
+
+        modos = [('journal', True, False, True), ('journal', False, False, True),
+                 ('atomica', True, False, False), ('atomica', False, False, False), ('reposo', True, True, False)]
+        filas = []
+        for nombre, sync, cifrado, journal in modos:
+            path = os.path.join(tmpdir, f'{nombre}-{sync}.csv')
+            shutil.copy(base, path)
+            storage.SINCRONIZAR = sync
+            vault = Vault(path, clave if cifrado else None)
+            if journal:
+                vault.enable_journal(fernet, compactar_cada=float('inf'), sync=sync)
+            tiempos = []
+            for i in range(args.writes):
+                t0 = time.perf_counter()
+                vault.put(f'nuevo{i}.com', user_cifrado, password_cifrada)
+                vault.save()
+                tiempos.append((time.perf_counter() - t0) * 1000)
+            vault.close()
+            if cifrado:
+                assert len(Vault(path, clave)) == args.rows + args.writes
+            filas.append((nombre, 'sí' if sync else 'no', 'sí' if cifrado else 'no', f'{percentil(tiempos, 50):.3f}',
+                          f'{percentil(tiempos, 95):.3f}', f'{1000 * len(tiempos) / sum(tiempos):.0f}'))
+
+        # Bloqueo de escritura sin competencia (lo que paga cada escritura fuera de una sesión de la GUI)
+        bloqueo = storage.FileLock(base)
+        tiempos = []
+        for _ in range(args.writes):
+            t0 = time.perf_counter()
+            with bloqueo:
+                pass
+            tiempos.append((time.perf_counter() - t0) * 1000)
+        filas.append(('bloqueo', '-', '-', f'{percentil(tiempos, 50):.3f}', f'{percentil(tiempos, 95):.3f}',
+                      f'{1000 * len(tiempos) / sum(tiempos):.0f}'))
+
+        imprimir_tabla(('modo', 'fsync', 'cifrado', 'p50 ms', 'p95 ms', 'escrituras/s'), filas)
+    finally:
+        storage.SINCRONIZAR = sincronizar
+        shutil.rmtree(tmpdir)
+
+#-------------------------------------------------------------------------------------------------------------------------------
+
+"""
+Benchmark: latencia de desbloqueo facial según el número de usuarios registrados, reproduciendo
+frames. Compara el modelo único con todos los usuarios (lo que usa la GUI: solo se acepta la etiqueta
+del usuario elegido) con un modelo de un solo usuario sobre las caras de referencia, más barato pero que
+puede confundir a otro usuario registrado con el elegido.
+"""
+def bench_users(args):
+    import cv2
+    import numpy as np
+
+    rng = np.random.default_rng(1234)
+    cascade = cv2.CascadeClassifier(face_engine.CASCADE_PATH)
+    lienzo = (frame_source.ANCHO, frame_source.ALTO)
+    tmpdir = tempfile.mkdtemp()
+    try:
+        caras = os.path.join(tmpdir, 'faces')
+        os.makedirs(caras)
+        origen = args.source
+        if os.path.abspath(args.source) == os.path.abspath(face_engine.FACES_DIR):
+            # Si se reproducen las propias caras de referencia, unas pocas hacen de usuario y no entran en el modelo base
+            origen = os.path.join(tmpdir, 'camara')
+            os.makedirs(origen)
+        referencias = sorted(f for f in os.listdir(face_engine.FACES_DIR)
+                             if f.lower().endswith(face_engine.EXTENSIONES) and not f.startswith('User'))
+        for i, f in enumerate(referencias):
+            destino = origen if origen != args.source and i < args.user_frames else caras
+            shutil.copy(os.path.join(face_engine.FACES_DIR, f), destino)
+        base = os.path.join(tmpdir, 'base.yml')
+        cache = os.path.join(tmpdir, 'cache.npz')
+        face_engine.ensure_base_model(caras, base, os.path.join(tmpdir, 'base.digest'), cache)
+        referencia = face_engine.normalize_crops(face_engine.load_training_samples(caras, cache)[0])
+
+        # El usuario que se desbloquea se enrola con los frames reproducidos; el resto son sintéticos
+        # (recortes de referencia volteados y con otro brillo): solo importa lo que pesan en el modelo
+        registro = users.UserRegistry(os.path.join(tmpdir, 'users.json'))
+        fuente = frame_source.ReplaySource(origen, fps=None, loop=True, lienzo=lienzo)
+        real = registro.add('usuario', vault=os.path.join(tmpdir, 'passwordsList.csv'), faces=os.path.join(tmpdir, 'user.npz'))
+        utils.create_dataset(cascade, source=fuente, mostrar=False, user_faces_path=real['faces'])
+        fuente.release()
+        maximo = max(int(n) for n in args.users.split(','))
+        for i in range(1, maximo):
+            usuario = registro.add(f'sintetico{i}', vault=os.path.join(tmpdir, f'v{i}.csv'), faces=os.path.join(tmpdir, f'u{i}.npz'))
+            elegidos = referencia[rng.choice(len(referencia), face_engine.MUESTRAS_USUARIO)][:, :, ::-1]
+            brillo = rng.uniform(0.7, 1.3)
+            face_engine.save_user_faces(np.clip(elegidos * brillo, 0, 255).astype(np.uint8), usuario['faces'])
+
+        filas = []
+        for n in (int(x) for x in args.users.split(',')):
+            usuarios = registro.users()[:n]
+            for modo in ('todos', 'un_usuario'):
+                elegidos = usuarios if modo == 'todos' else usuarios[:1]
+                t0 = time.perf_counter()
+                recognizer = face_engine.load_recognizer(os.path.join(tmpdir, 'no.yml'), base,
+                                                         usuarios=[(u['label'], u['faces']) for u in elegidos])
+                carga = time.perf_counter() - t0
+                histogramas = len(recognizer.getHistograms())
+                fuente = frame_source.ReplaySource(origen, fps=args.fps, loop=True, lienzo=lienzo)
+                etiqueta, stats = face_verify.verify({usuarios[0]['label']: usuarios[0]['name']}, cascade, recognizer, fuente,
+                                                     mostrar=False, tiempo_confirmacion=args.confirm, timeout=args.timeout,
+                                                     predict_cada=1, umbral=args.threshold)
+                fuente.release()
+                filas.append((n, modo, histogramas, f'{carga * 1000:.0f}', f"{stats['procesado_p50_ms']:.1f}",
+                              f"{stats['procesado_p95_ms']:.1f}",
+                              '-' if stats['desbloqueo'] is None else f"{stats['desbloqueo']:.2f}",
+                              registro.get(etiqueta)['name'] if etiqueta else '-'))
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+    imprimir_tabla(('usuarios', 'modelo', 'histogramas', 'carga ms', 'procesado p50 ms', 'p95 ms', 'desbloqueo s', 'reconocido'), filas)
+
+#-------------------------------------------------------------------------------------------------------------------------------
+
+"""
+Benchmark: coste de la medición por etapas (un span vacío y una función con @timed) desactivada y
+activada, y resumen con percentiles de un desbloqueo instrumentado repetido sobre un vault sintético.
+"""
+def bench_timing(args):
+    @timing.timed('bench.vacia')
+    def vacia():
+        pass
+
+    def coste_span():
+        t0 = time.perf_counter()
+        for _ in range(args.calls):
+            with timing.span('bench.span') as medida:
+                medida.count('n')
+        return (time.perf_counter() - t0) * 1e9 / args.calls
+
+    def coste_timed():
+        t0 = time.perf_counter()
+        for _ in range(args.calls):
+            vacia()
+        return (time.perf_counter() - t0) * 1e9 / args.calls
+
+    tmpdir = tempfile.mkdtemp()
+    try:
+        perfil = os.path.join(tmpdir, 'apm_profile.jsonl')
+        timing.disable()
+        filas = [('desactivada', f'{coste_span():.0f}', f'{coste_timed():.0f}')]
+        timing.enable(perfil)
+        filas.append(('activada', f'{coste_span():.0f}', f'{coste_timed():.0f}'))
+        timing.disable()
+        os.remove(perfil)
+        imprimir_tabla(('medición', 'span ns', '@timed ns'), filas)
+
+        # Desbloqueo instrumentado: snapshot mmap y, si no lo hay, leer el contenedor cifrado entero
+        clave_path = os.path.join(tmpdir, 'clave.key')
+        utils.create_key(clave_path)
+        clave = utils.cargar_clave(clave_path)
+        fernet = Fernet(clave)
+        csv_path = os.path.join(tmpdir, 'passwordsList.csv')
+        crear_vault_sintetico(csv_path, fernet, args.rows)
+        timing.enable(perfil)
+        for _ in range(args.repeat):
+            utils.cifrar_csv(csv_path, clave_path) # La primera vez cifra; después solo rehace el snapshot borrado
+            with timing.span('unlock.snapshot'):
+                snapshot = utils.open_snapshot(csv_path, clave_path)
+            snapshot.close()
+            os.remove(csv_path + '.vault')
+            with timing.span('unlock.stream'):
+                vault = Vault(csv_path, clave)
+                cache = DecryptCache(fernet)
+                for site in vault.sites()[:15]:
+                    cache.decrypt(vault.get(site)[0])
+        timing.disable()
+        print()
+        timing.print_summary(*timing.summarize(timing.read_records(perfil)))
+    finally:
+        timing.disable()
+        shutil.rmtree(tmpdir)
+
+#-------------------------------------------------------------------------------------------------------------------------------
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks del gestor de contraseñas")
+    sub = parser.add_subparsers(dest='bench', required=True)
+
+    p = sub.add_parser('journal', help="Escritura con reescritura completa vs journal")
+    p.add_argument('--rows', type=int, default=10000)
+    p.add_argument('--writes', type=int, default=200)
+    p.add_argument('--no-sync', action='store_true', help="No hacer fsync tras cada registro")
+    p.set_defaults(func=bench_journal)
+
+    p = sub.add_parser('crypto', help="Cifrado/descifrado por lotes según el número de workers")
+    p.add_argument('--rows', type=int, default=20000)
+    p.add_argument('--workers', default='1,2,4,8', help="Lista separada por comas")
+    p.add_argument('--executor', choices=('thread', 'process'), default='thread')
+    p.set_defaults(func=bench_crypto)
+
+    p = sub.add_parser('binary', help="Carga y tamaño del CSV cifrado frente al vault binario")
+    p.add_argument('--rows', type=int, default=100000)
+    p.set_defaults(func=bench_binary)
+
+    p = sub.add_parser('unlock', help="Desbloqueo con snapshot mmap frente a descifrar el CSV")
+    p.add_argument('--sizes', default='100,1000,10000,100000', help="Tamaños de vault separados por comas")
+    p.set_defaults(func=bench_unlock)
+
+    p = sub.add_parser('search', help="Latencia del índice de búsqueda por trigramas/prefijos")
+    p.add_argument('--rows', type=int, default=100000)
+    p.add_argument('--repeat', type=int, default=20)
+    p.add_argument('--limit', type=int, default=200, help="Máximo de resultados por consulta (lo que muestra la lista)")
+    p.set_defaults(func=bench_search)
+
+    p = sub.add_parser('imports', help="Tiempo de importación en frío (-X importtime)")
+    p.add_argument('--module', default='main_gui')
+    p.add_argument('--top', type=int, default=10)
+    p.add_argument('--max-ms', type=float, default=0, help="Falla si la importación tarda más (0 = sin límite)")
+    p.set_defaults(func=bench_imports)
+
+    p = sub.add_parser('face', help="Captura y verificación facial reproduciendo imágenes o un vídeo")
+    p.add_argument('--source', default='faces', help="Carpeta de imágenes o archivo de vídeo")
+    p.add_argument('--fps', type=float, default=30, help="Ritmo de la fuente (0 = sin límite)")
+    p.add_argument('--no-canvas', action='store_true', help="Usar las imágenes tal cual, sin centrarlas en un frame de 640x480")
+    p.add_argument('--samples', type=int, default=face_engine.MUESTRAS_USUARIO, help="Recortes que se conservan")
+    p.add_argument('--candidates', type=int, default=100, help="Recortes capturados entre los que se elige")
+    p.add_argument('--scale', type=float, default=face_verify.ESCALA_DETECCION)
+    p.add_argument('--predict-stride', default='1,2,4', help="Valores de predict_cada separados por comas")
+    p.add_argument('--confirm', type=float, default=face_verify.TIEMPO_CONFIRMACION)
+    p.add_argument('--timeout', type=float, default=10)
+    p.set_defaults(func=bench_face)
+
+    p = sub.add_parser('kdf', help="Latencia de desbloqueo de la clave maestra frente al coste por intento")
+    p.add_argument('--target-ms', default=str(kdf.OBJETIVO_MS), help="Latencias objetivo de calibración separadas por comas")
+    p.add_argument('--kdfs', default='', help="KDF a medir separadas por comas (por defecto, las disponibles)")
+    p.add_argument('--repeat', type=int, default=5)
+    p.set_defaults(func=bench_kdf)
+
+    p = sub.add_parser('rekey', help="Rotación de la clave del USB (con interrupción y reanudación)")
+    p.add_argument('--rows', type=int, default=100000)
+    p.add_argument('--workers', default='1,2,4', help="Lista separada por comas")
+    p.add_argument('--batch', type=int, default=rekey.FILAS_POR_LOTE, help="Filas por lote/checkpoint")
+    p.add_argument('--executor', choices=('thread', 'process'), default='thread')
+    p.set_defaults(func=bench_rekey)
+
+    p = sub.add_parser('bulk', help="Importación/exportación masiva de volcados de navegadores y Bitwarden")
+    p.add_argument('--rows', type=int, default=100000)
+    p.add_argument('--formats', default='chrome,firefox,bitwarden,bitwarden-json', help="Formatos separados por comas")
+    p.add_argument('--workers', type=int, default=None)
+    p.set_defaults(func=bench_bulk)
+
+    p = sub.add_parser('durability', help="Latencia por escritura según la durabilidad (fsync, rename atómico, cifrado en reposo)")
+    p.add_argument('--rows', type=int, default=10000)
+    p.add_argument('--writes', type=int, default=100)
+    p.set_defaults(func=bench_durability)
+
+    p = sub.add_parser('users', help="Desbloqueo facial según el número de usuarios registrados (frames reproducidos)")
+    p.add_argument('--users', default='1,4,16,64', help="Números de usuarios separados por comas")
+    p.add_argument('--source', default='faces', help="Carpeta de imágenes o archivo de vídeo")
+    p.add_argument('--fps', type=float, default=30, help="Ritmo de la fuente (0 = sin límite)")
+    p.add_argument('--user-frames', type=int, default=2, help="Imágenes de --source que hacen de usuario si es la carpeta de referencia")
+    p.add_argument('--threshold', type=float, default=70,
+                   help="Umbral LBPH (fotos fijas: la cara seguida se recorta algo distinto que al enrolar)")
+    p.add_argument('--confirm', type=float, default=face_verify.TIEMPO_CONFIRMACION)
+    p.add_argument('--timeout', type=float, default=10)
+    p.set_defaults(func=bench_users)
+
+    p = sub.add_parser('timing', help="Coste de la medición por etapas (APM_PROFILE) y resumen de un desbloqueo instrumentado")
+    p.add_argument('--calls', type=int, default=200000, help="Spans vacíos por medida de coste")
+    p.add_argument('--rows', type=int, default=10000)
+    p.add_argument('--repeat', type=int, default=20, help="Desbloqueos instrumentados")
+    p.set_defaults(func=bench_timing)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,144 @@
+import csv
+import json
+import os
+from urllib.parse import urlsplit
+
+import storage
+
+
+# Columnas (en orden de exportación) de cada formato CSV y de dónde sale SITE, USER y PASSWORD
+FORMATOS_CSV = {
+    'apm': {'columnas': ['SITE', 'USER', 'PASSWORD'], 'site': 'SITE', 'url': None, 'user': 'USER', 'password': 'PASSWORD'},
+    'chrome': {'columnas': ['name', 'url', 'username', 'password', 'note'],
+               'site': 'name', 'url': 'url', 'user': 'username', 'password': 'password'},
+    'firefox': {'columnas': ['url', 'username', 'password', 'httpRealm', 'formActionOrigin', 'guid',
+                             'timeCreated', 'timeLastUsed', 'timePasswordChanged'],
+                'site': None, 'url': 'url', 'user': 'username', 'password': 'password'},
+    'bitwarden': {'columnas': ['folder', 'favorite', 'type', 'name', 'notes', 'fields', 'reprompt',
+                               'login_uri', 'login_username', 'login_password', 'login_totp'],
+                  'site': 'name', 'url': 'login_uri', 'user': 'login_username', 'password': 'login_password'},
+}
+FORMATOS_JSON = ('apm-json', 'bitwarden-json')
+FORMATOS = tuple(FORMATOS_CSV) + FORMATOS_JSON
+
+
+#-------------------------------------------------------------------------------------------------------------------------------
+
+"""Función que saca el nombre del sitio de una URL (https://www.example.com/login -> www.example.com)"""
+def site_from_url(url):
+    url = (url or '').strip()
+    if not url:
+        return ''
+    host = urlsplit(url if '://' in url else '//' + url).hostname
+    return host or url
+
+def _url_de_sitio(site):
+    return site if '://' in site else f'https://{site}'
+
+#-------------------------------------------------------------------------------------------------------------------------------
+
+"""Función que detecta el formato de un volcado de contraseñas por su extensión y su cabecera"""
+def detect_format(path):
+    with open(path, 'r', encoding='utf-8-sig', newline='') as f:
+        if path.lower().endswith('.json'):
+            inicio = f.read(4096).lstrip()
+            # Bitwarden exporta {"encrypted": false, "folders": [...], "items": [...]}; el nuestro es una lista
+            return 'apm-json' if inicio.startswith('[') else 'bitwarden-json'
+        cabecera = next(csv.reader(f), [])
+    columnas = {c.strip() for c in cabecera}
+    for formato, spec in FORMATOS_CSV.items():
+        requeridas = {c for c in (spec['site'], spec['url'], spec['user'], spec['password']) if c}
+        if requeridas <= columnas:
+            return formato
+    raise ValueError(f"Formato de {os.path.basename(path)} no reconocido (cabecera: {', '.join(cabecera)})")
+
+#-------------------------------------------------------------------------------------------------------------------------------
+
+def _filas_csv(path, spec):
+    with open(path, 'r', encoding='utf-8-sig', newline='') as f:
+        for row in csv.DictReader(f):
+            site = (row.get(spec['site']) or '').strip() if spec['site'] else ''
+            if not site and spec['url']:
+                site = site_from_url(row.get(spec['url']))
+            yield site, row.get(spec['user']) or '', row.get(spec['password']) or ''
+
+def _filas_json(path, formato):
+    # json no permite leer por partes con la biblioteca estándar: se carga el documento y se recorre sin copiarlo
+    with open(path, 'r', encoding='utf-8-sig') as f:
+        datos = json.load(f)
+    if formato == 'apm-json':
+        for item in datos:
+            yield item.get('SITE') or '', item.get('USER') or '', item.get('PASSWORD') or ''
+        return
+    for item in datos.get('items', []):
+        login = item.get('login') or {}
+        if item.get('type', 1) != 1 or not login:
+            continue # Solo elementos de tipo login (no notas, tarjetas ni identidades)
+        site = (item.get('name') or '').strip()
+        if not site:
+            uris = login.get('uris') or [{}]
+            site = site_from_url(uris[0].get('uri'))
+        yield site, login.get('username') or '', login.get('password') or ''
+
+"""
+Generador de entradas (SITE, USER, PASSWORD) en claro de un volcado CSV o JSON de Chrome, Firefox,
+Bitwarden o de este gestor. Las filas sin sitio o sin contraseña se saltan; si se pasa 'stats' se
+cuentan ahí ('leidas' e 'invalidas').
+"""
+def read_entries(path, formato=None, stats=None):
+    formato = formato or detect_format(path)
+    if formato in FORMATOS_CSV:
+        filas = _filas_csv(path, FORMATOS_CSV[formato])
+    elif formato in FORMATOS_JSON:
+        filas = _filas_json(path, formato)
+    else:
+        raise ValueError(f"Formato desconocido: {formato}")
+    for site, user, password in filas:
+        if stats is not None:
+            stats['leidas'] = stats.get('leidas', 0) + 1
+        if not site or not password:
+            if stats is not None:
+                stats['invalidas'] = stats.get('invalidas', 0) + 1
+            continue
+        yield site, user, password
+
+#-------------------------------------------------------------------------------------------------------------------------------
+
+def _fila_csv(formato, site, user, password):
+    if formato == 'apm':
+        return [site, user, password]
+    if formato == 'chrome':
+        return [site, _url_de_sitio(site), user, password, '']
+    if formato == 'firefox':
+        return [_url_de_sitio(site), user, password, '', '', '', '', '', '']
+    return ['', '', 'login', site, '', '', '0', _url_de_sitio(site), user, password, ''] # bitwarden
+
+def _item_json(formato, site, user, password):
+    if formato == 'apm-json':
+        return {'SITE': site, 'USER': user, 'PASSWORD': password}
+    return {'type': 1, 'name': site, 'favorite': False, 'notes': None,
+            'login': {'username': user, 'password': password, 'uris': [{'match': None, 'uri': _url_de_sitio(site)}]}}
+
+"""
+Función para escribir entradas (SITE, USER, PASSWORD) en claro en un volcado del formato indicado,
+fila a fila. El archivo queda solo legible por el usuario. Devuelve el número de entradas escritas.
+"""
+def write_entries(path, entradas, formato='chrome'):
+    if formato not in FORMATOS:
+        raise ValueError(f"Formato desconocido: {formato}")
+    n = 0
+    # Las contraseñas van en claro: el archivo se crea ya con permisos 0600 (en POSIX)
+    with storage.atomic_write(path, 'w', permisos=0o600, encoding='utf-8', newline='') as f:
+        if formato in FORMATOS_CSV:
+            writer = csv.writer(f)
+            writer.writerow(FORMATOS_CSV[formato]['columnas'])
+            for site, user, password in entradas:
+                writer.writerow(_fila_csv(formato, site, user, password))
+                n += 1
+        else:
+            f.write('[' if formato == 'apm-json' else '{"encrypted": false, "folders": [], "items": [')
+            for site, user, password in entradas:
+                f.write(('\n' if n == 0 else ',\n') + json.dumps(_item_json(formato, site, user, password), ensure_ascii=False))
+                n += 1
+            f.write('\n]' if formato == 'apm-json' else '\n]}')
+    return n
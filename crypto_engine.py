@@ -0,0 +1,238 @@
+import base64
+import codecs
+import os
+import struct
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+from cryptography.exceptions import InvalidTag
+from cryptography.fernet import Fernet, InvalidToken, MultiFernet
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+
+
+TAM_LOTE = 512 # Campos por tarea enviada al pool
+
+# Contenedor cifrado por segmentos: cabecera + [longitud(4) | AES-GCM(segmento)]*
+MAGIC_STREAM = b'APMS'
+VERSION_STREAM = 1
+TAM_SEGMENTO = 64 * 1024
+_CABECERA = struct.Struct('>4sBI7s') # magic, versión, tamaño de segmento, prefijo del nonce
+_LONGITUD = struct.Struct('>I')
+
+PREFIJO_FERNET = b'gAAAAA'
+_ALFABETO_FERNET = frozenset(b'ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789-_=')
+
+
+#-------------------------------------------------------------------------------------------------------------------------------
+
+"""Funciones que ejecuta cada worker. Reciben la clave en bytes para poder enviarse a otro proceso"""
+def _encrypt_chunk(clave, valores):
+    fernet = Fernet(clave)
+    return [fernet.encrypt(v.encode()).decode() for v in valores]
+
+def _decrypt_chunk(clave, tokens, ignorar_errores):
+    fernet = Fernet(clave)
+    resultado = []
+    for token in tokens:
+        try:
+            resultado.append(fernet.decrypt(token.encode()).decode())
+        except Exception:
+            if not ignorar_errores:
+                raise
+            resultado.append(None) # Campo corrupto: lo marcamos y seguimos con el resto
+    return resultado
+
+def _rotate_chunk(claves, tokens):
+    # claves = (nueva, anterior): rotate() descifra con cualquiera y vuelve a cifrar con la primera
+    fernet = MultiFernet([Fernet(c) for c in claves])
+    resultado = []
+    for token in tokens:
+        try:
+            resultado.append(fernet.rotate(token.encode()).decode())
+        except InvalidToken:
+            resultado.append(token) # Campo corrupto: ninguna clave lo descifra, se deja tal cual
+    return resultado
+
+#-------------------------------------------------------------------------------------------------------------------------------
+
+"""
+Función para repartir una lista en lotes entre un pool de hilos o de procesos, conservando el orden.
+Con 'pool' se usa ese executor (p.ej. uno que se reutiliza lote a lote) en lugar de crear otro.
+"""
+def _map_chunks(func, clave, items, extra=(), workers=None, tam_lote=TAM_LOTE, executor='thread', pool=None):
+    items = list(items)
+    workers = workers or os.cpu_count() or 1
+    lotes = [items[i:i + tam_lote] for i in range(0, len(items), tam_lote)]
+
+    if pool is not None:
+        futuros = [pool.submit(func, clave, lote, *extra) for lote in lotes]
+        return [r for futuro in futuros for r in futuro.result()]
+
+    # Con un solo worker o un solo lote no compensa arrancar un pool
+    if workers == 1 or len(lotes) <= 1:
+        return [r for lote in lotes for r in func(clave, lote, *extra)]
+
+    pool_cls = ProcessPoolExecutor if executor == 'process' else ThreadPoolExecutor
+    with pool_cls(max_workers=workers) as pool:
+        futuros = [pool.submit(func, clave, lote, *extra) for lote in lotes]
+        return [r for futuro in futuros for r in futuro.result()]
+
+#-------------------------------------------------------------------------------------------------------------------------------
+
+"""
+Función para cifrar muchos valores (str) a la vez. Devuelve los tokens en el mismo orden.
+'executor' puede ser 'thread' (por defecto) o 'process'.
+"""
+def encrypt_many(clave, valores, workers=None, tam_lote=TAM_LOTE, executor='thread', pool=None):
+    return _map_chunks(_encrypt_chunk, clave, valores, workers=workers, tam_lote=tam_lote, executor=executor, pool=pool)
+
+#-------------------------------------------------------------------------------------------------------------------------------
+
+"""
+Función para descifrar muchos tokens (str) a la vez. Con ignorar_errores=True los tokens
+inválidos devuelven None en lugar de abortar todo el lote.
+"""
+def decrypt_many(clave, tokens, workers=None, tam_lote=TAM_LOTE, executor='thread', ignorar_errores=False, pool=None):
+    return _map_chunks(_decrypt_chunk, clave, tokens, extra=(ignorar_errores,), workers=workers, tam_lote=tam_lote,
+                       executor=executor, pool=pool)
+
+#-------------------------------------------------------------------------------------------------------------------------------
+
+"""
+Función para volver a cifrar muchos tokens con 'nueva' (MultiFernet.rotate). Acepta tokens de
+'anterior' o ya rotados, así que repetir un lote tras una interrupción no hace daño.
+"""
+def rotate_many(nueva, anterior, tokens, workers=None, tam_lote=TAM_LOTE, executor='thread', pool=None):
+    return _map_chunks(_rotate_chunk, (nueva, anterior), tokens, workers=workers, tam_lote=tam_lote, executor=executor, pool=pool)
+
+#-------------------------------------------------------------------------------------------------------------------------------
+
+"""Función para derivar una subclave de 32 bytes (para un uso concreto) a partir de la clave Fernet del USB"""
+def derive_subkey(clave, info):
+    hkdf = HKDF(algorithm=hashes.SHA256(), length=32, salt=None, info=info)
+    return hkdf.derive(base64.urlsafe_b64decode(clave))
+
+def _clave_stream(clave):
+    return derive_subkey(clave, b'apm-stream-v1')
+
+def _nonce(prefijo, indice, final):
+    # Construcción STREAM: el nonce incluye el índice del segmento y si es el último,
+    # así no se pueden reordenar, duplicar ni truncar segmentos sin que falle la autenticación
+    return prefijo + struct.pack('>IB', indice, 1 if final else 0)
+
+#-------------------------------------------------------------------------------------------------------------------------------
+
+"""Función para saber si un archivo tiene el formato de contenedor por segmentos"""
+def is_stream_file(path):
+    with open(path, 'rb') as f:
+        return f.read(len(MAGIC_STREAM)) == MAGIC_STREAM
+
+"""
+Función para saber si un archivo está en el formato de versiones anteriores: todo el CSV cifrado en
+un único token Fernet (versión 0x80 y marca de tiempo en base64, por eso empiezan por 'gAAAAA').
+"""
+def is_fernet_file(path):
+    with open(path, 'rb') as f:
+        inicio = f.read(64).rstrip()
+    return inicio.startswith(PREFIJO_FERNET) and all(c in _ALFABETO_FERNET for c in inicio)
+
+"""Función para descifrar un archivo del formato anterior. Devuelve el CSV en claro (bytes)."""
+def decrypt_fernet_file(path, clave):
+    with open(path, 'rb') as f:
+        return Fernet(clave).decrypt(f.read().strip())
+
+#-------------------------------------------------------------------------------------------------------------------------------
+
+"""
+Función que devuelve el prefijo de nonce de un contenedor (aleatorio en cada cifrado), que sirve
+para identificar una versión concreta del archivo sin descifrarlo. None si no es un contenedor.
+"""
+def stream_generation(path):
+    if not os.path.exists(path):
+        return None
+    with open(path, 'rb') as f:
+        cabecera = f.read(_CABECERA.size)
+    if len(cabecera) != _CABECERA.size or not cabecera.startswith(MAGIC_STREAM):
+        return None
+    return _CABECERA.unpack(cabecera)[3]
+
+#-------------------------------------------------------------------------------------------------------------------------------
+
+"""
+Función para cifrar 'fin' en 'fout' (archivos binarios) por segmentos de tamaño fijo.
+La memoria usada es del orden de un segmento, sea cual sea el tamaño del archivo.
+"""
+def encrypt_stream(fin, fout, clave, tam_segmento=TAM_SEGMENTO):
+    aes = AESGCM(_clave_stream(clave))
+    prefijo = os.urandom(7)
+    cabecera = _CABECERA.pack(MAGIC_STREAM, VERSION_STREAM, tam_segmento, prefijo)
+    fout.write(cabecera)
+
+    indice = 0
+    actual = fin.read(tam_segmento)
+    while True:
+        # Leemos el siguiente segmento por adelantado para saber si el actual es el último
+        siguiente = fin.read(tam_segmento)
+        final = not siguiente
+        cifrado = aes.encrypt(_nonce(prefijo, indice, final), actual, cabecera)
+        fout.write(_LONGITUD.pack(len(cifrado)))
+        fout.write(cifrado)
+        if final:
+            break
+        actual = siguiente
+        indice += 1
+
+#-------------------------------------------------------------------------------------------------------------------------------
+
+"""
+Generador que descifra un contenedor segmento a segmento. Cada segmento se autentica
+antes de entregarse; si el archivo está truncado se lanza ValueError al llegar al final.
+"""
+def decrypt_stream(fin, clave):
+    cabecera = fin.read(_CABECERA.size)
+    if len(cabecera) != _CABECERA.size:
+        raise ValueError("Cabecera del contenedor incompleta.")
+    magic, version, tam_segmento, prefijo = _CABECERA.unpack(cabecera)
+    if magic != MAGIC_STREAM or version != VERSION_STREAM:
+        raise ValueError("El archivo no es un contenedor cifrado compatible.")
+
+    aes = AESGCM(_clave_stream(clave))
+    indice = 0
+    while True:
+        longitud = fin.read(_LONGITUD.size)
+        if not longitud:
+            raise ValueError("Contenedor truncado: falta el segmento final.")
+        (n,) = _LONGITUD.unpack(longitud)
+        if n > tam_segmento + 16:
+            raise ValueError("Segmento con longitud no válida.")
+        cifrado = fin.read(n)
+        # Un segmento solo se descifra con el nonce correcto, que indica si es el último
+        try:
+            claro = aes.decrypt(_nonce(prefijo, indice, False), cifrado, cabecera)
+            final = False
+        except InvalidTag:
+            claro = aes.decrypt(_nonce(prefijo, indice, True), cifrado, cabecera)
+            final = True
+        yield claro
+        if final:
+            if fin.read(1):
+                raise ValueError("Datos extra tras el segmento final.")
+            return
+        indice += 1
+
+#-------------------------------------------------------------------------------------------------------------------------------
+
+"""Generador de líneas de texto de un contenedor cifrado, disponible antes de procesar el último segmento"""
+def decrypt_lines(fin, clave, encoding='utf-8'):
+    decoder = codecs.getincrementaldecoder(encoding)()
+    pendiente = ''
+    for segmento in decrypt_stream(fin, clave):
+        pendiente += decoder.decode(segmento)
+        lineas = pendiente.split('\n')
+        pendiente = lineas.pop()
+        for linea in lineas:
+            yield linea + '\n'
+    pendiente += decoder.decode(b'', final=True)
+    if pendiente:
+        yield pendiente
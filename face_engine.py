@@ -0,0 +1,328 @@
+import hashlib
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+
+CASCADE_PATH = "haarcascade_frontalface_default.xml"
+FACES_DIR = 'faces'
+MODEL_PATH = 'trainer/trainer.yml'
+CACHE_PATH = 'trainer/faces_cache.npz' # Recortes de cara ya detectados, indexados por hash de la imagen
+BASE_MODEL_PATH = 'trainer/base.yml' # Modelo entrenado solo con las caras de referencia (sin el usuario)
+BASE_DIGEST_PATH = 'trainer/base.digest' # Huella del conjunto de referencia con el que se entrenó base.yml
+USER_FACES_PATH = 'trainer/user_faces.npz' # Recortes del usuario que se añaden a base.yml con update()
+USER_LABEL = 1
+TAM_RECORTE = (100, 100) # Tamaño al que se normalizan los recortes del usuario (el de las caras de referencia)
+MUESTRAS_USUARIO = 50 # Recortes del usuario que se conservan tras filtrar por calidad
+DESCARTE_BORROSAS = 0.25 # Fracción de candidatos más borrosos que se descarta antes de elegir
+MIN_PARA_POOL = 64 # Por debajo de este número de imágenes nuevas no compensa arrancar procesos
+EXTENSIONES = ('.jpg', '.jpeg', '.png')
+
+
+#-------------------------------------------------------------------------------------------------------------------------------
+
+"""Función para extraer el ID de usuario del nombre del archivo ('User.<id>.<n>.jpg' o '<id>.jpg')"""
+def label_from_filename(filename):
+    if filename.startswith("User"):
+        return int(filename.split(".")[1])
+    return int(os.path.splitext(filename)[0])
+
+def _hash_archivo(path):
+    with open(path, 'rb') as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+#-------------------------------------------------------------------------------------------------------------------------------
+
+_detector = None # Clasificador de cada proceso/hilo worker, se carga una sola vez
+
+"""Función que abre una imagen, la pasa a gris y devuelve los recortes de las caras detectadas"""
+def detect_faces_in_file(path, cascade_path=CASCADE_PATH):
+    global _detector
+    import cv2
+    import numpy as np
+    from PIL import Image
+
+    if _detector is None:
+        _detector = cv2.CascadeClassifier(cascade_path)
+    img_numpy = np.array(Image.open(path).convert('L'), 'uint8')
+    return [img_numpy[y:y+h, x:x+w].copy() for (x, y, w, h) in _detector.detectMultiScale(img_numpy)]
+
+#-------------------------------------------------------------------------------------------------------------------------------
+
+"""Función para leer la caché de recortes: {hash: [recortes]}"""
+def load_face_cache(cache_path=CACHE_PATH):
+    import numpy as np
+
+    if not os.path.exists(cache_path):
+        return {}
+    try:
+        datos = np.load(cache_path)
+        hashes, shapes, offsets, pixels = datos['hashes'], datos['shapes'], datos['offsets'], datos['pixels']
+    except Exception as e:
+        print(f"Caché de caras no válida ({e}), se regenerará.")
+        return {}
+
+    cache = {}
+    for h, (alto, ancho), inicio in zip(hashes, shapes, offsets):
+        recortes = cache.setdefault(str(h), [])
+        if alto:
+            recortes.append(pixels[inicio:inicio + alto * ancho].reshape(alto, ancho))
+    return cache
+
+"""
+Función para guardar la caché de recortes en un único .npz: todos los píxeles en un array
+plano y, por cada recorte, su hash, forma y offset. Una imagen sin caras se guarda con forma (0, 0).
+"""
+def save_face_cache(cache, cache_path=CACHE_PATH):
+    import numpy as np
+
+    hashes, shapes, offsets, bloques = [], [], [], []
+    total = 0
+    for h, recortes in cache.items():
+        for recorte in recortes or [None]:
+            hashes.append(h)
+            if recorte is None:
+                shapes.append((0, 0))
+                offsets.append(total)
+                continue
+            shapes.append(recorte.shape)
+            offsets.append(total)
+            bloques.append(recorte.ravel())
+            total += recorte.size
+
+    os.makedirs(os.path.dirname(cache_path) or '.', exist_ok=True)
+    tmp = cache_path + '.tmp.npz'
+    np.savez(tmp,
+             hashes=np.array(hashes, dtype='U40'),
+             shapes=np.array(shapes, dtype=np.int32).reshape(-1, 2),
+             offsets=np.array(offsets, dtype=np.int64),
+             pixels=np.concatenate(bloques) if bloques else np.zeros(0, np.uint8))
+    os.replace(tmp, cache_path)
+
+#-------------------------------------------------------------------------------------------------------------------------------
+
+"""
+Función para obtener los recortes y etiquetas de entrenamiento de la carpeta de caras.
+Solo se decodifican y detectan las imágenes cuyo hash no está en la caché (normalmente,
+las capturas nuevas del usuario); si son muchas se reparten en un pool de procesos.
+"""
+def load_training_samples(path=FACES_DIR, cache_path=CACHE_PATH, workers=None, incluir=None):
+    archivos = sorted(f for f in os.listdir(path) if f.lower().endswith(EXTENSIONES) and (incluir is None or incluir(f)))
+    hashes = {f: _hash_archivo(os.path.join(path, f)) for f in archivos}
+
+    cache = load_face_cache(cache_path)
+    pendientes = sorted({h: f for f, h in hashes.items() if h not in cache}.items())
+
+    if pendientes:
+        rutas = [os.path.join(path, f) for _, f in pendientes]
+        if len(rutas) >= MIN_PARA_POOL and (workers or os.cpu_count() or 1) > 1:
+            with ProcessPoolExecutor(max_workers=workers) as pool:
+                resultados = list(pool.map(detect_faces_in_file, rutas, chunksize=8))
+        else:
+            resultados = [detect_faces_in_file(r) for r in rutas]
+        for (h, _), recortes in zip(pendientes, resultados):
+            cache[h] = recortes
+
+    # La caché solo conserva las imágenes que siguen existiendo (las capturas borradas desaparecen).
+    # Si solo hemos mirado una parte de la carpeta no podemos saber qué sobra, así que no se poda.
+    vigentes = set(hashes.values())
+    if incluir is None:
+        cache = {h: recortes for h, recortes in cache.items() if h in vigentes}
+    if pendientes or (incluir is None and len(cache) != len(vigentes)):
+        save_face_cache(cache, cache_path)
+
+    faces, ids = [], []
+    for f in archivos:
+        for recorte in cache[hashes[f]]:
+            faces.append(recorte)
+            ids.append(label_from_filename(f))
+    return faces, ids, len(pendientes)
+
+#-------------------------------------------------------------------------------------------------------------------------------
+
+"""
+Función para entrenar el modelo LBPH completo (referencia + usuarios), reutilizando la caché de recortes.
+'usuarios' es una lista de (etiqueta, archivo de recortes); por defecto, el usuario único de siempre.
+"""
+def train_face_recognizer(path=FACES_DIR, model_path=MODEL_PATH, cache_path=CACHE_PATH, workers=None, usuarios=None):
+    import cv2
+    import numpy as np
+
+    # Si los recortes de los usuarios ya están empaquetados, de la carpeta solo se leen las caras de referencia
+    usuarios = [(label, f) for label, f in usuarios or [(USER_LABEL, USER_FACES_PATH)] if os.path.exists(f)]
+    faces, ids, nuevas = load_training_samples(path, cache_path, workers, incluir=_es_referencia if usuarios else None)
+    for label, user_faces_path in usuarios:
+        usuario = _load_user_faces(user_faces_path)
+        faces += usuario
+        ids += [label] * len(usuario)
+    print(f"\n {nuevas} imágenes nuevas procesadas, {len(faces)} recortes en total.")
+
+    recognizer = cv2.face.LBPHFaceRecognizer_create()
+    recognizer.train(faces, np.array(ids))
+
+    os.makedirs(os.path.dirname(model_path) or '.', exist_ok=True)
+    recognizer.write(model_path)
+    return recognizer, len(np.unique(ids))
+
+#-------------------------------------------------------------------------------------------------------------------------------
+
+def _es_captura_usuario(filename):
+    return filename.startswith("User")
+
+def _es_referencia(filename):
+    return not filename.startswith("User")
+
+"""Función para calcular la huella del conjunto de imágenes de referencia (nombre + contenido)"""
+def _digest_referencia(path=FACES_DIR):
+    digest = hashlib.sha1()
+    for f in sorted(os.listdir(path)):
+        if f.lower().endswith(EXTENSIONES) and _es_referencia(f):
+            digest.update(f.encode() + b'\0' + _hash_archivo(os.path.join(path, f)).encode())
+    return digest.hexdigest()
+
+"""
+Función para asegurar que existe el modelo base (solo caras de referencia). Se reentrena
+únicamente si cambian las imágenes de referencia, no cuando el usuario actualiza su Face ID.
+"""
+def ensure_base_model(path=FACES_DIR, base_path=BASE_MODEL_PATH, digest_path=BASE_DIGEST_PATH, cache_path=CACHE_PATH):
+    import cv2
+    import numpy as np
+
+    digest = _digest_referencia(path)
+    if os.path.exists(base_path) and os.path.exists(digest_path):
+        with open(digest_path) as f:
+            if f.read().strip() == digest:
+                return False
+
+    faces, ids, _ = load_training_samples(path, cache_path, incluir=_es_referencia)
+    recognizer = cv2.face.LBPHFaceRecognizer_create()
+    recognizer.train(faces, np.array(ids))
+    os.makedirs(os.path.dirname(base_path) or '.', exist_ok=True)
+    recognizer.write(base_path)
+    with open(digest_path, 'w') as f:
+        f.write(digest)
+    print(f"\n Modelo base entrenado con {len(faces)} caras de referencia.")
+    return True
+
+"""Función para guardar los recortes del usuario en un único array (N, alto, ancho) comprimido"""
+def save_user_faces(faces, user_faces_path=USER_FACES_PATH):
+    import numpy as np
+
+    os.makedirs(os.path.dirname(user_faces_path) or '.', exist_ok=True)
+    tmp = user_faces_path + '.tmp.npz'
+    np.savez_compressed(tmp, caras=normalize_crops(faces))
+    os.replace(tmp, user_faces_path)
+
+def _load_user_faces(user_faces_path=USER_FACES_PATH):
+    import numpy as np
+
+    with np.load(user_faces_path) as datos:
+        return list(datos['caras'])
+
+#-------------------------------------------------------------------------------------------------------------------------------
+
+"""Función para redimensionar una lista de recortes a TAM_RECORTE y apilarlos en un array (N, alto, ancho)"""
+def normalize_crops(recortes, tam=TAM_RECORTE):
+    import cv2
+    import numpy as np
+
+    if isinstance(recortes, np.ndarray) and recortes.shape[1:] == (tam[1], tam[0]):
+        return recortes
+    lote = np.empty((len(recortes), tam[1], tam[0]), np.uint8)
+    for i, recorte in enumerate(recortes):
+        lote[i] = recorte if recorte.shape == lote.shape[1:] else cv2.resize(recorte, tam, interpolation=cv2.INTER_AREA)
+    return lote
+
+"""Función para medir la nitidez de cada recorte del lote (varianza del laplaciano), sin bucles en Python"""
+def sharpness(lote):
+    import numpy as np
+
+    b = lote.astype(np.float32)
+    lap = 4 * b[:, 1:-1, 1:-1] - b[:, :-2, 1:-1] - b[:, 2:, 1:-1] - b[:, 1:-1, :-2] - b[:, 1:-1, 2:]
+    return lap.reshape(len(lote), -1).var(axis=1)
+
+def _descriptores(lote, celda=5):
+    import numpy as np
+
+    # Miniatura por bloques normalizada (media 0, norma 1): dos recortes de la misma pose quedan
+    # cerca aunque cambie un poco la luz, y uno girado o desplazado queda lejos
+    n, alto, ancho = lote.shape
+    mini = lote[:, :alto - alto % celda, :ancho - ancho % celda].astype(np.float32)
+    mini = mini.reshape(n, alto // celda, celda, ancho // celda, celda).mean(axis=(2, 4)).reshape(n, -1)
+    mini -= mini.mean(axis=1, keepdims=True)
+    mini /= np.linalg.norm(mini, axis=1, keepdims=True) + 1e-6
+    return mini
+
+"""
+Función para elegir los 'n' mejores recortes de un lote: se descartan los más borrosos y, del
+resto, se van escogiendo los que más se diferencian de los ya elegidos (ponderado por nitidez),
+de modo que los frames casi idénticos no ocupan varias plazas. Devuelve los índices elegidos.
+"""
+def select_best_crops(lote, n=MUESTRAS_USUARIO, descarte=DESCARTE_BORROSAS):
+    import numpy as np
+
+    if len(lote) <= n:
+        return np.arange(len(lote))
+
+    nitidez = sharpness(lote)
+    # Solo se descartan borrosos mientras queden más candidatos que plazas
+    n_descarte = min(int(len(lote) * descarte), len(lote) - n)
+    candidatos = np.argsort(nitidez)[n_descarte:]
+    peso = nitidez[candidatos] / (nitidez[candidatos].max() + 1e-6)
+    desc = _descriptores(lote[candidatos])
+
+    elegidos = [int(np.argmax(peso))] # Empezamos por el más nítido
+    distancia = np.linalg.norm(desc - desc[elegidos[0]], axis=1)
+    distancia[elegidos[0]] = -1
+    for _ in range(n - 1):
+        i = int(np.argmax(distancia * peso))
+        elegidos.append(i)
+        distancia = np.minimum(distancia, np.linalg.norm(desc - desc[i], axis=1))
+        distancia[elegidos] = -1
+    return np.sort(candidatos[elegidos])
+
+#-------------------------------------------------------------------------------------------------------------------------------
+
+"""
+Función para cargar el reconocedor listo para usar: modelo base + histogramas de cada usuario con
+update(), en un único modelo. 'usuarios' es una lista de (etiqueta, archivo de recortes); por defecto,
+el usuario único de siempre. Si aún no existe el formato incremental, se usa el trainer.yml completo.
+"""
+def load_recognizer(model_path=MODEL_PATH, base_path=BASE_MODEL_PATH, user_faces_path=USER_FACES_PATH, usuarios=None):
+    import cv2
+    import numpy as np
+
+    recognizer = cv2.face.LBPHFaceRecognizer_create()
+    usuarios = [(label, f) for label, f in usuarios or [(USER_LABEL, user_faces_path)] if os.path.exists(f)]
+    if os.path.exists(base_path) and usuarios:
+        recognizer.read(base_path)
+        for label, faces_path in usuarios:
+            faces = _load_user_faces(faces_path)
+            if faces:
+                recognizer.update(faces, np.full(len(faces), label, dtype=np.int32))
+    elif os.path.exists(model_path):
+        recognizer.read(model_path)
+    return recognizer
+
+"""Función para normalizar, filtrar por calidad y guardar los recortes del usuario. Devuelve el lote guardado"""
+def store_user_faces(faces, n=MUESTRAS_USUARIO, user_faces_path=USER_FACES_PATH):
+    lote = normalize_crops(faces)
+    lote = lote[select_best_crops(lote, n)]
+    save_user_faces(lote, user_faces_path)
+    print(f"\n {len(lote)} de {len(faces)} recortes del usuario conservados.")
+    return lote
+
+"""
+Función para actualizar el Face ID de forma incremental. Con 'faces' (recortes de create_dataset) se
+filtran por calidad y se guardan directamente en 'user_faces_path'; si no, se usan las capturas User.*
+de la carpeta (formato antiguo, solo el primer usuario) o, si no hay, los recortes ya guardados.
+Devuelve el reconocedor con los 'usuarios' indicados (ver load_recognizer).
+"""
+def enroll_user(faces=None, path=FACES_DIR, cache_path=CACHE_PATH, workers=None, user_faces_path=USER_FACES_PATH, usuarios=None):
+    ensure_base_model(path, cache_path=cache_path)
+    if faces is None and user_faces_path == USER_FACES_PATH:
+        faces, _, nuevas = load_training_samples(path, cache_path, workers, incluir=_es_captura_usuario)
+        if faces:
+            print(f"\n {nuevas} capturas nuevas procesadas.")
+    if faces is not None and len(faces):
+        store_user_faces(faces, user_faces_path=user_faces_path)
+    return load_recognizer(user_faces_path=user_faces_path, usuarios=usuarios)
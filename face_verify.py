@@ -0,0 +1,255 @@
+import queue
+import threading
+import time
+
+from timing import percentil
+
+
+UMBRAL_CONFIANZA = 60 # Distancia LBPH máxima para aceptar la cara (más bajo = más parecido)
+USER_LABEL = 1
+ESCALA_DETECCION = 0.5 # La detección se hace sobre el frame reducido; el predict, sobre el original
+PREDICT_CADA = 2 # Con la cara seguida, solo se llama a predict() 1 de cada N frames
+MARGEN_ROI = 0.5 # Ampliación de la última cara (por lado, en proporción a su tamaño) para buscarla
+TAM_COLA = 2 # Frames en cola entre captura y procesado; si se llena se descarta el más antiguo
+TIEMPO_CONFIRMACION = 3 # Segundos desde el primer reconocimiento hasta dar por buena la verificación
+
+
+#-------------------------------------------------------------------------------------------------------------------------------
+
+class FrameGrabber:
+    """
+    Hilo que lee frames de la cámara y los deja en una cola acotada. Si el procesado va más
+    lento que la cámara se descarta el frame más antiguo, así siempre se trabaja con el más reciente.
+    """
+
+    def __init__(self, cam, tam_cola=TAM_COLA):
+        self.cam = cam
+        self.cola = queue.Queue(maxsize=tam_cola)
+        self.capturados = 0
+        self.descartados = 0
+        self.terminado = threading.Event() # La cámara no da más frames
+        self._parar = threading.Event()
+        self._hilo = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self._hilo.start()
+        return self
+
+    def _run(self):
+        while not self._parar.is_set():
+            ret, img = self.cam.read()
+            if not ret:
+                break
+            self.capturados += 1
+            item = (time.perf_counter(), img)
+            try:
+                self.cola.put_nowait(item)
+            except queue.Full:
+                try:
+                    self.cola.get_nowait()
+                    self.descartados += 1
+                except queue.Empty:
+                    pass
+                self.cola.put_nowait(item)
+        self.terminado.set()
+
+    def get(self, timeout=0.5):
+        """Devuelve (instante de captura, frame) o None si no ha llegado ninguno a tiempo."""
+        try:
+            return self.cola.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def stop(self):
+        self._parar.set()
+        self._hilo.join(timeout=2)
+
+#-------------------------------------------------------------------------------------------------------------------------------
+
+class FaceVerifier:
+    """
+    Detección + reconocimiento de un frame. Tras la primera detección solo se busca la cara
+    en una región alrededor de la última posición (y en el frame reducido); si ahí no aparece
+    se vuelve a buscar en el frame completo. Solo se aceptan las etiquetas de 'etiquetas' (los
+    usuarios registrados); el resto son caras de referencia o desconocidas.
+    """
+
+    def __init__(self, cascade, recognizer, escala=ESCALA_DETECCION, predict_cada=PREDICT_CADA,
+                 margen_roi=MARGEN_ROI, umbral=UMBRAL_CONFIANZA, etiquetas=(USER_LABEL,)):
+        self.cascade = cascade
+        self.recognizer = recognizer
+        self.escala = escala
+        self.predict_cada = max(1, predict_cada)
+        self.margen_roi = margen_roi
+        self.umbral = umbral
+        self.etiquetas = frozenset(etiquetas)
+        self._roi = None # Última cara (x, y, w, h) en coordenadas del frame reducido
+        self._prediccion = None # Último (id, confianza)
+        self._desde_predict = 0
+        self.detecciones_roi = 0
+        self.detecciones_completas = 0
+        self.predicts = 0
+
+    def reset(self):
+        self._roi = None
+        self._prediccion = None
+        self._desde_predict = 0
+
+    def _detectar(self, small, min_size):
+        # Primero en la región de la última cara; si no está ahí, en todo el frame
+        if self._roi is not None:
+            x, y, w, h = self._roi
+            mx, my = int(w * self.margen_roi), int(h * self.margen_roi)
+            x0, y0 = max(0, x - mx), max(0, y - my)
+            x1, y1 = min(small.shape[1], x + w + mx), min(small.shape[0], y + h + my)
+            self.detecciones_roi += 1
+            caras = self.cascade.detectMultiScale(small[y0:y1, x0:x1], scaleFactor=1.2, minNeighbors=5, minSize=min_size)
+            if len(caras):
+                return [(cx + x0, cy + y0, cw, ch) for (cx, cy, cw, ch) in caras]
+        self.detecciones_completas += 1
+        return list(self.cascade.detectMultiScale(small, scaleFactor=1.2, minNeighbors=5, minSize=min_size))
+
+    def process(self, gray):
+        """
+        Procesa un frame en gris. Devuelve ((x, y, w, h), id, confianza) en coordenadas del frame
+        original, o None si no hay cara. El id es 0 si la cara no es la de un usuario aceptado.
+        """
+        import cv2
+
+        alto, ancho = gray.shape[:2]
+        if self.escala != 1:
+            small = cv2.resize(gray, (int(ancho * self.escala), int(alto * self.escala)), interpolation=cv2.INTER_AREA)
+        else:
+            small = gray
+        min_size = (int(0.1 * small.shape[1]), int(0.1 * small.shape[0]))
+
+        caras = self._detectar(small, min_size)
+        if not caras:
+            self.reset()
+            return None
+
+        # Si hay varias, seguimos la más grande (la más cercana a la cámara)
+        x, y, w, h = max(caras, key=lambda c: c[2] * c[3])
+        self._roi = (x, y, w, h)
+        box = tuple(int(v / self.escala) for v in (x, y, w, h))
+
+        self._desde_predict += 1
+        if self._prediccion is None or self._desde_predict >= self.predict_cada:
+            bx, by, bw, bh = box
+            self._prediccion = self.recognizer.predict(gray[by:by + bh, bx:bx + bw])
+            self._desde_predict = 0
+            self.predicts += 1
+
+        id, confianza = self._prediccion
+        if confianza >= self.umbral or id not in self.etiquetas:
+            id = 0
+        return box, id, confianza
+
+#-------------------------------------------------------------------------------------------------------------------------------
+
+"""
+Función para verificar la cara de un usuario con la cámara. 'usuarios' es un diccionario etiqueta ->
+nombre con los usuarios que se aceptan (o solo un nombre, para el usuario único de siempre). La
+captura va en un hilo aparte y el procesado trabaja siempre con el frame más reciente. 'cancelado'
+(threading.Event) permite abortar desde otro hilo. Devuelve (etiqueta reconocida o 0, estadísticas).
+"""
+def verify(usuarios, cascade, recognizer, cam, mostrar=True, tiempo_confirmacion=TIEMPO_CONFIRMACION,
+           timeout=None, cancelado=None, **opciones):
+    import cv2
+
+    font = cv2.FONT_HERSHEY_SIMPLEX
+    names = usuarios if isinstance(usuarios, dict) else {USER_LABEL: usuarios}
+    verifier = FaceVerifier(cascade, recognizer, etiquetas=names, **opciones)
+    grabber = FrameGrabber(cam).start()
+
+    recognized_id = 0
+    recognized_time = None
+    latencias, procesado = [], []
+    stats = {'primer_reconocimiento': None, 'desbloqueo': None}
+    inicio = time.perf_counter()
+
+    try:
+        while True:
+            item = grabber.get()
+            if item is None:
+                if grabber.terminado.is_set() and grabber.cola.empty():
+                    print("Error: No se pudo acceder a la cámara.")
+                    break
+                continue
+            capturado, img = item
+
+            t0 = time.perf_counter()
+            gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+            resultado = verifier.process(gray)
+            ahora = time.perf_counter()
+            procesado.append(ahora - t0)
+            latencias.append(ahora - capturado) # Desde que la cámara entrega el frame hasta tener el resultado
+
+            if resultado is not None:
+                (x, y, w, h), id, confidence = resultado
+                if id != 0:
+                    id_name = names[id]
+                    # Si es la primera vez que te reconoce (o ha pasado a ser otro usuario), guarda el tiempo
+                    if recognized_time is None or (recognized_id and id != recognized_id):
+                        recognized_time = time.time()
+                        recognized_id = id
+                        if stats['primer_reconocimiento'] is None:
+                            stats['primer_reconocimiento'] = ahora - inicio
+                else:
+                    id_name = "Unknown"
+                    recognized_id = 0
+                if mostrar:
+                    cv2.rectangle(img, (x, y), (x + w, y + h), (0, 255, 0), 2)
+                    cv2.putText(img, str(id_name), (x + 5, y - 5), font, 1, (255, 255, 255), 2)
+
+            if mostrar:
+                cv2.imshow('camera', img)
+
+            # Si han pasado los segundos de confirmación desde un reconocimiento exitoso, salimos
+            if recognized_time is not None and (time.time() - recognized_time) >= tiempo_confirmacion:
+                if recognized_id:
+                    print(f"\nUsuario {names[recognized_id]} reconocido. Cerrando...")
+                    stats['desbloqueo'] = time.perf_counter() - inicio
+                break
+            if timeout is not None and time.perf_counter() - inicio >= timeout:
+                break
+            if cancelado is not None and cancelado.is_set(): # Cancelado desde la GUI
+                recognized_id = 0
+                break
+
+            if mostrar and (cv2.waitKey(1) & 0xff) == 27: # Salir con la tecla ESC
+                recognized_id = 0 # Si el usuario sale manualmente, no se considera exitoso
+                break
+    finally:
+        grabber.stop()
+        if mostrar:
+            cv2.destroyAllWindows()
+
+    stats.update({
+        'duracion': time.perf_counter() - inicio, # Hasta la decisión (o hasta salir sin ella)
+        'frames_capturados': grabber.capturados,
+        'frames_descartados': grabber.descartados,
+        'frames_procesados': len(procesado),
+        'predicts': verifier.predicts,
+        'detecciones_roi': verifier.detecciones_roi,
+        'detecciones_completas': verifier.detecciones_completas,
+        'procesado_p50_ms': percentil(procesado, 50) * 1000,
+        'procesado_p95_ms': percentil(procesado, 95) * 1000,
+        'latencia_p50_ms': percentil(latencias, 50) * 1000,
+        'latencia_p95_ms': percentil(latencias, 95) * 1000,
+    })
+    return recognized_id, stats
+
+#-------------------------------------------------------------------------------------------------------------------------------
+
+"""Función para mostrar por consola las estadísticas de una verificación"""
+def print_stats(stats):
+    print(f"\n Frames: {stats['frames_capturados']} capturados, {stats['frames_procesados']} procesados, "
+          f"{stats['frames_descartados']} descartados; {stats['predicts']} predicts.")
+    print(f" Detección: {stats['detecciones_roi']} en la región seguida, {stats['detecciones_completas']} en el frame completo.")
+    print(f" Procesado por frame: p50 {stats['procesado_p50_ms']:.1f} ms, p95 {stats['procesado_p95_ms']:.1f} ms.")
+    print(f" Latencia cámara->resultado: p50 {stats['latencia_p50_ms']:.1f} ms, p95 {stats['latencia_p95_ms']:.1f} ms.")
+    if stats['primer_reconocimiento'] is not None:
+        print(f" Primer reconocimiento a los {stats['primer_reconocimiento']:.2f} s.")
+    if stats['desbloqueo'] is not None:
+        print(f" Desbloqueo a los {stats['desbloqueo']:.2f} s.")
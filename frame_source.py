@@ -0,0 +1,132 @@
+import os
+import time
+
+
+INDICE_CAMARA = 0
+ANCHO, ALTO = 640, 480
+EXTENSIONES_IMAGEN = ('.jpg', '.jpeg', '.png', '.bmp')
+
+
+#-------------------------------------------------------------------------------------------------------------------------------
+
+class CameraSource:
+    """Cámara real con cv2.VideoCapture. En Windows se usa DirectShow, como hasta ahora."""
+
+    def __init__(self, indice=INDICE_CAMARA, ancho=ANCHO, alto=ALTO):
+        import cv2
+
+        if os.name == 'nt':
+            self.cam = cv2.VideoCapture(indice, cv2.CAP_DSHOW)
+        else:
+            self.cam = cv2.VideoCapture(indice)
+        self.cam.set(3, ancho)
+        self.cam.set(4, alto)
+
+    def read(self):
+        return self.cam.read()
+
+    def release(self):
+        self.cam.release()
+
+#-------------------------------------------------------------------------------------------------------------------------------
+
+class ReplaySource:
+    """
+    Fuente que reproduce una carpeta de imágenes o un archivo de vídeo como si fuera la cámara.
+    Con 'fps' se entregan los frames a ese ritmo (None = tan rápido como se pidan); con 'lienzo'
+    (ancho, alto) cada imagen se centra sobre un fondo de ese tamaño, como en un frame real.
+    """
+
+    def __init__(self, path, fps=None, loop=False, lienzo=None, max_frames=None):
+        import cv2
+
+        self.path = path
+        self.fps = fps
+        self.loop = loop
+        self.lienzo = lienzo
+        self.max_frames = max_frames
+        self.entregados = 0
+        self._siguiente = None # Instante en que toca entregar el siguiente frame
+        if os.path.isdir(path):
+            self._archivos = sorted(os.path.join(path, f) for f in os.listdir(path) if f.lower().endswith(EXTENSIONES_IMAGEN))
+            if not self._archivos:
+                raise ValueError(f"No hay imágenes en {path}")
+            self._indice = 0
+            self._video = None
+        else:
+            self._archivos = None
+            self._video = cv2.VideoCapture(path)
+            if not self._video.isOpened():
+                raise ValueError(f"No se pudo abrir el vídeo {path}")
+
+    def _leer(self):
+        import cv2
+
+        if self._video is not None:
+            ret, img = self._video.read()
+            if not ret and self.loop:
+                self._video.set(cv2.CAP_PROP_POS_FRAMES, 0)
+                ret, img = self._video.read()
+            return ret, img
+
+        if self._indice >= len(self._archivos):
+            if not self.loop:
+                return False, None
+            self._indice = 0
+        img = cv2.imread(self._archivos[self._indice])
+        self._indice += 1
+        return img is not None, img
+
+    def _encajar(self, img):
+        import cv2
+        import numpy as np
+
+        ancho, alto = self.lienzo
+        # La cara ocupa la mitad del alto del frame, centrada sobre un fondo gris
+        lado = alto // 2
+        escala = lado / max(img.shape[:2])
+        img = cv2.resize(img, (max(1, int(img.shape[1] * escala)), max(1, int(img.shape[0] * escala))))
+        frame = np.full((alto, ancho, 3), 127, np.uint8)
+        y, x = (alto - img.shape[0]) // 2, (ancho - img.shape[1]) // 2
+        frame[y:y + img.shape[0], x:x + img.shape[1]] = img
+        return frame
+
+    def read(self):
+        if self.max_frames is not None and self.entregados >= self.max_frames:
+            return False, None
+        if self.fps:
+            # Esperamos al instante del siguiente frame para simular el ritmo de una cámara
+            ahora = time.perf_counter()
+            if self._siguiente is None:
+                self._siguiente = ahora
+            elif self._siguiente > ahora:
+                time.sleep(self._siguiente - ahora)
+            self._siguiente += 1 / self.fps
+
+        ret, img = self._leer()
+        if not ret:
+            return False, None
+        if img.ndim == 2:
+            import cv2
+            img = cv2.cvtColor(img, cv2.COLOR_GRAY2BGR)
+        if self.lienzo is not None:
+            img = self._encajar(img)
+        self.entregados += 1
+        return True, img
+
+    def release(self):
+        if self._video is not None:
+            self._video.release()
+
+#-------------------------------------------------------------------------------------------------------------------------------
+
+"""
+Función para abrir la fuente de vídeo indicada (benchmarks y pruebas). Un número es un índice de
+cámara; otra cosa, una ruta a reproducir. Sin argumento se usa la cámara 0: la reproducción solo se
+activa pasándola explícitamente, nunca desde el entorno, para que no sirva para desbloquear el gestor.
+"""
+def open_source(spec=INDICE_CAMARA, fps=30, **opciones):
+    spec = str(spec)
+    if spec.isdigit():
+        return CameraSource(int(spec))
+    return ReplaySource(spec, fps=fps, **opciones)
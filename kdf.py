@@ -0,0 +1,198 @@
+import base64
+import hashlib
+import hmac
+import os
+import time
+
+
+OBJETIVO_MS = 250 # Latencia de desbloqueo buscada al calibrar (un intento legítimo ~ 1/4 de segundo)
+KDF_POR_DEFECTO = 'scrypt' # En la biblioteca estándar y con coste de memoria (caro en GPU/ASIC)
+MEMORIA_MAXIMA = 256 * 1024 * 1024 # Tope de memoria por derivación al calibrar
+TAM_SAL = 16
+TAM_HASH = 32
+
+
+#-------------------------------------------------------------------------------------------------------------------------------
+
+def _b64(datos):
+    return base64.b64encode(datos).decode().rstrip('=')
+
+def _unb64(texto):
+    return base64.b64decode(texto + '=' * (-len(texto) % 4))
+
+#-------------------------------------------------------------------------------------------------------------------------------
+
+class Scrypt:
+    """scrypt (RFC 7914). El coste en tiempo y en memoria (128·n·r bytes por intento) crece con n."""
+
+    nombre = 'scrypt'
+    minimos = {'n': 2 ** 14, 'r': 8, 'p': 1}
+
+    def __init__(self, n=2 ** 15, r=8, p=1):
+        self.n, self.r, self.p = n, r, p
+
+    @property
+    def params(self):
+        return {'n': self.n, 'r': self.r, 'p': self.p}
+
+    @property
+    def memoria(self):
+        return 128 * self.n * self.r * self.p
+
+    def derive(self, password, sal):
+        return hashlib.scrypt(password, salt=sal, n=self.n, r=self.r, p=self.p,
+                              maxmem=self.memoria + 1024 * 1024, dklen=TAM_HASH)
+
+    def stronger(self):
+        """Devuelve el siguiente escalón de coste (None si se pasaría del tope de memoria)."""
+        siguiente = Scrypt(self.n * 2, self.r, self.p)
+        return siguiente if siguiente.memoria <= MEMORIA_MAXIMA else None
+
+#-------------------------------------------------------------------------------------------------------------------------------
+
+class Pbkdf2:
+    """PBKDF2-HMAC-SHA256. Sin coste de memoria: solo depende del número de iteraciones."""
+
+    nombre = 'pbkdf2'
+    minimos = {'i': 600000} # Recomendación actual de OWASP para SHA-256
+
+    def __init__(self, i=600000):
+        self.i = i
+
+    @property
+    def params(self):
+        return {'i': self.i}
+
+    @property
+    def memoria(self):
+        return 0
+
+    def derive(self, password, sal):
+        return hashlib.pbkdf2_hmac('sha256', password, sal, self.i, dklen=TAM_HASH)
+
+    def stronger(self):
+        return Pbkdf2(self.i * 2)
+
+#-------------------------------------------------------------------------------------------------------------------------------
+
+class Argon2:
+    """Argon2id con argon2-cffi (opcional). Memoria fija en KiB; el tiempo se ajusta con t."""
+
+    nombre = 'argon2id'
+    minimos = {'t': 2, 'm': 19 * 1024, 'p': 1} # Mínimo recomendado por OWASP
+
+    def __init__(self, t=3, m=64 * 1024, p=1):
+        self.t, self.m, self.p = t, m, p
+
+    @property
+    def params(self):
+        return {'t': self.t, 'm': self.m, 'p': self.p}
+
+    @property
+    def memoria(self):
+        return self.m * 1024
+
+    def derive(self, password, sal):
+        from argon2.low_level import hash_secret_raw, Type # Dependencia opcional
+
+        return hash_secret_raw(password, sal, time_cost=self.t, memory_cost=self.m, parallelism=self.p,
+                               hash_len=TAM_HASH, type=Type.ID)
+
+    def stronger(self):
+        return Argon2(self.t + 1, self.m, self.p)
+
+KDFS = {c.nombre: c for c in (Scrypt, Pbkdf2, Argon2)}
+
+"""Función que indica qué KDF se pueden usar en esta instalación (argon2id solo con argon2-cffi)"""
+def available():
+    disponibles = ['scrypt', 'pbkdf2']
+    try:
+        import argon2.low_level # noqa: F401
+        disponibles.append('argon2id')
+    except ImportError:
+        pass
+    return disponibles
+
+#-------------------------------------------------------------------------------------------------------------------------------
+
+"""Función para medir cuánto tarda una derivación (el mejor de 'repeticiones' intentos)"""
+def measure(kdf, repeticiones=1):
+    sal = os.urandom(TAM_SAL)
+    mejor = None
+    for _ in range(repeticiones):
+        t0 = time.perf_counter()
+        kdf.derive(b'calibracion', sal)
+        dt = time.perf_counter() - t0
+        mejor = dt if mejor is None else min(mejor, dt)
+    return mejor
+
+"""
+Función que elige los parámetros de coste para que una derivación tarde unos 'objetivo_ms' en
+esta máquina. Se parte de los mínimos recomendados y se sube de escalón hasta alcanzar el objetivo.
+"""
+def calibrate(nombre=KDF_POR_DEFECTO, objetivo_ms=OBJETIVO_MS):
+    clase = KDFS[nombre]
+    kdf = clase(**clase.minimos)
+    objetivo = objetivo_ms / 1000
+    dt = measure(kdf)
+    if nombre == 'pbkdf2':
+        # El coste es lineal en las iteraciones: basta con una medida para extrapolar
+        if dt < objetivo:
+            kdf = Pbkdf2(int(kdf.i * objetivo / dt))
+        return kdf
+    while dt < objetivo:
+        siguiente = kdf.stronger()
+        if siguiente is None:
+            break
+        # Si el siguiente escalón se pasaría mucho más del objetivo de lo que nos quedamos cortos, paramos aquí
+        estimado = dt * 2 if nombre == 'scrypt' else dt * siguiente.t / kdf.t
+        if estimado - objetivo > objetivo - dt:
+            break
+        kdf, dt = siguiente, measure(siguiente)
+    return kdf
+
+#-------------------------------------------------------------------------------------------------------------------------------
+
+"""Función que convierte una KDF con su sal y su resumen en la línea que se guarda en master.key"""
+def encode(kdf, sal, resumen):
+    params = ','.join(f'{k}={v}' for k, v in kdf.params.items())
+    return f'${kdf.nombre}${params}${_b64(sal)}${_b64(resumen)}'
+
+"""
+Función que interpreta una línea de master.key. Devuelve (kdf, sal, resumen); el formato antiguo
+(SHA-256 en hexadecimal, sin sal) se devuelve como (None, b'', resumen).
+"""
+def decode(almacenado):
+    almacenado = almacenado.strip()
+    if not almacenado.startswith('$'):
+        return None, b'', bytes.fromhex(almacenado)
+    _, nombre, params, sal, resumen = almacenado.split('$')
+    if nombre not in KDFS:
+        raise ValueError(f"KDF desconocida en la clave maestra: {nombre}")
+    params = {k: int(v) for k, v in (p.split('=') for p in params.split(','))}
+    return KDFS[nombre](**params), _unb64(sal), _unb64(resumen)
+
+#-------------------------------------------------------------------------------------------------------------------------------
+
+"""Función para derivar el resumen de una contraseña. Sin 'kdf' se calibra la KDF por defecto"""
+def hash_password(password, kdf=None):
+    if kdf is None:
+        kdf = calibrate()
+    sal = os.urandom(TAM_SAL)
+    return encode(kdf, sal, kdf.derive(password.encode(), sal))
+
+"""Función para comprobar una contraseña contra la línea guardada (en tiempo constante)"""
+def verify_password(password, almacenado):
+    kdf, sal, esperado = decode(almacenado)
+    if kdf is None:
+        calculado = hashlib.sha256(password.encode()).digest()
+    else:
+        calculado = kdf.derive(password.encode(), sal)
+    return hmac.compare_digest(calculado, esperado)
+
+"""Función que indica si un resumen guardado debería regenerarse (formato antiguo o coste por debajo del mínimo)"""
+def needs_rehash(almacenado):
+    kdf, _, _ = decode(almacenado)
+    if kdf is None:
+        return True
+    return any(kdf.params[k] < v for k, v in kdf.minimos.items())
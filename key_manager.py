@@ -0,0 +1,90 @@
+import os
+import threading
+
+from cryptography.fernet import Fernet, MultiFernet
+
+
+#-------------------------------------------------------------------------------------------------------------------------------
+
+class KeyManager:
+    """
+    Clave de la sesión. El archivo de clave del USB se lee una sola vez y se guarda un único
+    objeto Fernet (o MultiFernet si hay claves anteriores registradas, p.ej. durante una rotación).
+    En cada uso solo se hace un stat del archivo: si ha desaparecido (USB retirado) se lanza
+    FileNotFoundError y ya no se puede descifrar con ella; si ha cambiado (mtime/tamaño) se vuelve
+    a leer. La clave en memoria solo se sigue usando para cifrar al bloquear (permitir_ausente),
+    de forma que retirar el USB nunca deja el archivo de contraseñas descifrado en disco.
+    """
+
+    def __init__(self):
+        self.path = None
+        self._clave = None # bytearray, para poder sobrescribirla al olvidarla
+        self._fernet = None
+        self._firma = None # (mtime_ns, tamaño, inodo) del archivo cuando se leyó
+        self._anteriores = [] # Claves antiguas que aún se aceptan para descifrar
+        self._lock = threading.Lock()
+        self.generation = 0 # Cambia cada vez que se carga una clave distinta o se olvida
+
+    def _firma_archivo(self, path):
+        st = os.stat(path)
+        return (st.st_mtime_ns, st.st_size, st.st_ino)
+
+    def _cargar(self, path):
+        firma = self._firma_archivo(path)
+        with open(path, 'rb') as f:
+            clave = bytearray(f.read().strip())
+        fernet = Fernet(bytes(clave)) # Valida el formato antes de sustituir la clave actual
+        self._borrar(anteriores=False)
+        self.path, self._clave, self._firma = path, clave, firma
+        self._fernet = MultiFernet([fernet] + self._anteriores) if self._anteriores else fernet
+        self.generation += 1
+
+    def _comprobar(self, path, permitir_ausente=False):
+        """Carga la clave si no está en memoria, es de otro archivo o el archivo ha cambiado."""
+        path = os.path.abspath(path)
+        try:
+            firma = self._firma_archivo(path)
+        except FileNotFoundError:
+            if permitir_ausente and path == self.path and self._fernet is not None:
+                return # USB retirado: solo para cifrar con la clave de la sesión antes de olvidarla
+            raise
+        if path != self.path or firma != self._firma or self._fernet is None:
+            self._cargar(path)
+
+    def key(self, path, permitir_ausente=False):
+        """Devuelve la clave (bytes) del archivo indicado, leyéndolo solo si hace falta."""
+        with self._lock:
+            self._comprobar(path, permitir_ausente)
+            return bytes(self._clave)
+
+    def fernet(self, path, permitir_ausente=False):
+        """Devuelve el Fernet/MultiFernet de la sesión para el archivo de clave indicado."""
+        with self._lock:
+            self._comprobar(path, permitir_ausente)
+            return self._fernet
+
+    def add_previous(self, clave):
+        """Registra una clave antigua que se seguirá aceptando para descifrar (MultiFernet)."""
+        with self._lock:
+            self._anteriores.append(Fernet(clave))
+            self._fernet = None # Se reconstruye en el siguiente uso
+
+    def _borrar(self, anteriores=True):
+        if self._clave is not None:
+            # Sobrescribimos nuestra copia; los objetos Fernet tienen la suya, solo podemos soltarlos
+            for i in range(len(self._clave)):
+                self._clave[i] = 0
+        if self._fernet is not None or self._clave is not None:
+            self.generation += 1
+        self.path = self._clave = self._fernet = self._firma = None
+        if anteriores:
+            self._anteriores = []
+
+    def wipe(self):
+        """Olvida la clave de la sesión (al bloquear o cerrar)."""
+        with self._lock:
+            self._borrar()
+
+    @property
+    def loaded(self):
+        return self._fernet is not None
@@ -1,15 +1,124 @@
 import customtkinter as ctk
-from tkinter import messagebox
+from tkinter import messagebox, filedialog
 import utils  
 import os
+import threading
+import time
 import pyperclip
-import pandas as pd
-import cv2
+import timing
+from concurrent.futures import ThreadPoolExecutor
+from tasks import TaskRunner
+from storage import VaultLockedError
+from vault import Vault, DecryptCache
 
 # Configuramos la apariencia inicial
 ctk.set_appearance_mode("System") 
 ctk.set_default_color_theme("blue")  
 
+ROW_HEIGHT = 45 # Alto en píxeles de cada fila de la lista de contraseñas
+ROW_OVERSCAN = 2 # Filas extra que se mantienen creadas por debajo de la zona visible
+MAX_SEARCH_RESULTS = 200 # Resultados que se muestran como máximo al filtrar (los que empiezan por el texto, primero)
+
+class PasswordRow(ctk.CTkFrame):
+    """
+    Fila reutilizable de la lista de contraseñas. No pertenece a ningún SITE
+    fijo: al hacer scroll se vuelve a enlazar con otra entrada.
+    """
+
+    def __init__(self, master, app, slot):
+        super().__init__(master, height=ROW_HEIGHT - 5)
+        self.app = app
+        self.slot = slot # Posición fija de la fila dentro de la zona visible
+        self.site = None
+        self.password_token = None
+
+        self.grid_columnconfigure((0, 1), weight=3)
+        self.grid_columnconfigure(2, weight=2)
+        self.grid_columnconfigure((3, 4, 5), weight=0) # Botones
+
+        # Labels para Site, User y Password (que se podrá cambiar)
+        self.site_label = ctk.CTkLabel(self, text="", anchor="w")
+        self.site_label.grid(row=0, column=0, sticky="ew", padx=5)
+        self.user_label = ctk.CTkLabel(self, text="", anchor="w")
+        self.user_label.grid(row=0, column=1, sticky="ew", padx=5)
+        self.password_label = ctk.CTkLabel(self, text="********", anchor="w")
+        self.password_label.grid(row=0, column=2, sticky="ew", padx=5)
+
+        # --- Botones de acción en la fila ---
+        ctk.CTkButton(self, text="👁️", width=30, command=self.toggle_visibility).grid(row=0, column=3, padx=2)
+        ctk.CTkButton(self, text="📋", width=30, command=lambda: self.app.copy_password(self.password_token)).grid(row=0, column=4, padx=2)
+        ctk.CTkButton(self, text="🗑️", width=30, fg_color="#DB3E3E", hover_color="#B83232", command=lambda: self.app.delete_entry(self.site)).grid(row=0, column=5, padx=(2,5))
+
+    def bind_entry(self, site, user_cifrado, password_cifrada):
+        """Muestra una entrada en esta fila. Solo se descifra el USER, que es lo que se ve."""
+        self.site = site
+        self.password_token = password_cifrada
+        user = self.app._decrypt(user_cifrado)
+        self.site_label.configure(text=site)
+        self.user_label.configure(text=user if user is not None else "Data Error")
+        self.password_label.configure(text="********")
+        self.place(x=0, y=self.slot * ROW_HEIGHT, relwidth=1)
+
+    def unbind_entry(self):
+        """Deja la fila vacía y la oculta (no hay entrada para esta posición)."""
+        self.site = None
+        self.password_token = None
+        self.place_forget()
+
+    def toggle_visibility(self):
+        """Muestra u oculta la contraseña, descifrándola solo al mostrarla."""
+        if self.password_label.cget("text") == "********":
+            pwd = self.app._decrypt(self.password_token)
+            self.password_label.configure(text=pwd if pwd is not None else "N/A")
+        else:
+            self.password_label.configure(text="********")
+
+class StatusBar(ctk.CTkFrame):
+    """Barra inferior con la tarea en segundo plano en curso, su progreso y un botón para cancelarla."""
+
+    def __init__(self, master):
+        super().__init__(master, corner_radius=0, height=32)
+        self.task = None
+        self.label = ctk.CTkLabel(self, text="", anchor="w")
+        self.label.pack(side="left", padx=10, fill="x", expand=True)
+        self.cancel_button = ctk.CTkButton(self, text="Cancel", width=70, command=self.cancel)
+        self.progress = ctk.CTkProgressBar(self, width=160)
+        self.progress.pack(side="right", padx=10)
+
+    def show_task(self, task):
+        """Muestra la tarea activa (o se oculta si no hay ninguna)."""
+        self.task = task
+        if task is None:
+            self.progress.stop()
+            self.place_forget()
+            return
+        self.label.configure(text=task.descripcion)
+        self.progress.configure(mode="indeterminate")
+        self.progress.start()
+        if task.cancelable:
+            self.cancel_button.pack(side="right", padx=(0, 10))
+        else:
+            self.cancel_button.pack_forget()
+        self.place(relx=0, rely=1, relwidth=1, anchor="sw")
+        self.lift()
+
+    def set_progress(self, hecho, total=None):
+        """Progreso de la tarea activa: barra determinada si se conoce el total."""
+        if self.task is None:
+            return
+        if total:
+            self.progress.stop()
+            self.progress.configure(mode="determinate")
+            self.progress.set(hecho / total)
+            self.label.configure(text=f"{self.task.descripcion} ({hecho}/{total})")
+        else:
+            self.label.configure(text=f"{self.task.descripcion} {hecho}")
+
+    def cancel(self):
+        if self.task is not None:
+            self.label.configure(text="Cancelling...")
+            self.task.cancel()
+
 class PasswordManagerApp(ctk.CTk):
     def __init__(self):
         super().__init__()
@@ -23,39 +132,109 @@ class PasswordManagerApp(ctk.CTk):
         self.usb_path = None # Ruta del USB detectado
         self.key_path = None # Ruta del archivo de clave
         self.passwords_decrypted = False # Indica si las contraseñas han sido descifradas
-        self.username = None # Nombre de usuario para reconocimiento facial
+        self.passwords_opened = False # Esta sesión ha abierto el archivo de contraseñas (hay que cifrarlo al bloquear)
+        self.unlocked = False # Interfaz principal visible (hay que bloquear si se retira el USB)
+        self._usb_retirado = threading.Event() # Lo activa el hilo del vigilante de USB; se revisa con after()
+        self.current_user = None # Usuario del registro facial con la sesión abierta (su etiqueta, sus caras y su vault)
+        self.passwords_file = 'passwordsList.csv' # Archivo de contraseñas del usuario actual
+        self._reserved_files = [] # Archivos de contraseñas que esta instancia tiene bloqueados para escribir
+        self.decrypt_cache = None # Caché de campos descifrados bajo demanda (se vacía al bloquear)
+        self.snapshot = None # Vault binario (mmap) de solo lectura mientras el CSV sigue cifrado
 
-        # --- Cargar modelos de IA al inicio ---
-        self._load_models()
+        # --- Cargar modelos de IA en segundo plano mientras se muestra el login ---
+        self.face_cascade = None
+        self.recognizer = None
+        self._models_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="models")
+        self._models_future = self._models_executor.submit(self._load_models)
+
+        # --- Tareas en segundo plano (cifrado, archivos, cámara) con su barra de estado ---
+        self.tasks = TaskRunner(self)
+        self.status_bar = StatusBar(self)
+        self.tasks.on_change = self.status_bar.show_task
+        self._session = 0 # Se incrementa al bloquear: los resultados de tareas de una sesión anterior se descartan
+        self._search_task = None # Construcción del índice de búsqueda en curso
+        self._closing = False # Se está cifrando el archivo para cerrar la aplicación
 
         # --- INICIO DE LA APLICACIÓN ---
         self.check_initial_setup()
 
     def _load_models(self):
-        """Carga los modelos de IA una sola vez y los almacena en la instancia."""
-        
-        self.face_cascade = cv2.CascadeClassifier("haarcascade_frontalface_default.xml")
-        self.recognizer = cv2.face.LBPHFaceRecognizer_create()
-        if os.path.exists('trainer/trainer.yml'):
-            self.recognizer.read('trainer/trainer.yml')
+        """Carga los modelos de IA (se ejecuta en un hilo aparte) y los devuelve."""
+        with timing.span('models.load'):
+            import cv2 # Importación diferida para no pagar OpenCV al importar el módulo
+
+            face_cascade = cv2.CascadeClassifier("haarcascade_frontalface_default.xml")
+            # Un único modelo con todos los usuarios: sirve para verificar a cualquiera de ellos
+            recognizer = utils.load_face_recognizer()
         print("Modelos cargados con exito.")
+        return face_cascade, recognizer
+
+    def _models(self):
+        """
+        Devuelve (face_cascade, recognizer), esperando a la carga en segundo plano solo la primera vez.
+        Se llama solo desde tareas del TaskRunner: el hilo de Tk nunca se queda esperando a los modelos.
+        """
+        if self.face_cascade is None:
+            self.face_cascade, self.recognizer = self._models_future.result()
+            self._models_executor.shutdown(wait=False)
+        return self.face_cascade, self.recognizer
+
+    def _run(self, descripcion, func, *args, on_done=None, on_error=None, **kwargs):
+        """
+        Lanza 'func' en segundo plano. Los callbacks se ejecutan en el hilo de Tk y solo si
+        la sesión sigue siendo la misma (si se ha bloqueado entretanto, se descartan).
+        """
+        sesion = self._session
+
+        def hecho(resultado):
+            if sesion == self._session and on_done is not None:
+                on_done(resultado)
+
+        def error(e):
+            if sesion != self._session:
+                return
+            if on_error is not None:
+                on_error(e)
+            else:
+                messagebox.showerror("Error", f"{descripcion} failed.\nError: {e}", parent=self)
+
+        kwargs.setdefault('on_progress', self.status_bar.set_progress)
+        return self.tasks.submit(descripcion, func, *args, on_done=hecho, on_error=error, **kwargs)
 
     def check_initial_setup(self):
         """
         Verifica si los archivos de clave existen. Si no, guía al usuario
         para crearlos. Si existen, muestra la pantalla de login.
         """
-        # 1. Detectar USB
+        # 0. Solo una instancia puede escribir los archivos de contraseñas (uno por usuario) a la vez
+        vaults = [u['vault'] for u in utils.user_registry().users()] or ['passwordsList.csv']
+        for vault_file in vaults:
+            if not self._reserve_file(vault_file):
+                messagebox.showerror("Critical Error", "Another instance of the password manager is already running.")
+                self.quit()
+                return
+
+        # 1. Detectar USB (la enumeración ya está en caché si se hizo al arrancar)
         usb_drives = utils.detectar_usb()
         if not usb_drives:
             messagebox.showerror("Critical Error", "Any USB drive detected.\nPlease insert a USB drive with 'clave.key' file.")
             self.quit()
             return
         
-        # Usamos la primera unidad USB encontrada
-        self.usb_path = usb_drives[0]
-        self.key_path = os.path.join(self.usb_path, 'clave.key')
+        # Usamos la unidad que ya tiene 'clave.key' (se busca en todas a la vez) o, si ninguna la tiene, la primera
+        self.key_path = utils.buscar_clave_usb() or os.path.join(usb_drives[0], 'clave.key')
+        self.usb_path = os.path.dirname(self.key_path)
         utils.RUTA_CLAVE = self.key_path # Actualizamos la ruta en utils
+        self._watch_usb()
+
+        # Si una rotación de la clave se cortó al sustituir los archivos, se termina antes de usar la clave
+        try:
+            for vault_file in vaults:
+                utils.recuperar_rotacion(vault_file, self.key_path)
+        except (OSError, ValueError) as e:
+            messagebox.showerror("Critical Error", f"An interrupted key rotation could not be completed.\nError: {e}")
+            self.quit()
+            return
         passwords_file = 'passwordsList.csv'
 
         # 2. Si no existe clave.key en el USB
@@ -74,9 +253,10 @@ class PasswordManagerApp(ctk.CTk):
                 )
                 if resp:
                     utils.create_key(self.key_path)
-                    # Vaciar el CSV
-                    with open(passwords_file, 'w') as f:
-                        f.write('SITE,USER,PASSWORD\n')
+                    # Vaciar los archivos de contraseñas (y sus journal/snapshot, cifrados con la clave anterior)
+                    for filename in {passwords_file, *(u['vault'] for u in utils.user_registry().users())}:
+                        if os.path.exists(filename):
+                            utils.reset_passwords_file(filename, self.key_path)
                     messagebox.showinfo("Reset Complete", "New key generated and passwords list cleared.", parent=self)
                 else:
                     messagebox.showerror("Operation Cancelled", "No key created. Application will close.", parent=self)
@@ -93,22 +273,69 @@ class PasswordManagerApp(ctk.CTk):
             if not new_pass: self.quit(); return
             utils.create_master_key(new_pass)
             
-            # Pedir nombre de usuario
-            self.username = ctk.CTkInputDialog(text="Now, please enter your name for facial recognition:", title="Enter Name").get_input()
-            if not self.username: self.quit(); return
-            utils.save_username(self.username)
+            # Pedir nombre de usuario (primer usuario del registro facial)
+            username = ctk.CTkInputDialog(text="Now, please enter your name for facial recognition:", title="Enter Name").get_input()
+            if not username or not username.strip(): self.quit(); return
+            self.current_user = utils.user_registry().by_name(username.strip()) or utils.add_face_user(username)
 
-            # Iniciar captura y entrenamiento facial
+            # Iniciar captura y entrenamiento facial (en segundo plano, con progreso y cancelable como al actualizar Face ID)
             messagebox.showinfo("Face Capture", "Next, we will capture 30 images of your face.\nPlease look at the camera and hold still.", parent=self)
-            #self.withdraw() # Ocultamos la ventana principal durante la captura
-            utils.create_dataset(self.face_cascade)
-            utils.train_face_recognizer()
-            #self.deiconify() # Volvemos a mostrarla
-            messagebox.showinfo("Setup Complete", "Your facial profile has been created successfully!", parent=self)
-            self.recognizer.read('trainer/trainer.yml')
+            self._run("Capturing face...", self._setup_face_task, self.current_user, cancelable=True, pasar_tarea=True,
+                      on_done=self._on_face_setup,
+                      on_error=lambda e: (messagebox.showerror("Error", f"The facial profile could not be created.\nError: {e}", parent=self),
+                                          self.show_login_screen()),
+                      on_cancel=lambda: (messagebox.showinfo("Face Capture", "Face capture cancelled. You can log in with your Master Key "
+                                                             "and use 'Update Face ID' later.", parent=self),
+                                         self.show_login_screen()))
+            return
 
         self.show_login_screen()
 
+    def _setup_face_task(self, usuario, task):
+        """Se ejecuta en un worker: primera captura de la cara del usuario y su alta en el modelo."""
+        face_cascade, _ = self._models()
+        stats = utils.create_dataset(face_cascade, user_faces_path=usuario['faces'], cancelado=task.cancelado, progreso=task.report)
+        if task.cancelled or not stats['muestras']:
+            return None
+        return utils.update_face_recognizer(usuario['label'])
+
+    def _on_face_setup(self, recognizer):
+        if recognizer is None:
+            messagebox.showwarning("Face Capture", "No face was captured. You can log in with your Master Key "
+                                   "and use 'Update Face ID' later.", parent=self)
+        else:
+            self.recognizer = recognizer
+            messagebox.showinfo("Setup Complete", "Your facial profile has been created successfully!", parent=self)
+        self.show_login_screen()
+
+    def _reserve_file(self, filename):
+        """Bloquea un archivo de contraseñas para esta instancia. Devuelve False si otra ya lo tiene."""
+        if filename in self._reserved_files:
+            return True
+        try:
+            utils.reservar_archivo(filename)
+        except VaultLockedError:
+            return False
+        self._reserved_files.append(filename)
+        return True
+
+    def _watch_usb(self):
+        """Vigila la unidad de la clave: si se retira con el gestor desbloqueado, se bloquea."""
+        watcher = utils.usb_watcher()
+        watcher.watch_key(self.key_path)
+        watcher.on_key_removed = lambda _: self._usb_retirado.set()
+        watcher.start()
+        self.after(500, self._check_usb)
+
+    def _check_usb(self):
+        """Revisa en el hilo de Tk el aviso del vigilante (Tk no admite llamadas desde otros hilos)."""
+        if self._usb_retirado.is_set():
+            self._usb_retirado.clear()
+            if self.unlocked:
+                self.lock_app()
+                messagebox.showwarning("USB Removed", "The USB drive with 'clave.key' was removed.\nThe password manager has been locked.", parent=self)
+        self.after(500, self._check_usb)
+
     def show_login_screen(self):
         """Muestra la pantalla de inicio de sesión facial como método principal."""
         #self.deiconify()
@@ -119,28 +346,53 @@ class PasswordManagerApp(ctk.CTk):
         label = ctk.CTkLabel(self.face_login_frame, text="Facial Recognition Login", font=ctk.CTkFont(size=20, weight="bold"))
         label.pack(pady=40)
 
+        # Con varios usuarios se elige quién entra: solo se acepta su cara (y su vault es el que se abre)
+        nombres = [u['name'] for u in utils.user_registry().users()]
+        self.login_user_var = ctk.StringVar(value=self.current_user['name'] if self.current_user else (nombres[0] if nombres else ""))
+        if len(nombres) > 1:
+            ctk.CTkOptionMenu(self.face_login_frame, values=nombres, variable=self.login_user_var).pack(pady=(0, 10))
+
         scan_button = ctk.CTkButton(self.face_login_frame, text="Scan Face to Unlock", command=self.handle_face_login, height=40)
         scan_button.pack(pady=20, padx=20, fill="x")
 
         password_button = ctk.CTkButton(self.face_login_frame, text="Login with Master Key instead", fg_color="transparent", command=self.show_password_login_screen)
         password_button.pack(pady=10)
     
+    def _login_user(self):
+        """Usuario elegido en la pantalla de login (o el único registrado), o None si no hay ninguno."""
+        return utils.user_registry().by_name(self.login_user_var.get())
+
     def handle_face_login(self):
         """Gestiona el proceso de verificación facial."""
-        username = utils.load_username()
-        if not username:
+        usuario = self._login_user()
+        if usuario is None:
             messagebox.showerror("Error", "Username not found. Please log in with Master Key to set up Face ID.", parent=self)
             self.show_password_login_screen()
             return
         
+        if self.tasks.busy: return # Ya hay un escaneo (u otra tarea) en marcha
         messagebox.showinfo("Face Scan", "The camera will now open.\nPlease look directly at it.", parent=self)
-        
-        self.withdraw() # Ocultar GUI durante el escaneo
-        user_id = utils.verify_face(username, self.face_cascade, self.recognizer)
-        self.deiconify() # Mostrar GUI de nuevo
-        
-        if user_id == 1:
+
+        # La cámara y el reconocimiento van en segundo plano: la ventana sigue respondiendo y se puede cancelar
+        self._run("Scanning face...", self._verify_face_task, usuario, cancelable=True, pasar_tarea=True,
+                  on_done=lambda etiqueta: self._on_face_verified(etiqueta, usuario),
+                  on_error=lambda e: messagebox.showerror("Error", f"The face recognition models could not be loaded.\nError: {e}", parent=self))
+
+    def _verify_face_task(self, usuario, task):
+        """
+        Se ejecuta en un worker: espera a los modelos (solo la primera vez) y verifica la cara contra el
+        modelo con todos los usuarios. Solo cuenta si la etiqueta predicha es la del usuario elegido: la
+        cara de otro usuario registrado se predice con su propia etiqueta y no desbloquea este vault.
+        """
+        with timing.span('unlock.face', label=usuario['label']):
+            face_cascade, _ = self._models()
+            recognizer = utils.load_face_recognizer()
+            return utils.verify_face({usuario['label']: usuario['name']}, face_cascade, recognizer, cancelado=task.cancelado)
+
+    def _on_face_verified(self, etiqueta, usuario):
+        if etiqueta == usuario['label']:
             messagebox.showinfo("Success", "Face recognized successfully!", parent=self)
+            self._set_user(usuario)
             self.unlock_app()
         else:
             messagebox.showwarning("Failed", "Face not recognized. Please try again or use your Master Key.", parent=self)
@@ -157,6 +409,10 @@ class PasswordManagerApp(ctk.CTk):
         label = ctk.CTkLabel(self.password_login_frame, text="Enter your Master Key", font=ctk.CTkFont(size=20, weight="bold"))
         label.pack(pady=40)
 
+        nombres = [u['name'] for u in utils.user_registry().users()]
+        if len(nombres) > 1:
+            ctk.CTkOptionMenu(self.password_login_frame, values=nombres, variable=self.login_user_var).pack(pady=(0, 10))
+
         self.master_password_entry = ctk.CTkEntry(self.password_login_frame, show="*", width=300)
         self.master_password_entry.pack(pady=10)
         self.master_password_entry.bind("<Return>", self.handle_password_login)
@@ -165,59 +421,147 @@ class PasswordManagerApp(ctk.CTk):
         login_button.pack(pady=20) 
     
     def handle_password_login(self, event=None):
-        """Valida la contraseña maestra."""
+        """
+        Valida la contraseña maestra del usuario elegido (la KDF está calibrada para tardar ~1/4 s: se
+        hace en segundo plano). Cada usuario tiene su clave maestra, así que solo abre su propio vault.
+        """
+        if self.tasks.busy: return
         password = self.master_password_entry.get()
-        if utils.validate_master_key(password):
+        usuario = self._login_user()
+        master_path = usuario['master'] if usuario is not None else utils.MASTER_KEY
+        if not os.path.exists(master_path):
+            messagebox.showerror("Error", "This user has no Master Key yet. Please log in with Face ID.", parent=self)
+            return
+        self._run("Checking master key...", utils.validate_master_key, password, master_path,
+                  on_done=lambda valida: self._on_password_checked(valida, usuario))
+
+    def _on_password_checked(self, valida, usuario):
+        if valida:
+            self._set_user(usuario)
             self.unlock_app()
         else:
             messagebox.showerror("Error", "Incorrect Master Key.", parent=self)
             self.master_password_entry.delete(0, 'end')
 
+    def _set_user(self, usuario):
+        """Fija el usuario de la sesión y su archivo de contraseñas (sin registro, el archivo de siempre)."""
+        self.current_user = usuario
+        self.passwords_file = usuario['vault'] if usuario is not None else 'passwordsList.csv'
+
     def unlock_app(self):
         """Acciones a realizar tras un login exitoso (facial o por contraseña)."""
         # Destruir frames de login
         if hasattr(self, 'face_login_frame'): self.face_login_frame.destroy()
         if hasattr(self, 'password_login_frame'): self.password_login_frame.destroy()
 
-        # Descifrar CSV
-        if os.path.exists('passwordsList.csv'):
-            try:
-                utils.descifrar_csv('passwordsList.csv', self.key_path)
-                self.passwords_decrypted = True
-            except Exception as e:
-                messagebox.showerror("Decryption Error", f"The key on the USB is not valid for this file or it is corrupt.\nError: {e}", parent=self)
-                self.quit()
-                return
-        
+        # Abrir el snapshot o descifrar el CSV puede tardar con vaults grandes: se hace en segundo plano
+        self._unlock_started = time.perf_counter()
+        self._run("Unlocking...", self._open_passwords, on_done=self._on_unlocked, on_error=self._on_decryption_error)
+
+    def _open_passwords(self):
+        """
+        Se ejecuta en un worker. Si hay un snapshot binario al día lo usamos para leer y no desciframos
+        el CSV hasta que haya cambios. Devuelve el snapshot o None.
+        """
+        with timing.span('unlock.open') as medida:
+            self.passwords_opened = True
+            snapshot = utils.open_snapshot(self.passwords_file, self.key_path)
+            medida.set(snapshot=snapshot is not None)
+            if snapshot is None:
+                self._decrypt_passwords_file()
+            return snapshot
+
+    def _on_unlocked(self, snapshot):
+        self.snapshot = snapshot
         self.show_main_ui()
+        timing.record('unlock.total', self._unlock_started, snapshot=snapshot is not None)
+
+    def _decrypt_passwords_file(self):
+        """
+        Descifra el CSV en disco (se ejecuta en un worker). Con el cifrado en reposo el archivo se
+        queda cifrado; solo se descifra si aún está en un formato antiguo (se vuelve a cifrar al bloquear).
+        """
+        self.passwords_opened = True
+        if os.path.exists(self.passwords_file):
+            if utils.CIFRADO_EN_REPOSO and utils.is_stream_file(self.passwords_file):
+                return
+            if utils.CIFRADO_EN_REPOSO and utils.is_fernet_file(self.passwords_file):
+                utils.cifrar_csv(self.passwords_file, self.key_path) # Formato anterior: se migra sin pasar por disco en claro
+                return
+            utils.descifrar_csv(self.passwords_file, self.key_path)
+            # Se marca desde el worker: así una tarea de cifrado encolada detrás siempre lo ve
+            self.passwords_decrypted = True
+
+    def _encrypt_passwords_file(self):
+        """
+        Cifra el CSV si está descifrado y olvida la clave de la sesión (en un worker, detrás de
+        las escrituras pendientes). Solo se toca el archivo si esta sesión lo ha abierto: sin
+        desbloquear no hay nada que volcar, y sin la clave de la sesión tampoco se podría cifrar.
+        """
+        try:
+            if self.passwords_decrypted or (utils.CIFRADO_EN_REPOSO and self.passwords_opened and utils.session_key_loaded()
+                                            and os.path.exists(self.passwords_file)):
+                utils.cifrar_csv(self.passwords_file, self.key_path) # En reposo: vuelca el journal y el snapshot
+                self.passwords_decrypted = False
+            self.passwords_opened = False
+        finally:
+            utils.olvidar_clave() # La clave no se queda en memoria con la sesión bloqueada
+
+    def _on_decryption_error(self, e):
+        messagebox.showerror("Decryption Error", f"The key on the USB is not valid for this file or it is corrupt.\nError: {e}", parent=self)
+        self.quit()
+
+    def _when_writable(self, accion):
+        """
+        Antes de modificar nada pasamos del snapshot de solo lectura al CSV descifrado. El descifrado
+        va en segundo plano; 'accion' se ejecuta (en el hilo de Tk) cuando el CSV ya se puede escribir.
+        """
+        if self.snapshot is None:
+            accion()
+            return
+
+        def descifrado(_):
+            # Mientras se descifraba la lista seguía leyendo del snapshot; ahora ya se puede cerrar
+            self.snapshot.close()
+            self.snapshot = None
+            self.load_passwords_ui(on_loaded=accion)
+
+        self._run("Decrypting passwords file...", self._decrypt_passwords_file, on_done=descifrado, on_error=self._on_decryption_error)
 
     def show_main_ui(self):
         """Crea la interfaz principal del gestor de contraseñas."""
+        self.unlocked = True
         # --- LAYOUT PRINCIPAL (IZQUIERDA: ACCIONES, DERECHA: LISTA) ---
         self.grid_columnconfigure(1, weight=1)
         self.grid_rowconfigure(0, weight=1)
 
         # --- FRAME IZQUIERDO PARA BOTONES Y ACCIONES ---
-        left_frame = ctk.CTkFrame(self, width=200, corner_radius=0)
+        self.left_frame = left_frame = ctk.CTkFrame(self, width=200, corner_radius=0)
         left_frame.grid(row=0, column=0, rowspan=2, sticky="nsew")
         
         ctk.CTkLabel(left_frame, text="Actions", font=ctk.CTkFont(size=16, weight="bold")).pack(pady=20)
         
         ctk.CTkButton(left_frame, text="Add Password", command=self.add_password).pack(pady=10, padx=20, fill="x")
+        ctk.CTkButton(left_frame, text="Import Passwords", command=self.import_passwords).pack(pady=(0, 10), padx=20, fill="x")
+        ctk.CTkButton(left_frame, text="Export Passwords", command=self.export_passwords).pack(pady=(0, 10), padx=20, fill="x")
         ctk.CTkButton(left_frame, text="Update Face ID", 
               fg_color="transparent", 
               border_width=2, 
               text_color=("gray10", "#DCE4EE"), 
               command=self.handle_retrain_face).pack(pady=10, padx=20, fill="x")
+        ctk.CTkButton(left_frame, text="Add User", fg_color="transparent", border_width=2, text_color=("gray10", "#DCE4EE"),
+                      command=self.handle_add_user).pack(pady=(0, 10), padx=20, fill="x")
 
 
         ctk.CTkButton(left_frame, text="Change Master Key", fg_color="transparent", border_width=2, text_color=("gray10", "#DCE4EE"), command=self.change_master_key).pack(pady=(20, 10), padx=20, fill="x")
+        ctk.CTkButton(left_frame, text="Rotate USB Key", fg_color="transparent", border_width=2, text_color=("gray10", "#DCE4EE"), command=self.rotate_usb_key).pack(pady=10, padx=20, fill="x")
+        ctk.CTkButton(left_frame, text="Lock", fg_color="transparent", border_width=2, text_color=("gray10", "#DCE4EE"), command=self.lock_app).pack(pady=10, padx=20, fill="x")
 
         # --- FRAME DERECHO PARA LA LISTA DE CONTRASEÑAS ---
-        right_frame = ctk.CTkFrame(self)
+        self.right_frame = right_frame = ctk.CTkFrame(self)
         right_frame.grid(row=0, column=1, padx=20, pady=20, sticky="nsew")
         right_frame.grid_columnconfigure(0, weight=1)
-        right_frame.grid_rowconfigure(1, weight=1)
+        right_frame.grid_rowconfigure(2, weight=1)
 
         ctk.CTkLabel(right_frame, text="My Passwords", font=ctk.CTkFont(size=16, weight="bold")).grid(row=0, column=0, padx=10, pady=10)
         
@@ -233,72 +577,230 @@ class PasswordManagerApp(ctk.CTk):
         ctk.CTkLabel(header_frame, text="Username", font=ctk.CTkFont(weight="bold")).grid(row=0, column=1)
         ctk.CTkLabel(header_frame, text="Password", font=ctk.CTkFont(weight="bold")).grid(row=0, column=2)
 
-        # --- Contenedor de contraseñas con scroll ---
-        self.scrollable_frame = ctk.CTkScrollableFrame(right_frame, label_text="My Passwords")
-        self.scrollable_frame.grid(row=1, column=0, padx=10, pady=10, sticky="nsew")
-        self.scrollable_frame.grid_columnconfigure(0, weight=1)
+        # --- Caja de búsqueda: filtra la lista mientras se escribe ---
+        self.search_entry = ctk.CTkEntry(right_frame, placeholder_text="Search site or username...")
+        self.search_entry.grid(row=1, column=0, padx=10, pady=(10, 0), sticky="ew")
+        self.search_entry.bind("<KeyRelease>", self._on_search)
+
+        # --- Lista virtualizada: solo existen widgets para las filas visibles (+ unas pocas de reserva) ---
+        self.list_frame = ctk.CTkFrame(right_frame)
+        self.list_frame.grid(row=2, column=0, padx=10, pady=10, sticky="nsew")
+        self.list_frame.grid_columnconfigure(0, weight=1)
+        self.list_frame.grid_rowconfigure(0, weight=1)
+
+        self.rows_container = ctk.CTkFrame(self.list_frame, fg_color="transparent")
+        self.rows_container.grid(row=0, column=0, sticky="nsew", padx=5, pady=5)
+        self.rows_container.bind("<Configure>", self._on_list_resize)
+
+        self.list_scrollbar = ctk.CTkScrollbar(self.list_frame, command=self._on_scrollbar)
+        self.list_scrollbar.grid(row=0, column=1, sticky="ns")
+
+        # La rueda del ratón se captura a nivel de aplicación y solo se aplica si el puntero está sobre la lista
+        self.bind_all("<MouseWheel>", self._on_mouse_wheel)
+        self.bind_all("<Button-4>", self._on_mouse_wheel)
+        self.bind_all("<Button-5>", self._on_mouse_wheel)
+
+        self.vault = None # Vault con el índice de SITE -> tokens cifrados
+        self.row_pool = [] # Filas reutilizables, cada una se vuelve a enlazar a un SITE distinto al hacer scroll
+        self.list_sites = [] # Orden de los SITE mostrados en la lista
+        self.list_offset = 0 # Índice del primer SITE visible
+        self.search_index = None # Se construye en segundo plano al cargar la lista (al desbloquear)
 
         self.load_passwords_ui()
 
-    def load_passwords_ui(self):
-        """Carga las contraseñas en la UI, creando una fila para cada una."""
-        # Limpiar vista anterior
-        for widget in self.scrollable_frame.winfo_children():
-            widget.destroy()
+    def _search_query(self):
+        return self.search_entry.get().strip() if hasattr(self, 'search_entry') else ""
 
-        if not os.path.exists('passwordsList.csv'):
+    def _build_search_index(self):
+        """Indexa SITE y usuarios descifrados en segundo plano (una vez por sesión), para que la primera búsqueda no espere."""
+        if self.search_index is not None or self.vault is None or self._search_task is not None:
             return
-        utils.ensure_passwords_file('passwordsList.csv')  # Aseguramos que el archivo existe y tiene encabezados
-        df = pd.read_csv('passwordsList.csv')
-        # Obtenemos los datos descifrados para construir la UI
-        clave_obj = utils.Fernet(utils.cargar_clave(self.key_path))
-
-        for index, row in df.iterrows():
-            site = row['SITE']
-            # Desciframos los datos reales para usarlos en los botones
-            try:
-                user = clave_obj.decrypt(row['USER'].encode()).decode()
-                password = clave_obj.decrypt(row['PASSWORD'].encode()).decode()
-            except Exception:
-                # Si una fila está corrupta, se muestra pero no se podrá interactuar
-                user = "Data Error"
-                password = "N/A"
-
-            # --- Crear una fila para esta contraseña ---
-            row_frame = ctk.CTkFrame(self.scrollable_frame)
-            row_frame.pack(fill="x", pady=5, padx=5)
-            row_frame.grid_columnconfigure((0, 1), weight=3)
-            row_frame.grid_columnconfigure(2, weight=2)
-            row_frame.grid_columnconfigure((3, 4, 5), weight=0) # Botones
-
-            # Labels para Site y User
-            ctk.CTkLabel(row_frame, text=site, anchor="w").grid(row=0, column=0, sticky="ew", padx=5)
-            ctk.CTkLabel(row_frame, text=user, anchor="w").grid(row=0, column=1, sticky="ew", padx=5)
-            
-            # Label para la contraseña (que se podrá cambiar)
-            password_label = ctk.CTkLabel(row_frame, text="********", anchor="w")
-            password_label.grid(row=0, column=2, sticky="ew", padx=5)
-
-            # --- Botones de acción en la fila ---
-            def toggle_visibility(label=password_label, pwd=password):
-                if label.cget("text") == "********":
-                    label.configure(text=pwd)
+        self._search_task = self._run("Indexing passwords for search...", utils.build_search_index,
+                                      self.passwords_file, self.vault, utils.cargar_clave(self.key_path),
+                                      cancelable=True, on_done=self._on_search_index,
+                                      on_error=lambda e: setattr(self, '_search_task', None),
+                                      on_cancel=lambda: setattr(self, '_search_task', None))
+
+    def _on_search(self, event=None):
+        """Filtra la lista con el texto de la caja de búsqueda."""
+        if self._search_query():
+            self._build_search_index() # Por si la indexación al desbloquear se canceló o falló
+        self._apply_search()
+
+    def _on_search_index(self, indice):
+        self._search_task = None
+        self.search_index = indice
+        self._apply_search()
+
+    def _apply_search(self):
+        """Muestra solo los SITE que coinciden con la búsqueda (ya clasificados por el índice), o la lista completa si está vacía."""
+        if self.vault is None:
+            return
+        if not self._search_query() or self.search_index is None:
+            self.list_sites = self.vault.sites() if isinstance(self.vault, Vault) else self.vault.site_view()
+        else:
+            self.list_sites = self.search_index.search(self._search_query(), limite=MAX_SEARCH_RESULTS)
+        self.list_offset = 0
+        self._render_rows()
+
+    def _decrypt(self, token):
+        """Descifra un campo a través de la caché. Devuelve None si el dato está corrupto o no hay clave."""
+        try:
+            fernet = utils.cargar_fernet(self.key_path) # Solo un stat del archivo de clave, no se vuelve a leer
+            if self.decrypt_cache is None or self.decrypt_cache.fernet is not fernet:
+                # La clave ha cambiado en el USB: lo descifrado con la anterior deja de valer
+                self.decrypt_cache = DecryptCache(fernet)
+            return self.decrypt_cache.decrypt(token)
+        except Exception:
+            return None
+
+    def _visible_rows(self):
+        """Número de filas que caben en la zona visible de la lista."""
+        alto = self.rows_container.winfo_height()
+        return max(1, alto // ROW_HEIGHT + 1)
+
+    def _on_list_resize(self, event=None):
+        """Ajusta el tamaño del pool de filas al alto disponible y repinta."""
+        necesarias = self._visible_rows() + ROW_OVERSCAN
+        while len(self.row_pool) < necesarias:
+            self.row_pool.append(PasswordRow(self.rows_container, self, len(self.row_pool)))
+        self._render_rows()
+
+    def _scroll_to(self, offset):
+        """Mueve la ventana visible para que empiece en 'offset' (en filas)."""
+        max_offset = max(0, len(self.list_sites) - self._visible_rows() + 1)
+        offset = min(max(0, int(offset)), max_offset)
+        if offset != self.list_offset:
+            self.list_offset = offset
+            self._render_rows()
+
+    def _on_scrollbar(self, *args):
+        """Traduce los comandos de la barra de scroll ('moveto' / 'scroll') a un desplazamiento en filas."""
+        if args[0] == "moveto":
+            self._scroll_to(round(float(args[1]) * len(self.list_sites)))
+        elif args[0] == "scroll":
+            paso = self._visible_rows() if args[2] == "pages" else 1
+            self._scroll_to(self.list_offset + int(args[1]) * paso)
+
+    def _on_mouse_wheel(self, event):
+        """Desplaza la lista con la rueda del ratón si el puntero está encima de ella."""
+        widget = self.winfo_containing(event.x_root, event.y_root)
+        while widget is not None and widget is not self.list_frame:
+            widget = widget.master
+        if widget is None:
+            return
+        if event.num == 4 or getattr(event, "delta", 0) > 0:
+            self._scroll_to(self.list_offset - 3)
+        else:
+            self._scroll_to(self.list_offset + 3)
+
+    def _render_rows(self):
+        """Enlaza cada fila del pool con el SITE que le toca según el desplazamiento actual."""
+        with timing.span('ui.render_rows') as medida:
+            for i, row in enumerate(self.row_pool):
+                index = self.list_offset + i
+                entrada = self.vault.get(self.list_sites[index]) if index < len(self.list_sites) else None
+                if entrada is None:
+                    row.unbind_entry()
                 else:
-                    label.configure(text="********")
+                    row.bind_entry(self.list_sites[index], *entrada)
+                    medida.count('filas')
 
-            def copy_password(pwd=password):
-                pyperclip.copy(pwd)
-                messagebox.showinfo("Copied", "Password copied to clipboard (15s).", parent=self)
-                self.after(15000, pyperclip.copy, "")
-            
-            def delete_entry(site_to_delete=site):
-                if messagebox.askyesno("Confirm", f"Delete entry for '{site_to_delete}'?", parent=self):
-                    utils.delete_password(site_to_delete)
-                    self.load_passwords_ui() # Recargar la lista
+        total = len(self.list_sites)
+        if total == 0:
+            self.list_scrollbar.set(0, 1)
+        else:
+            self.list_scrollbar.set(self.list_offset / total, min(1, (self.list_offset + self._visible_rows()) / total))
+
+    def _refresh_site(self, site):
+        """Actualiza en sitio la fila de un SITE añadido o modificado, sin recrear la lista."""
+        if self.vault is None:
+            # La lista aún no estaba cargada (no existía el archivo de contraseñas)
+            self.load_passwords_ui()
+            return
+        if self._search_query() and self.search_index is not None:
+            # Con un filtro activo volvemos a consultar el índice (ya actualizado por utils)
+            offset = self.list_offset
+            self._apply_search()
+            self._scroll_to(offset)
+            return
+        if site not in self.vault:
+            # Borrado: lo quitamos del orden y repintamos solo las filas visibles
+            if site in self.list_sites:
+                self.list_sites.remove(site)
+                self.list_offset = min(self.list_offset, max(0, len(self.list_sites) - 1))
+                self._render_rows()
+            return
+
+        if site not in self.list_sites:
+            self.list_sites.append(site)
+            self._render_rows()
+            return
+
+        for row in self.row_pool:
+            if row.site == site:
+                row.bind_entry(site, *self.vault.get(site))
+
+    def load_passwords_ui(self, on_loaded=None):
+        """
+        Carga el orden de las contraseñas y pinta solo las filas visibles. Leer el CSV va en
+        segundo plano; 'on_loaded' se llama cuando la lista ya está cargada.
+        """
+        self.list_sites = []
+        self.list_offset = 0
+        inicio = time.perf_counter()
+
+        def cargada():
+            timing.record('ui.load_passwords', inicio, rows=len(self.list_sites))
+            if on_loaded is not None:
+                on_loaded()
+
+        if not os.path.exists(self.passwords_file):
+            self._render_rows()
+            cargada()
+            return
+
+        if self.snapshot is not None:
+            # Solo lectura: el índice y los nombres se leen del mmap a medida que se muestran
+            self._on_vault_loaded((utils.cargar_fernet(self.key_path), self.snapshot), cargada)
+            return
+        self._run("Loading passwords...", self._open_vault, on_done=lambda r: self._on_vault_loaded(r, cargada))
 
-            ctk.CTkButton(row_frame, text="👁️", width=30, command=toggle_visibility).grid(row=0, column=3, padx=2)
-            ctk.CTkButton(row_frame, text="📋", width=30, command=copy_password).grid(row=0, column=4, padx=2)
-            ctk.CTkButton(row_frame, text="🗑️", width=30, fg_color="#DB3E3E", hover_color="#B83232", command=delete_entry).grid(row=0, column=5, padx=(2,5))
+    def _open_vault(self):
+        """Se ejecuta en un worker: lee la clave y el CSV (índice en memoria, no se vuelve a parsear)."""
+        clave_obj = utils.cargar_fernet(self.key_path)
+        utils.ensure_passwords_file(self.passwords_file, self.key_path)  # Aseguramos que el archivo existe y tiene encabezados
+        return clave_obj, utils.open_vault(self.passwords_file, clave_obj)
+
+    def _on_vault_loaded(self, resultado, on_loaded=None):
+        clave_obj, self.vault = resultado
+        if self.decrypt_cache is None:
+            self.decrypt_cache = DecryptCache(clave_obj)
+        self.list_sites = self.vault.site_view() if self.vault is self.snapshot else self.vault.sites()
+
+        # No desciframos nada aquí: USER se descifra al enlazar una fila visible y PASSWORD al pulsar 👁️ o 📋
+        if self._search_query() and self.search_index is not None:
+            self._apply_search()
+        self._build_search_index()
+        self._on_list_resize()
+        if on_loaded is not None:
+            on_loaded()
+
+    def copy_password(self, token):
+        """Copia al portapapeles la contraseña de una fila (se descifra en este momento)."""
+        pwd = self._decrypt(token)
+        if pwd is None:
+            messagebox.showerror("Error", "This entry is corrupt and cannot be copied.", parent=self)
+            return
+        pyperclip.copy(pwd)
+        messagebox.showinfo("Copied", "Password copied to clipboard (15s).", parent=self)
+        self.after(15000, pyperclip.copy, "")
+
+    def delete_entry(self, site):
+        """Borra una entrada y quita solo su fila de la lista."""
+        if messagebox.askyesno("Confirm", f"Delete entry for '{site}'?", parent=self):
+            self._when_writable(lambda: self._run(f"Deleting '{site}'...", utils.delete_password, site, self.passwords_file,
+                                                  on_done=lambda _: self._refresh_site(site)))
 
     def add_password(self):
         """Abre un diálogo para añadir o actualizar una contraseña."""
@@ -314,46 +816,236 @@ class PasswordManagerApp(ctk.CTk):
         password = dialog.get_input()
         if not password: return
 
-        # Guardamos usando la función de utils
-        clave_obj = utils.Fernet(utils.cargar_clave(self.key_path))
-        utils.save_passwords_to_csv(site, user, password, clave_obj)
-        messagebox.showinfo("Success", f"Password for '{site}' saved successfully.")
-        self.load_passwords_ui() # Recargamos la nueva UI
+        # Guardamos usando la función de utils, en segundo plano
+        def guardado(_):
+            self._refresh_site(site) # Solo se actualiza la fila afectada
+            messagebox.showinfo("Success", f"Password for '{site}' saved successfully.")
+
+        self._when_writable(lambda: self._run(f"Saving '{site}'...", self._save_entry, site, user, password, on_done=guardado))
+
+    def _save_entry(self, site, user, password):
+        """Se ejecuta en un worker: cifra y guarda una entrada."""
+        clave_obj = utils.cargar_fernet(self.key_path)
+        return utils.save_passwords_to_csv(site, user, password, clave_obj, self.passwords_file)
     
+    def import_passwords(self):
+        """Importa un volcado CSV/JSON de Chrome, Firefox o Bitwarden en segundo plano y con una sola escritura."""
+        if self.tasks.busy: return
+        path = filedialog.askopenfilename(parent=self, title="Import Passwords",
+                                          filetypes=[("Password exports", "*.csv *.json"), ("All files", "*.*")])
+        if not path: return
+        overwrite = messagebox.askyesno("Import Passwords", "Overwrite entries whose site already exists?\n(No keeps the current ones.)", parent=self)
+
+        def importado(stats):
+            self.load_passwords_ui()
+            messagebox.showinfo("Import Passwords", f"{stats['importadas']} passwords imported ({stats['formato']}).\n"
+                                f"{stats['duplicadas']} duplicates and {stats['invalidas']} incomplete rows skipped.\n"
+                                f"{stats['filas_s']:,.0f} rows/s", parent=self)
+
+        self._when_writable(lambda: self._run("Importing passwords...", self._import_task, path, overwrite,
+                                              pasar_tarea=True, on_done=importado))
+
+    def _import_task(self, path, overwrite, task):
+        return utils.import_passwords(path, filename=self.passwords_file, clave_path=self.key_path, sobrescribir=overwrite, progreso=task.report)
+
+    def export_passwords(self):
+        """Exporta todas las contraseñas en claro (CSV de Chrome, que también importan Firefox y Bitwarden, o JSON de Bitwarden)."""
+        if self.tasks.busy: return
+        path = filedialog.asksaveasfilename(parent=self, title="Export Passwords", defaultextension=".csv",
+                                            filetypes=[("CSV (Chrome, Firefox, Bitwarden)", "*.csv"), ("Bitwarden JSON", "*.json")])
+        if not path: return
+        if not messagebox.askyesno("Export Passwords", "The exported file will contain your passwords UNENCRYPTED.\nContinue?", parent=self):
+            return
+        formato = 'bitwarden-json' if path.lower().endswith('.json') else 'chrome'
+        self._when_writable(lambda: self._run("Exporting passwords...", utils.export_passwords, path, formato, filename=self.passwords_file, clave_path=self.key_path,
+                                              on_done=lambda stats: messagebox.showinfo("Export Passwords",
+                                                  f"{stats['exportadas']} passwords exported to:\n{path}\n{stats['filas_s']:,.0f} rows/s", parent=self)))
+
     def change_master_key(self):
         """Permite al usuario cambiar su clave maestra."""
         new_pass = ctk.CTkInputDialog(text="Enter your NEW master key", title="Change Master Key").get_input()
         if new_pass:
             confirm_pass = ctk.CTkInputDialog(text="Confirm your NEW master key:", title="Confirm key").get_input()
             if new_pass == confirm_pass:
-                utils.modify_master_key(new_pass)
-                messagebox.showinfo("Success", "Your master key has been changed successfully.")
+                # Derivar la nueva clave (con calibración de la KDF) no debe congelar la ventana
+                master_path = self.current_user['master'] if self.current_user is not None else utils.MASTER_KEY
+                self._run("Changing master key...", utils.modify_master_key, new_pass, master_path,
+                          on_done=lambda _: messagebox.showinfo("Success", "Your master key has been changed successfully."))
             else:
                 messagebox.showerror("Error", "The passwords do not match.")
 
+    def rotate_usb_key(self):
+        """Genera una clave nueva en el USB y vuelve a cifrar todas las contraseñas con ella."""
+        if self.tasks.busy: return
+        if len(utils.user_registry()) > 1:
+            # Todos los archivos de contraseñas comparten la clave del USB: rotarla para uno dejaría ilegibles los demás
+            messagebox.showerror("Rotate USB Key", "The USB key is shared by several users and can only be rotated with a single user registered.", parent=self)
+            return
+        if not messagebox.askyesno("Rotate USB Key", "All passwords will be re-encrypted with a new key on the USB drive.\n"
+                                   "Do not remove the USB drive until it finishes. Continue?", parent=self):
+            return
+        self._when_writable(lambda: self._run("Rotating USB key...", self._rotate_key_task, cancelable=True, pasar_tarea=True,
+                                              on_done=self._on_key_rotated,
+                                              on_cancel=lambda: messagebox.showinfo("Rotate USB Key", "Key rotation paused. Press 'Rotate USB Key' again to resume it.", parent=self)))
+
+    def _rotate_key_task(self, task):
+        """
+        Se ejecuta en un worker. La rotación trabaja sobre el archivo cifrado; mientras tanto la lista
+        sigue leyendo del vault en memoria. Al terminar (o pausarla) se vuelve al CSV descifrado.
+        """
+        if self.passwords_decrypted or (utils.CIFRADO_EN_REPOSO and self.passwords_opened and os.path.exists(self.passwords_file)):
+            utils.cifrar_csv(self.passwords_file, self.key_path) # La rotación no admite journal pendiente
+            self.passwords_decrypted = False
+        try:
+            return utils.rotar_clave(self.passwords_file, self.key_path, cancelado=task.cancelado, progreso=task.report)
+        finally:
+            if os.path.exists(self.passwords_file):
+                self._decrypt_passwords_file() # Con la clave nueva, o con la anterior si se ha pausado
+                utils.reset_journal_key(self.passwords_file, self.key_path)
+
+    def _on_key_rotated(self, stats):
+        self.decrypt_cache = None # Los tokens han cambiado; los que aún muestra la lista se aceptan hasta bloquear
+        self.load_passwords_ui()
+        messagebox.showinfo("Rotate USB Key", f"The USB key has been rotated.\n{stats['filas']} entries re-encrypted.", parent=self)
+
+    def lock_app(self):
+        """Bloquea el gestor: olvida los datos descifrados, cifra el archivo y vuelve al login."""
+        # Lo que quede pendiente de esta sesión ya no debe tocar la interfaz (las escrituras sí se completan)
+        self.tasks.cancel_all()
+        timing.flush() # Contadores de la sesión que no caían dentro de ningún span
+        self._session += 1
+        self.unlocked = False
+        self._search_task = None
+        if self.decrypt_cache is not None:
+            self.decrypt_cache.clear()
+            self.decrypt_cache = None
+        self.row_pool = []
+        self.list_sites = []
+        self.vault = None
+        self.search_index = None
+        utils.drop_search_index(self.passwords_file)
+        if self.snapshot is not None:
+            self.snapshot.close()
+            self.snapshot = None
+
+        # Quitamos la interfaz principal (usa grid) antes de volver al login (usa pack)
+        self.left_frame.destroy()
+        self.right_frame.destroy()
+        self.grid_columnconfigure(1, weight=0)
+        self.grid_rowconfigure(0, weight=0)
+
+        # Se cifra después de las escrituras que estuvieran en cola (un solo worker, en orden)
+        self.tasks.submit("Encrypting passwords file...", self._encrypt_passwords_file,
+                          on_done=lambda _: self.show_login_screen(),
+                          on_error=lambda e: (messagebox.showerror("Error", f"The password file could not be encrypted.\nError: {e}", parent=self),
+                                              self.show_login_screen()))
+
     def on_closing(self):
         """
         Se ejecuta al cerrar la ventana. Cifra el archivo de contraseñas
         y cierra la aplicación.
         """
-        if self.passwords_decrypted:
-            if messagebox.askyesno("Exit", "Are you sure you want to exit?\nThe password file will be encrypted."):
-                utils.cifrar_csv('passwordsList.csv', self.key_path)
-                self.destroy()
-        else:
-            self.destroy()
+        if self._closing: return # Ya se está cifrando para cerrar
+        if self.passwords_decrypted or self.tasks.busy:
+            if not messagebox.askyesno("Exit", "Are you sure you want to exit?\nThe password file will be encrypted."):
+                return
+        self._closing = True
+        if self.decrypt_cache is not None:
+            self.decrypt_cache.clear()
+        # El cifrado final va detrás de las escrituras pendientes (un solo worker) y la ventana sigue respondiendo
+        self.tasks.cancel_all()
+        self.tasks.submit("Encrypting passwords file...", self._encrypt_passwords_file,
+                          on_done=lambda _: self._close_window(),
+                          on_error=self._on_close_error)
+
+    def _on_close_error(self, e):
+        # Un error al cifrar no puede dejar la ventana sin poder cerrarse
+        messagebox.showerror("Error", f"The password file could not be encrypted.\nError: {e}", parent=self)
+        self._close_window()
+
+    def _close_window(self):
+        """Última parte del cierre, ya con el archivo cifrado: suelta el USB y los archivos y destruye la ventana."""
+        self.tasks.shutdown(wait=False)
+        utils.usb_watcher().stop()
+        for filename in self._reserved_files:
+            utils.liberar_archivo(filename)
+        self.destroy()
 
     def handle_retrain_face(self):
         """Gestiona el reentrenamiento del reconocimiento facial."""
+        if self.tasks.busy: return
         confirm = messagebox.askyesno("Update Face ID", "This will delete your existing face data and start a new capture process. Are you sure?", parent=self)
         if confirm:
-            utils.delete_user_images()
             messagebox.showinfo("Face Capture", "Next, we will capture 30 new images of your face.\nPlease look at the camera and hold still.", parent=self)
-            self.withdraw()
-            utils.create_dataset(self.face_cascade)
-            utils.train_face_recognizer()
-            self.deiconify()
-            messagebox.showinfo("Success", "Your facial profile has been updated!", parent=self)
+            self._run("Capturing face...", self._retrain_face_task, cancelable=True, pasar_tarea=True,
+                      on_done=self._on_face_retrained,
+                      on_cancel=lambda: messagebox.showinfo("Update Face ID", "Face capture cancelled. Your previous profile is kept.", parent=self))
+
+    def _retrain_face_task(self, task):
+        """
+        Se ejecuta en un worker. Las capturas van a un archivo aparte y solo sustituyen a las
+        anteriores si no se cancela, así cancelar no deja al usuario sin Face ID.
+        """
+        face_cascade, _ = self._models()
+        usuario = self.current_user or {'label': utils.face_engine.USER_LABEL, 'faces': utils.face_engine.USER_FACES_PATH}
+        nuevas = usuario['faces'] + '.new.npz'
+        stats = utils.create_dataset(face_cascade, user_faces_path=nuevas, cancelado=task.cancelado, progreso=task.report)
+        if task.cancelled or not stats['muestras']:
+            if os.path.exists(nuevas): os.remove(nuevas)
+            return None
+        if usuario['label'] == utils.face_engine.USER_LABEL:
+            utils.delete_user_images() # Capturas User.* del formato antiguo (solo las tiene el primer usuario)
+        os.replace(nuevas, usuario['faces'])
+        # Solo se procesan las capturas nuevas; las caras de referencia ya están en el modelo base
+        return utils.update_face_recognizer(usuario['label'])
+
+    def _on_face_retrained(self, recognizer):
+        if recognizer is None:
+            messagebox.showwarning("Update Face ID", "No face was captured. Your previous profile is kept.", parent=self)
+            return
+        self.recognizer = recognizer
+        messagebox.showinfo("Success", "Your facial profile has been updated!", parent=self)
+
+    def handle_add_user(self):
+        """Registra otro usuario con su propia cara y su propio archivo de contraseñas."""
+        if self.tasks.busy: return
+        nombre = ctk.CTkInputDialog(text="Enter the name of the new user:", title="Add User").get_input()
+        if not nombre or not nombre.strip(): return
+        # Cada usuario tiene su propia clave maestra: con la de otro no se puede abrir su vault
+        password = ctk.CTkInputDialog(text=f"Create a Master Key for {nombre.strip()}:", title="Add User").get_input()
+        if not password: return
+        if password != ctk.CTkInputDialog(text="Confirm the Master Key:", title="Add User").get_input():
+            messagebox.showerror("Add User", "The passwords do not match.", parent=self)
+            return
+        try:
+            usuario = utils.add_face_user(nombre)
+        except ValueError:
+            messagebox.showerror("Add User", f"There is already a user called '{nombre.strip()}'.", parent=self)
+            return
+        if not self._reserve_file(usuario['vault']):
+            utils.user_registry().remove(usuario['label'])
+            messagebox.showerror("Add User", "The password file of the new user is in use by another instance.", parent=self)
+            return
+        messagebox.showinfo("Face Capture", f"Next, we will capture 30 images of {usuario['name']}'s face.\nPlease look at the camera and hold still.", parent=self)
+        self._run("Capturing face...", self._add_user_task, usuario, password, cancelable=True, pasar_tarea=True,
+                  on_done=lambda ok: messagebox.showinfo("Add User", f"{usuario['name']} can now log in with Face ID or their own Master Key." if ok
+                                                         else "No face was captured. The user was not added.", parent=self),
+                  on_cancel=lambda: (utils.user_registry().remove(usuario['label']),
+                                     messagebox.showinfo("Add User", "Face capture cancelled. The user was not added.", parent=self)))
+
+    def _add_user_task(self, usuario, password, task):
+        """
+        Se ejecuta en un worker: captura la cara del usuario nuevo, la añade al modelo con su etiqueta y
+        guarda su clave maestra.
+        """
+        face_cascade, _ = self._models()
+        stats = utils.create_dataset(face_cascade, user_faces_path=usuario['faces'], cancelado=task.cancelado, progreso=task.report)
+        if task.cancelled or not stats['muestras']:
+            utils.user_registry().remove(usuario['label'])
+            return False
+        utils.update_face_recognizer(usuario['label'])
+        utils.create_master_key(password, usuario['master'])
+        return True
 
 if __name__ == "__main__":
     # Realizamos las comprobaciones críticas ANTES de crear la ventana principal
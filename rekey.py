@@ -0,0 +1,218 @@
+import csv
+import itertools
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+from cryptography.fernet import Fernet
+
+import storage
+from crypto_engine import rotate_many, decrypt_lines, encrypt_stream, derive_subkey, is_stream_file, stream_generation
+from vault import BinaryVault, CsvRowsReader, write_binary_vault
+
+
+FILAS_POR_LOTE = 4096 # Filas que se rotan y se guardan en el checkpoint de una vez
+SUFIJO_CHECKPOINT = '.rekey' # Estado de la rotación (JSON), junto al archivo de contraseñas
+SUFIJO_LOTES = '.rekey.lotes' # Lotes ya rotados, cifrados con la clave nueva
+SUFIJO_TMP = '.rekey.nuevo' # Contenedor nuevo antes de sustituir al actual
+SUFIJO_CLAVE_NUEVA = '.new' # La clave nueva se guarda en el USB antes de usarla para nada
+
+
+#-------------------------------------------------------------------------------------------------------------------------------
+
+def _huella(clave):
+    # Identifica la clave nueva en el checkpoint sin guardarla en el PC
+    return derive_subkey(clave, b'apm-rekey-v1')[:8].hex()
+
+def _escribir(path, datos):
+    storage.write_bytes(path, datos, sync=True) # Checkpoint y clave nueva: siempre con fsync
+
+def _leer_estado(path):
+    try:
+        with open(path, 'r') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+def _guardar_estado(path, estado):
+    _escribir(path, json.dumps(estado).encode())
+
+#-------------------------------------------------------------------------------------------------------------------------------
+
+"""Generador de filas (SITE, USER cifrado, PASSWORD cifrada) de un contenedor cifrado, sin descifrarlo entero"""
+def _filas_origen(fin, clave):
+    reader = csv.reader(decrypt_lines(fin, clave))
+    next(reader, None) # Saltamos la cabecera
+    for row in reader:
+        if len(row) >= 3:
+            yield row[0], row[1], row[2]
+
+"""Generador de las filas ya rotadas que hay en el archivo de lotes"""
+def _filas_rotadas(lotes_path, fernet):
+    with open(lotes_path, 'rb') as f:
+        for linea in f:
+            for site, user, password in json.loads(fernet.decrypt(linea.strip())):
+                yield site, user, password
+
+"""Función que cuenta las filas del archivo a partir de su snapshot (None si no hay uno al día)"""
+def _contar_filas(filename, clave):
+    try:
+        snapshot = BinaryVault(filename + '.vault', clave)
+    except Exception:
+        return None
+    try:
+        return len(snapshot) if snapshot.generation == stream_generation(filename) else None
+    finally:
+        snapshot.close()
+
+def _limpiar(filename):
+    for sufijo in (SUFIJO_LOTES, SUFIJO_TMP, SUFIJO_CHECKPOINT):
+        if os.path.exists(filename + sufijo):
+            os.remove(filename + sufijo)
+
+#-------------------------------------------------------------------------------------------------------------------------------
+
+"""
+Función que termina una rotación interrumpida durante el cambio final de archivos (el contenedor
+nuevo ya estaba completo). Hay que llamarla al arrancar, antes de usar la clave del USB: si el corte
+fue entre sustituir el archivo y sustituir la clave, el archivo solo se puede abrir con la nueva.
+Devuelve True si había algo que terminar.
+"""
+def recover(filename, clave_path):
+    checkpoint = filename + SUFIJO_CHECKPOINT
+    estado = _leer_estado(checkpoint)
+    if estado is None or estado['fase'] != 'cambio':
+        return False
+
+    tmp = filename + SUFIJO_TMP
+    if stream_generation(filename) != bytes.fromhex(estado['generacion']):
+        os.replace(tmp, filename)
+        storage.fsync_dir(filename)
+
+    nueva_path = clave_path + SUFIJO_CLAVE_NUEVA
+    if os.path.exists(nueva_path):
+        os.replace(nueva_path, clave_path)
+        storage.fsync_dir(clave_path)
+    else:
+        with open(clave_path, 'rb') as f:
+            if _huella(f.read().strip()) != estado['huella']:
+                raise ValueError(f"La clave nueva de la rotación no está en {os.path.dirname(clave_path)}: "
+                                 "inserta el USB con el que se empezó a rotar.")
+    _limpiar(filename)
+    print(f"Rotación de clave de {filename} completada tras la interrupción.")
+    return True
+
+#-------------------------------------------------------------------------------------------------------------------------------
+
+"""
+Función para rotar la clave del USB sin perder datos. Se genera una clave nueva (en el USB, como
+'<clave>.new') y cada USER y PASSWORD se vuelve a cifrar con MultiFernet.rotate, por lotes de
+'filas_por_lote' repartidos entre 'workers' hilos (o procesos, con executor='process'), leyendo el contenedor cifrado en streaming. Tras
+cada lote se guarda un checkpoint: si se interrumpe (o se cancela con 'cancelado'), volver a llamarla
+continúa donde se quedó. Al final se escribe el contenedor con la clave nueva y se sustituyen el
+archivo, el snapshot y la clave. Devuelve un diccionario con estadísticas.
+"""
+def rotate_key(filename, clave_path, anterior=None, workers=None, filas_por_lote=FILAS_POR_LOTE, snapshot=True,
+               cancelado=None, progreso=None, executor='thread'):
+    inicio = time.perf_counter()
+    stats = {'completada': False, 'filas': 0, 'reanudada_desde': 0, 'corruptos': 0}
+    if recover(filename, clave_path):
+        stats['completada'] = True
+        return stats
+
+    if anterior is None:
+        with open(clave_path, 'rb') as f:
+            anterior = f.read().strip()
+    nueva_path = clave_path + SUFIJO_CLAVE_NUEVA
+    if os.path.exists(nueva_path):
+        # Rotación anterior interrumpida: se sigue con la misma clave nueva
+        with open(nueva_path, 'rb') as f:
+            nueva = f.read().strip()
+    else:
+        nueva = Fernet.generate_key()
+        _escribir(nueva_path, nueva)
+
+    if not os.path.exists(filename):
+        # Sin contraseñas no hay nada que volver a cifrar: basta con cambiar la clave
+        os.replace(nueva_path, clave_path)
+        storage.fsync_dir(clave_path)
+        stats['completada'] = True
+        return stats
+    if not is_stream_file(filename):
+        raise ValueError(f"{filename} debe estar cifrado para rotar la clave.")
+    if os.path.exists(filename + '.journal'):
+        raise ValueError(f"Hay un journal pendiente en {filename}: cífralo antes de rotar la clave.")
+
+    checkpoint = filename + SUFIJO_CHECKPOINT
+    lotes_path = filename + SUFIJO_LOTES
+    origen = stream_generation(filename).hex()
+    estado = _leer_estado(checkpoint)
+    if (estado is None or estado['origen'] != origen or estado['huella'] != _huella(nueva)
+            or not os.path.exists(lotes_path)):
+        # No hay checkpoint válido para este archivo y esta clave: se empieza de cero
+        estado = {'fase': 'rotando', 'origen': origen, 'huella': _huella(nueva), 'filas': 0, 'bytes': 0}
+        open(lotes_path, 'wb').close()
+        _guardar_estado(checkpoint, estado)
+    stats['reanudada_desde'] = filas = estado['filas']
+    total = _contar_filas(filename, anterior)
+    fernet_lotes = Fernet(nueva)
+
+    pool_cls = ProcessPoolExecutor if executor == 'process' else ThreadPoolExecutor
+    with open(filename, 'rb') as fin, open(lotes_path, 'r+b') as flotes, \
+            pool_cls(max_workers=workers or os.cpu_count() or 1) as pool:
+        # Lo escrito después del último checkpoint puede estar a medias: se descarta
+        flotes.truncate(estado['bytes'])
+        flotes.seek(estado['bytes'])
+        filas_origen = itertools.islice(_filas_origen(fin, anterior), filas, None)
+        while True:
+            if cancelado is not None and cancelado.is_set():
+                stats.update(filas=filas, duracion=time.perf_counter() - inicio)
+                return stats
+            lote = list(itertools.islice(filas_origen, filas_por_lote))
+            if not lote:
+                break
+            tokens = [t for _, user, password in lote for t in (user, password)]
+            rotados = rotate_many(nueva, anterior, tokens, pool=pool)
+            stats['corruptos'] += sum(a == b for a, b in zip(tokens, rotados))
+            filas_nuevas = [(site, rotados[2 * i], rotados[2 * i + 1]) for i, (site, _, _) in enumerate(lote)]
+            flotes.write(fernet_lotes.encrypt(json.dumps(filas_nuevas).encode()) + b'\n')
+            flotes.flush()
+            os.fsync(flotes.fileno())
+            filas += len(lote)
+            estado.update(filas=filas, bytes=flotes.tell())
+            _guardar_estado(checkpoint, estado)
+            if progreso is not None:
+                progreso(filas, total)
+
+    # Contenedor completo con la clave nueva (las filas rotadas se leen de los lotes, en streaming)
+    entradas = [] if snapshot else None
+    def filas_finales():
+        for fila in _filas_rotadas(lotes_path, fernet_lotes):
+            if entradas is not None:
+                entradas.append(fila)
+            yield fila
+    tmp = filename + SUFIJO_TMP
+    with open(tmp, 'wb') as fout:
+        encrypt_stream(CsvRowsReader(filas_finales()), fout, nueva)
+        fout.flush()
+        os.fsync(fout.fileno())
+    generacion = stream_generation(tmp)
+
+    # Cambio final. A partir de aquí recover() sabe terminarlo si se corta
+    estado.update(fase='cambio', generacion=generacion.hex())
+    _guardar_estado(checkpoint, estado)
+    os.replace(tmp, filename)
+    storage.fsync_dir(filename)
+    if snapshot:
+        write_binary_vault(filename + '.vault', entradas, nueva, generacion)
+    elif os.path.exists(filename + '.vault'):
+        os.remove(filename + '.vault') # Seguiría cifrado con la clave retirada
+    os.replace(nueva_path, clave_path)
+    storage.fsync_dir(clave_path)
+    _limpiar(filename)
+
+    duracion = time.perf_counter() - inicio
+    stats.update(completada=True, filas=filas, duracion=duracion,
+                 filas_s=(filas - stats['reanudada_desde']) / duracion if duracion else 0.0)
+    return stats
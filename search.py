@@ -0,0 +1,148 @@
+import bisect
+import threading
+
+
+UMBRAL_CANDIDATOS = 4096 # Hasta aquí se reúnen y ordenan todas las coincidencias; con más, se recorre en orden
+
+
+#-------------------------------------------------------------------------------------------------------------------------------
+
+"""Función para normalizar un texto antes de indexarlo o buscarlo"""
+def normalizar(texto):
+    return texto.casefold().strip()
+
+def _trigramas(texto):
+    return {texto[i:i + 3] for i in range(len(texto) - 2)}
+
+def _siguiente(texto):
+    # Menor cadena mayor que todas las que empiezan por 'texto' (límite superior del rango de prefijos)
+    return texto[:-1] + chr(ord(texto[-1]) + 1)
+
+#-------------------------------------------------------------------------------------------------------------------------------
+
+class SearchIndex:
+    """
+    Índice de búsqueda incremental sobre SITE y usuario. Las consultas de 3 o más
+    caracteres se resuelven intersecando las listas de trigramas (y verificando la
+    subcadena en los candidatos); las de 1-2 caracteres, como prefijo sobre una
+    lista ordenada de términos con bisect. Los resultados salen primero los que
+    empiezan por la consulta y después el resto, cada grupo ordenado por SITE. Las
+    altas y bajas pueden llegar desde un worker mientras la GUI busca, así que todo
+    pasa por un lock.
+    """
+
+    def __init__(self):
+        self._textos = {} # SITE -> textos normalizados (site, usuario)
+        self._trigramas = {} # trigrama -> set de SITE
+        self._terminos = [] # Lista ordenada de (texto, SITE) para búsquedas por prefijo
+        self._sitios = [] # SITE ordenados: orden de los resultados y recorrido cuando hay muchas coincidencias
+        self._lock = threading.RLock()
+
+    def add(self, site, user=None):
+        """Añade o actualiza una entrada."""
+        with self._lock:
+            if site in self._textos:
+                self.remove(site)
+            textos = tuple(normalizar(t) for t in (site, user) if t)
+            self._textos[site] = textos
+            for texto in textos:
+                for tri in _trigramas(texto):
+                    self._trigramas.setdefault(tri, set()).add(site)
+                bisect.insort(self._terminos, (texto, site))
+            bisect.insort(self._sitios, site)
+
+    def add_many(self, entradas):
+        """Carga inicial de muchas (site, usuario) de golpe: la lista de términos se ordena una sola vez."""
+        with self._lock:
+            terminos, sitios = [], []
+            for site, user in entradas:
+                if site in self._textos:
+                    self.remove(site)
+                textos = tuple(normalizar(t) for t in (site, user) if t)
+                self._textos[site] = textos
+                for texto in textos:
+                    for tri in _trigramas(texto):
+                        self._trigramas.setdefault(tri, set()).add(site)
+                    terminos.append((texto, site))
+                sitios.append(site)
+            self._terminos.extend(terminos)
+            self._terminos.sort()
+            self._sitios.extend(sitios)
+            self._sitios.sort()
+
+    def remove(self, site):
+        """Elimina una entrada si existe."""
+        with self._lock:
+            textos = self._textos.pop(site, None)
+            if textos is None:
+                return
+            for texto in textos:
+                for tri in _trigramas(texto):
+                    sitios = self._trigramas.get(tri)
+                    if sitios is not None:
+                        sitios.discard(site)
+                        if not sitios:
+                            del self._trigramas[tri]
+                i = bisect.bisect_left(self._terminos, (texto, site))
+                if i < len(self._terminos) and self._terminos[i] == (texto, site):
+                    del self._terminos[i]
+            del self._sitios[bisect.bisect_left(self._sitios, site)]
+
+    def search(self, consulta, limite=None):
+        """
+        Devuelve la lista de SITE cuyo nombre o usuario contiene la consulta (o empieza por
+        ella si tiene menos de 3 caracteres): primero los que empiezan por la consulta y
+        después el resto, cada grupo ordenado. Con 'limite' se devuelven solo los primeros
+        de esa clasificación; si hay muchas coincidencias se recorren los SITE en orden y se
+        para al completar el límite, así el coste no crece con el tamaño del vault.
+        """
+        with self._lock:
+            q = normalizar(consulta)
+            if not q:
+                return self._sitios[:limite]
+
+            # Coincidencias por prefijo: un rango de la lista ordenada de términos
+            inicio = bisect.bisect_left(self._terminos, (q,))
+            fin = bisect.bisect_left(self._terminos, (_siguiente(q),), inicio)
+            if limite is not None and fin - inicio > max(UMBRAL_CANDIDATOS, 2 * limite):
+                # Cada SITE aporta como mucho dos términos: seguro que hay más prefijos que 'limite'
+                return self._recorrer(lambda textos: any(t.startswith(q) for t in textos), limite)
+            prefijos = sorted({site for _, site in self._terminos[inicio:fin]})
+            faltan = None if limite is None else limite - len(prefijos)
+            if len(q) < 3 or (faltan is not None and faltan <= 0):
+                return prefijos[:limite]
+            return prefijos + self._subcadenas(q, set(prefijos), faltan)
+
+    def _recorrer(self, coincide, limite, excluir=()):
+        # Los SITE en orden hasta reunir 'limite' coincidencias (barato cuando coinciden muchos)
+        resultado = []
+        for site in self._sitios:
+            if site not in excluir and coincide(self._textos[site]):
+                resultado.append(site)
+                if len(resultado) >= limite:
+                    break
+        return resultado
+
+    def _subcadenas(self, q, excluir, limite):
+        """SITE ordenados que contienen 'q' sin estar en 'excluir' (los que empiezan por ella), hasta 'limite'."""
+        listas = []
+        for tri in _trigramas(q):
+            sitios = self._trigramas.get(tri)
+            if not sitios:
+                return []
+            listas.append(sitios)
+        listas.sort(key=len)
+        if limite is not None and len(listas[0]) > UMBRAL_CANDIDATOS:
+            return self._recorrer(lambda textos: any(q in t for t in textos), limite, excluir)
+
+        # Recorremos el trigrama menos frecuente y comprobamos el resto; con 3 caracteres no hace falta verificar
+        verificar = len(q) > 3
+        resultado = sorted(site for site in listas[0] if site not in excluir and all(site in sitios for sitios in listas[1:])
+                           and (not verificar or any(q in texto for texto in self._textos[site])))
+        return resultado[:limite]
+
+    def __contains__(self, site):
+        return site in self._textos
+
+    def __len__(self):
+        return len(self._textos)
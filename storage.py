@@ -0,0 +1,135 @@
+import os
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+
+
+SINCRONIZAR = True # fsync del archivo y del directorio en cada escritura atómica (durabilidad frente a cortes de luz)
+ESPERA_BLOQUEO = 5.0 # Segundos que se espera a que otro proceso suelte el bloqueo de escritura
+
+
+#-------------------------------------------------------------------------------------------------------------------------------
+
+class VaultLockedError(RuntimeError):
+    """Otro proceso (otra instancia del gestor) tiene el bloqueo de escritura del archivo."""
+
+#-------------------------------------------------------------------------------------------------------------------------------
+
+"""Función para que un rename/creación en un directorio sobreviva a un corte de luz (en Windows no hace falta ni se puede)"""
+def fsync_dir(path):
+    if os.name == 'nt':
+        return
+    fd = os.open(os.path.dirname(os.path.abspath(path)) or '.', os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+"""
+Context manager para escribir un archivo de forma atómica: se escribe en un temporal del mismo
+directorio, se hace fsync y se renombra encima del original. Si algo falla a mitad, el original
+queda intacto y el temporal se borra. 'modo' es 'wb' o 'w' (con encoding/newline para texto).
+"""
+@contextmanager
+def atomic_write(path, modo='wb', sync=None, permisos=None, **opciones):
+    sync = SINCRONIZAR if sync is None else sync
+    directorio = os.path.dirname(os.path.abspath(path))
+    fd, tmp = tempfile.mkstemp(dir=directorio, prefix=os.path.basename(path) + '.', suffix='.tmp')
+    try:
+        if permisos is not None and os.name != 'nt':
+            os.fchmod(fd, permisos)
+        with open(fd, modo, **opciones) as f:
+            yield f
+            f.flush()
+            if sync:
+                os.fsync(f.fileno())
+        os.replace(tmp, path)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+    if sync:
+        fsync_dir(path)
+
+"""Función para escribir unos bytes en un archivo de forma atómica"""
+def write_bytes(path, datos, sync=None):
+    with atomic_write(path, 'wb', sync=sync) as f:
+        f.write(datos)
+
+#-------------------------------------------------------------------------------------------------------------------------------
+
+class FileLock:
+    """
+    Bloqueo de escritura consultivo entre procesos ('<archivo>.lock' con flock/msvcrt). Dentro del
+    proceso es reentrante: la sesión de la GUI lo mantiene y cada escritura (desde cualquier hilo)
+    vuelve a adquirirlo sin bloquearse; otra instancia del gestor no puede escribir mientras tanto.
+    """
+
+    def __init__(self, path):
+        self.path = path + '.lock'
+        self._fd = None
+        self._nivel = 0
+        self._lock = threading.Lock()
+
+    def _intentar(self):
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            if os.name == 'nt':
+                import msvcrt
+                msvcrt.locking(fd, msvcrt.LK_NBLCK, 1)
+            else:
+                import fcntl
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            os.close(fd)
+            return False
+        self._fd = fd
+        return True
+
+    def acquire(self, timeout=ESPERA_BLOQUEO):
+        """Adquiere el bloqueo (esperando hasta 'timeout' segundos). Lanza VaultLockedError si no lo consigue."""
+        limite = time.monotonic() + (timeout or 0)
+        with self._lock:
+            while self._fd is None and not self._intentar():
+                if time.monotonic() >= limite:
+                    raise VaultLockedError(f"{self.path[:-len('.lock')]} está bloqueado por otra instancia del gestor.")
+                time.sleep(0.05)
+            self._nivel += 1
+        return self
+
+    def release(self):
+        with self._lock:
+            if self._nivel == 0:
+                return
+            self._nivel -= 1
+            if self._nivel == 0:
+                if os.name == 'nt':
+                    import msvcrt
+                    os.lseek(self._fd, 0, os.SEEK_SET)
+                    msvcrt.locking(self._fd, msvcrt.LK_UNLCK, 1)
+                # El archivo .lock no se borra: borrarlo abriría una carrera con quien esté esperando
+                os.close(self._fd)
+                self._fd = None
+
+    @property
+    def held(self):
+        return self._nivel > 0
+
+    def __enter__(self):
+        return self.acquire()
+
+    def __exit__(self, *exc):
+        self.release()
+
+_bloqueos = {}
+_bloqueos_lock = threading.Lock()
+
+"""Función que devuelve el bloqueo de escritura (único por proceso) de un archivo"""
+def writer_lock(path):
+    clave = os.path.abspath(path)
+    with _bloqueos_lock:
+        bloqueo = _bloqueos.get(clave)
+        if bloqueo is None:
+            bloqueo = _bloqueos[clave] = FileLock(clave)
+        return bloqueo
@@ -0,0 +1,149 @@
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+
+INTERVALO_MS = 50 # Cada cuánto revisa el hilo de Tk si hay resultados o progreso de los workers
+
+
+#-------------------------------------------------------------------------------------------------------------------------------
+
+class Task:
+    """
+    Operación lanzada en segundo plano. El worker puede consultar 'cancelado' para
+    abandonar el trabajo y llamar a report() para informar del progreso.
+    """
+
+    def __init__(self, runner, descripcion, cancelable):
+        self.runner = runner
+        self.descripcion = descripcion
+        self.cancelable = cancelable
+        self.cancelado = threading.Event()
+        self.future = None
+
+    def cancel(self):
+        """Pide la cancelación. Si aún no había empezado ya no se ejecuta; si no, se ignora su resultado."""
+        self.cancelado.set()
+        if self.future is not None:
+            self.future.cancel()
+
+    @property
+    def cancelled(self):
+        return self.cancelado.is_set()
+
+    def report(self, hecho, total=None):
+        """Informa del progreso desde el worker (hecho/total, o solo un texto si total es None)."""
+        self.runner._eventos.put(('progreso', self, (hecho, total)))
+
+#-------------------------------------------------------------------------------------------------------------------------------
+
+class TaskRunner:
+    """
+    Ejecuta en un pool de hilos el trabajo que bloquearía la interfaz (cifrado, E/S de
+    archivos, cámara) y entrega resultados, errores y progreso en el hilo de Tk con after().
+    Con un solo worker (por defecto) las tareas se ejecutan en el orden en que se piden,
+    así dos escrituras sobre el vault nunca se adelantan la una a la otra.
+    """
+
+    def __init__(self, root, workers=1, intervalo=INTERVALO_MS):
+        self.root = root
+        self.intervalo = intervalo
+        self.on_change = None # Callback (tarea activa o None) para mostrar el estado en la GUI
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="tasks")
+        self._eventos = queue.Queue()
+        self._pendientes = [] # Tareas enviadas cuyo resultado aún no se ha entregado
+        self._callbacks = {}
+        self._poll_id = None
+
+    def submit(self, descripcion, func, *args, on_done=None, on_error=None, on_progress=None, on_cancel=None,
+               cancelable=False, pasar_tarea=False, **kwargs):
+        """
+        Lanza func(*args, **kwargs) en segundo plano. Con pasar_tarea=True se le pasa además
+        task=<Task> para que pueda comprobar la cancelación e informar del progreso.
+        """
+        task = Task(self, descripcion, cancelable)
+        if pasar_tarea:
+            kwargs['task'] = task
+
+        def run():
+            if task.cancelled:
+                self._eventos.put(('cancelada', task, None))
+                return
+            try:
+                resultado = func(*args, **kwargs)
+            except Exception as e:
+                self._eventos.put(('error', task, e))
+            else:
+                self._eventos.put(('hecho', task, resultado))
+
+        self._callbacks[task] = (on_done, on_error, on_progress, on_cancel)
+        self._pendientes.append(task)
+        task.future = self._executor.submit(run)
+        task.future.add_done_callback(lambda f: f.cancelled() and self._eventos.put(('cancelada', task, None)))
+        self._notificar()
+        self._programar()
+        return task
+
+    @property
+    def busy(self):
+        return bool(self._pendientes)
+
+    def current(self):
+        """Tarea más antigua aún pendiente (la que se está ejecutando con un solo worker)."""
+        return self._pendientes[0] if self._pendientes else None
+
+    def cancel_all(self):
+        """Cancela las tareas cancelables; las escrituras pendientes siguen adelante."""
+        for task in list(self._pendientes):
+            if task.cancelable:
+                task.cancel()
+
+    def _programar(self):
+        if self._poll_id is None:
+            self._poll_id = self.root.after(self.intervalo, self._poll)
+
+    def _notificar(self):
+        if self.on_change is not None:
+            self.on_change(self.current())
+
+    def _poll(self):
+        """Entrega en el hilo de Tk todo lo que han dejado los workers desde la última vez."""
+        self._poll_id = None
+        while True:
+            try:
+                tipo, task, valor = self._eventos.get_nowait()
+            except queue.Empty:
+                break
+            on_done, on_error, on_progress, on_cancel = self._callbacks.get(task, (None, None, None, None))
+            if tipo == 'progreso':
+                if on_progress is not None and not task.cancelled:
+                    on_progress(*valor)
+                continue
+
+            # Tarea terminada (con resultado, error o cancelada): ya no está pendiente
+            self._callbacks.pop(task, None)
+            if task in self._pendientes:
+                self._pendientes.remove(task)
+            self._notificar()
+            if task.cancelled:
+                if on_cancel is not None:
+                    on_cancel()
+                continue
+            if tipo == 'hecho' and on_done is not None:
+                on_done(valor)
+            elif tipo == 'error':
+                if on_error is not None:
+                    on_error(valor)
+                else:
+                    print(f"Error en la tarea '{task.descripcion}': {valor}")
+
+        if self._pendientes:
+            self._programar()
+
+    def shutdown(self, wait=True):
+        """Cancela las tareas cancelables y espera (opcionalmente) a que terminen las demás."""
+        self.cancel_all()
+        self._executor.shutdown(wait=wait)
+        if self._poll_id is not None:
+            self.root.after_cancel(self._poll_id)
+            self._poll_id = None
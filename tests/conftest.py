@@ -0,0 +1,26 @@
+import os
+import sys
+
+import pytest
+from cryptography.fernet import Fernet
+
+# Los módulos del gestor están en la raíz del repositorio (no es un paquete instalable)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import storage
+
+
+@pytest.fixture(autouse=True)
+def sin_fsync(monkeypatch):
+    # Las pruebas no necesitan durabilidad frente a cortes de luz: sin fsync van mucho más rápidas
+    monkeypatch.setattr(storage, 'SINCRONIZAR', False)
+
+@pytest.fixture
+def clave():
+    return Fernet.generate_key()
+
+"""Filas (SITE, USER cifrado, PASSWORD cifrada) como las que guarda el gestor"""
+def filas_cifradas(clave, n):
+    fernet = Fernet(clave)
+    return [(f'site{i}.com', fernet.encrypt(f'user{i}'.encode()).decode(), fernet.encrypt(f'pass{i}'.encode()).decode())
+            for i in range(n)]
@@ -0,0 +1,59 @@
+import os
+
+import pytest
+
+import bulk_io
+
+
+ENTRADAS = [('mail.google.com', 'ana@gmail.com', 'p4ss,con"comillas'), ('github.com', '', 'ñandú 🔑')]
+
+
+@pytest.mark.parametrize('formato', bulk_io.FORMATOS)
+def test_round_trip_every_format(tmp_path, formato):
+    path = str(tmp_path / ('volcado.json' if formato in bulk_io.FORMATOS_JSON else 'volcado.csv'))
+    assert bulk_io.write_entries(path, iter(ENTRADAS), formato) == len(ENTRADAS)
+    assert not os.path.exists(path + '.tmp')
+    if os.name == 'posix':
+        assert os.stat(path).st_mode & 0o777 == 0o600 # Las contraseñas van en claro
+    assert bulk_io.detect_format(path) == formato
+    assert list(bulk_io.read_entries(path)) == ENTRADAS
+
+def test_site_from_url():
+    assert bulk_io.site_from_url('https://www.example.com/login?x=1') == 'www.example.com'
+    assert bulk_io.site_from_url('example.org/path') == 'example.org'
+    assert bulk_io.site_from_url('  ') == ''
+    assert bulk_io.site_from_url(None) == ''
+
+def test_firefox_dump_takes_site_from_url_and_skips_invalid_rows(tmp_path):
+    path = str(tmp_path / 'firefox.csv')
+    with open(path, 'w', encoding='utf-8-sig', newline='') as f:
+        f.write('"url","username","password","httpRealm","formActionOrigin","guid","timeCreated",'
+                '"timeLastUsed","timePasswordChanged"\n'
+                '"https://accounts.example.com/login","ana","secreta","","","{1}","1","1","1"\n'
+                '"https://sin-password.example.com","ana","","","","{2}","1","1","1"\n'
+                '"","pedro","otra","","","{3}","1","1","1"\n')
+    stats = {}
+    assert bulk_io.detect_format(path) == 'firefox'
+    assert list(bulk_io.read_entries(path, stats=stats)) == [('accounts.example.com', 'ana', 'secreta')]
+    assert stats == {'leidas': 3, 'invalidas': 2}
+
+def test_bitwarden_json_keeps_only_logins(tmp_path):
+    path = str(tmp_path / 'bitwarden.json')
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write('{"encrypted": false, "items": ['
+                '{"type": 2, "name": "Nota segura", "secureNote": {"type": 0}},'
+                '{"type": 1, "name": "", "login": {"username": "ana", "password": "x",'
+                ' "uris": [{"uri": "https://bank.example.com/"}]}}]}')
+    assert bulk_io.detect_format(path) == 'bitwarden-json'
+    assert list(bulk_io.read_entries(path)) == [('bank.example.com', 'ana', 'x')]
+
+def test_unknown_formats_are_rejected(tmp_path):
+    path = str(tmp_path / 'otro.csv')
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write('a,b,c\n1,2,3\n')
+    with pytest.raises(ValueError):
+        bulk_io.detect_format(path)
+    with pytest.raises(ValueError):
+        list(bulk_io.read_entries(path, formato='keepass'))
+    with pytest.raises(ValueError):
+        bulk_io.write_entries(path, [], formato='keepass')
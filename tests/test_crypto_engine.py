@@ -0,0 +1,73 @@
+import io
+
+import pytest
+from cryptography.exceptions import InvalidTag
+from cryptography.fernet import Fernet, InvalidToken
+
+from crypto_engine import (decrypt_many, decrypt_stream, encrypt_many, encrypt_stream, is_fernet_file, is_stream_file,
+                           stream_generation, _CABECERA)
+
+
+@pytest.mark.parametrize('workers', [1, 4])
+def test_batch_round_trip_keeps_order(clave, workers):
+    valores = [f'valor{i}' for i in range(1000)]
+    tokens = encrypt_many(clave, valores, workers=workers, tam_lote=64)
+    assert len(tokens) == len(valores)
+    assert Fernet(clave).decrypt(tokens[10].encode()) == b'valor10'
+    assert decrypt_many(clave, tokens, workers=workers, tam_lote=64) == valores
+
+def test_batch_reports_invalid_tokens(clave):
+    tokens = encrypt_many(clave, ['a', 'b', 'c'])
+    tokens[1] = Fernet(Fernet.generate_key()).encrypt(b'otra clave').decode()
+    assert decrypt_many(clave, tokens, ignorar_errores=True) == ['a', None, 'c']
+    with pytest.raises(InvalidToken):
+        decrypt_many(clave, tokens)
+
+#-------------------------------------------------------------------------------------------------------------------------------
+
+def _cifrar(datos, clave, tam_segmento=64):
+    salida = io.BytesIO()
+    encrypt_stream(io.BytesIO(datos), salida, clave, tam_segmento=tam_segmento)
+    return salida.getvalue()
+
+def _descifrar(contenedor, clave):
+    return b''.join(decrypt_stream(io.BytesIO(contenedor), clave))
+
+@pytest.mark.parametrize('tam', [0, 1, 64, 65, 1000])
+def test_stream_round_trip(clave, tam):
+    datos = (bytes(range(256)) * (tam // 256 + 1))[:tam]
+    assert _descifrar(_cifrar(datos, clave), clave) == datos
+
+def test_stream_rejects_tampered_segment(clave):
+    contenedor = bytearray(_cifrar(b'SITE,USER,PASSWORD\n' * 20, clave))
+    contenedor[_CABECERA.size + 10] ^= 1
+    with pytest.raises(InvalidTag):
+        _descifrar(bytes(contenedor), clave)
+
+def test_stream_rejects_tampered_header(clave):
+    contenedor = bytearray(_cifrar(b'datos' * 50, clave))
+    contenedor[8] ^= 1 # Prefijo del nonce: va autenticado como dato asociado
+    with pytest.raises(InvalidTag):
+        _descifrar(bytes(contenedor), clave)
+
+def test_stream_rejects_truncation(clave):
+    contenedor = _cifrar(b'x' * 500, clave)
+    # Cortar justo tras un segmento intermedio: ningún segmento marcado como final
+    with pytest.raises(ValueError):
+        _descifrar(contenedor[:_CABECERA.size + 4 + 64 + 16], clave)
+    with pytest.raises(ValueError):
+        _descifrar(contenedor + b'extra', clave)
+
+def test_stream_rejects_wrong_key(clave):
+    with pytest.raises(InvalidTag):
+        _descifrar(_cifrar(b'secreto', clave), Fernet.generate_key())
+
+def test_file_format_detection(tmp_path, clave):
+    stream, antiguo, claro = tmp_path / 'a', tmp_path / 'b', tmp_path / 'c'
+    stream.write_bytes(_cifrar(b'SITE,USER,PASSWORD\n', clave))
+    antiguo.write_bytes(Fernet(clave).encrypt(b'SITE,USER,PASSWORD\n'))
+    claro.write_bytes(b'SITE,USER,PASSWORD\nsite.com,gAAAAAuser,gAAAAApass\n')
+    assert is_stream_file(stream) and not is_fernet_file(stream)
+    assert is_fernet_file(antiguo) and not is_stream_file(antiguo)
+    assert not is_fernet_file(claro) and not is_stream_file(claro)
+    assert stream_generation(stream) is not None and stream_generation(antiguo) is None
@@ -0,0 +1,44 @@
+import hashlib
+
+import kdf
+import utils
+
+
+BARATA = kdf.Scrypt(n=2 ** 10) # Parámetros mínimos para que las pruebas vayan rápidas
+
+
+def test_hash_format_round_trip():
+    almacenado = kdf.hash_password('correcta', BARATA)
+    assert almacenado.startswith('$scrypt$n=1024,r=8,p=1$')
+    assert kdf.verify_password('correcta', almacenado)
+    assert not kdf.verify_password('incorrecta', almacenado)
+    # Sal aleatoria: la misma contraseña no da el mismo resumen
+    assert kdf.hash_password('correcta', BARATA) != almacenado
+    nuevo, _, _ = kdf.decode(almacenado)
+    assert nuevo.params == BARATA.params
+
+def test_pbkdf2_format_round_trip():
+    almacenado = kdf.hash_password('correcta', kdf.Pbkdf2(1000))
+    assert almacenado.startswith('$pbkdf2$i=1000$')
+    assert kdf.verify_password('correcta', almacenado)
+    assert kdf.needs_rehash(almacenado) # Por debajo del mínimo recomendado
+
+def test_legacy_sha256_is_accepted_and_flagged():
+    antiguo = hashlib.sha256(b'correcta').hexdigest()
+    assert kdf.verify_password('correcta', antiguo)
+    assert not kdf.verify_password('incorrecta', antiguo)
+    assert kdf.needs_rehash(antiguo)
+    assert not kdf.needs_rehash(kdf.hash_password('x', kdf.Scrypt(**kdf.Scrypt.minimos)))
+
+def test_validate_master_key_migrates_legacy_file(tmp_path, monkeypatch):
+    monkeypatch.setattr(kdf, 'calibrate', lambda *args, **kwargs: kdf.Scrypt(**kdf.Scrypt.minimos))
+    path = tmp_path / 'master.key'
+    path.write_text(hashlib.sha256(b'correcta').hexdigest())
+
+    assert not utils.validate_master_key('incorrecta', str(path))
+    assert not path.read_text().startswith('$') # Con la contraseña equivocada no se toca
+
+    assert utils.validate_master_key('correcta', str(path))
+    assert path.read_text().startswith('$scrypt$')
+    assert not kdf.needs_rehash(path.read_text())
+    assert utils.validate_master_key('correcta', str(path))
@@ -0,0 +1,95 @@
+import csv
+import io
+import os
+import threading
+
+import pytest
+from cryptography.fernet import Fernet
+
+import rekey
+from conftest import filas_cifradas
+from crypto_engine import decrypt_lines, encrypt_stream
+from vault import COLUMNAS, BinaryVault
+
+
+FILAS = 25
+
+
+@pytest.fixture
+def vault_cifrado(tmp_path, clave):
+    """Archivo de contraseñas cifrado (contenedor por segmentos) y clave del USB, como los deja el gestor."""
+    clave_path = str(tmp_path / 'usb' / 'clave.key')
+    os.makedirs(os.path.dirname(clave_path))
+    with open(clave_path, 'wb') as f:
+        f.write(clave)
+    path = str(tmp_path / 'passwordsList.csv')
+    filas = filas_cifradas(clave, FILAS)
+    texto = io.StringIO()
+    csv.writer(texto).writerows([COLUMNAS, *filas])
+    with open(path, 'wb') as fout:
+        encrypt_stream(io.BytesIO(texto.getvalue().encode('utf-8')), fout, clave)
+    return path, clave_path, filas
+
+def _comprobar_rotado(path, clave_path, anterior, filas):
+    with open(clave_path, 'rb') as f:
+        nueva = f.read().strip()
+    assert nueva != anterior
+    with open(path, 'rb') as fin:
+        rotadas = list(csv.reader(decrypt_lines(fin, nueva)))[1:]
+    assert [site for site, _, _ in rotadas] == [site for site, _, _ in filas]
+    fernet = Fernet(nueva)
+    for (site, user, password), (_, user_original, password_original) in zip(rotadas, filas):
+        assert fernet.decrypt(user.encode()) == Fernet(anterior).decrypt(user_original.encode())
+        assert fernet.decrypt(password.encode()) == Fernet(anterior).decrypt(password_original.encode())
+    assert not any(os.path.exists(path + s) for s in (rekey.SUFIJO_CHECKPOINT, rekey.SUFIJO_LOTES, rekey.SUFIJO_TMP))
+    assert not os.path.exists(clave_path + rekey.SUFIJO_CLAVE_NUEVA)
+
+def test_rotate_key_resumes_after_cancel(vault_cifrado, clave):
+    path, clave_path, filas = vault_cifrado
+    cancelado = threading.Event()
+    # Se cancela tras el primer lote
+    stats = rekey.rotate_key(path, clave_path, workers=1, filas_por_lote=10, cancelado=cancelado,
+                             progreso=lambda hechas, total: cancelado.set())
+    assert not stats['completada'] and stats['filas'] == 10
+    assert os.path.exists(path + rekey.SUFIJO_CHECKPOINT)
+    with open(clave_path, 'rb') as f:
+        assert f.read().strip() == clave # La clave del USB no cambia hasta el final
+
+    stats = rekey.rotate_key(path, clave_path, workers=1, filas_por_lote=10)
+    assert stats['completada'] and stats['reanudada_desde'] == 10 and stats['filas'] == FILAS
+    _comprobar_rotado(path, clave_path, clave, filas)
+    with open(clave_path, 'rb') as f:
+        snapshot = BinaryVault(path + '.vault', f.read().strip())
+    assert len(snapshot) == FILAS
+    snapshot.close()
+
+@pytest.mark.parametrize('corte', ['antes_de_sustituir', 'antes_de_la_clave'])
+def test_recover_finishes_interrupted_switch(vault_cifrado, clave, monkeypatch, corte):
+    path, clave_path, filas = vault_cifrado
+
+    class Corte(Exception):
+        pass
+
+    if corte == 'antes_de_sustituir':
+        # Corte justo después de guardar la fase 'cambio': el contenedor nuevo aún no ha sustituido al actual
+        guardar = rekey._guardar_estado
+        def guardar_y_cortar(checkpoint, estado):
+            guardar(checkpoint, estado)
+            if estado['fase'] == 'cambio':
+                raise Corte()
+        monkeypatch.setattr(rekey, '_guardar_estado', guardar_y_cortar)
+    else:
+        # Corte con el archivo ya sustituido pero la clave del USB aún sin cambiar
+        def cortar(*args, **kwargs):
+            raise Corte()
+        monkeypatch.setattr(rekey, 'write_binary_vault', cortar)
+
+    with pytest.raises(Corte):
+        rekey.rotate_key(path, clave_path, workers=1, filas_por_lote=10)
+    monkeypatch.undo()
+    with open(clave_path, 'rb') as f:
+        assert f.read().strip() == clave
+
+    assert rekey.recover(path, clave_path)
+    _comprobar_rotado(path, clave_path, clave, filas)
+    assert not rekey.recover(path, clave_path) # Ya no queda nada pendiente
@@ -0,0 +1,47 @@
+from search import SearchIndex
+
+
+def _indice():
+    indice = SearchIndex()
+    indice.add_many([('mail.google.com', 'ana@gmail.com'), ('github.com', 'ana'), ('bank.es', 'pedro'),
+                     ('Amazon.com', None)])
+    return indice
+
+def test_substring_search_on_sites_and_users():
+    indice = _indice()
+    assert indice.search('gmail') == ['mail.google.com']
+    assert indice.search('.com') == ['Amazon.com', 'github.com', 'mail.google.com']
+    assert indice.search('PEDRO') == ['bank.es'] # Sin distinguir mayúsculas
+    assert indice.search('zzz') == []
+
+def test_short_queries_match_prefixes():
+    indice = _indice()
+    assert indice.search('a') == ['Amazon.com', 'github.com', 'mail.google.com'] # 'ana...' y 'amazon'
+    assert indice.search('gi') == ['github.com']
+    assert indice.search('') == ['Amazon.com', 'bank.es', 'github.com', 'mail.google.com']
+
+def test_incremental_updates():
+    indice = _indice()
+    indice.add('github.com', 'otro') # Actualizar sustituye el usuario anterior
+    assert indice.search('ana') == ['mail.google.com']
+    indice.remove('mail.google.com')
+    assert indice.search('ana') == [] and 'mail.google.com' not in indice
+    indice.add('nuevo.org', 'ana')
+    assert indice.search('ana') == ['nuevo.org'] and len(indice) == 4
+
+def test_prefix_hits_rank_first_and_the_limit_cuts_after_sorting():
+    indice = SearchIndex()
+    indice.add_many([('zeta-mail.com', None), ('mail.zz', None), ('a-mail.org', None), ('mailbox.io', None),
+                     ('b.net', 'mail@b.net')])
+    # Primero los que empiezan por 'mail' (por SITE o por usuario), luego los que solo la contienen
+    assert indice.search('mail') == ['b.net', 'mail.zz', 'mailbox.io', 'a-mail.org', 'zeta-mail.com']
+    assert indice.search('mail', limite=4) == ['b.net', 'mail.zz', 'mailbox.io', 'a-mail.org']
+    assert indice.search('mai', limite=2) == ['b.net', 'mail.zz']
+
+def test_limit_stops_early():
+    indice = SearchIndex()
+    indice.add_many((f'site{i}.com', f'user{i}') for i in range(1000))
+    esperado = sorted(f'site{i}.com' for i in range(1000))[:10]
+    assert indice.search('site', limite=10) == esperado # Se recorre en orden en vez de reunir las 1000
+    assert indice.search('s', limite=10) == esperado
+    assert indice.search('te1', limite=3) == ['site1.com', 'site10.com', 'site100.com']
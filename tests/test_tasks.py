@@ -0,0 +1,98 @@
+import threading
+
+from tasks import TaskRunner
+
+
+class RaizFalsa:
+    """Sustituye a la ventana de Tk: guarda los after() para ejecutarlos a mano desde el test."""
+
+    def __init__(self):
+        self.programados = {}
+        self._siguiente = 0
+
+    def after(self, ms, func):
+        self._siguiente += 1
+        self.programados[self._siguiente] = func
+        return self._siguiente
+
+    def after_cancel(self, poll_id):
+        self.programados.pop(poll_id, None)
+
+    def bombear(self, runner):
+        """Espera a los workers y entrega sus eventos como haría el bucle de Tk."""
+        runner._executor.submit(lambda: None).result()
+        while self.programados:
+            poll_id = next(iter(self.programados))
+            self.programados.pop(poll_id)()
+            if runner.busy and not self.programados:
+                break
+
+
+def _runner():
+    raiz = RaizFalsa()
+    return raiz, TaskRunner(raiz)
+
+def test_results_and_errors_are_delivered_on_the_tk_thread():
+    raiz, runner = _runner()
+    hilos, resultados, errores = [], [], []
+
+    def hecho(valor):
+        hilos.append(threading.current_thread())
+        resultados.append(valor)
+
+    runner.submit("Suma", lambda a, b: a + b, 2, 3, on_done=hecho)
+    runner.submit("Fallo", lambda: 1 / 0, on_error=errores.append)
+    assert runner.busy
+    raiz.bombear(runner)
+
+    assert resultados == [5] and hilos == [threading.current_thread()]
+    assert len(errores) == 1 and isinstance(errores[0], ZeroDivisionError)
+    assert not runner.busy and runner.current() is None
+    runner.shutdown()
+
+def test_tasks_run_in_order_with_one_worker():
+    raiz, runner = _runner()
+    orden = []
+    for i in range(5):
+        runner.submit(f"Tarea {i}", orden.append, i)
+    raiz.bombear(runner)
+    assert orden == [0, 1, 2, 3, 4]
+    runner.shutdown()
+
+def test_progress_and_cancellation():
+    raiz, runner = _runner()
+    puede_seguir = threading.Event()
+    progreso, hechos, cancelados = [], [], []
+
+    def trabajo(task):
+        task.report(1, 2)
+        puede_seguir.wait(5)
+        return 'ignorado' if task.cancelled else 'terminado'
+
+    lenta = runner.submit("Lenta", trabajo, pasar_tarea=True, cancelable=True, on_done=hechos.append,
+                          on_progress=lambda hecho, total: progreso.append((hecho, total)),
+                          on_cancel=lambda: cancelados.append('lenta'))
+    escritura = runner.submit("Escritura", lambda: 'guardado', on_done=hechos.append)
+    en_cola = runner.submit("En cola", lambda: 'no debe ejecutarse', cancelable=True, on_done=hechos.append,
+                            on_cancel=lambda: cancelados.append('en cola'))
+    assert runner.current() is lenta
+
+    runner.cancel_all() # Solo afecta a las cancelables: la escritura sigue adelante
+    assert lenta.cancelled and en_cola.cancelled and not escritura.cancelled
+    puede_seguir.set()
+    raiz.bombear(runner)
+
+    assert hechos == ['guardado'] # Al resultado de la tarea cancelada ya no se le hace caso
+    assert sorted(cancelados) == ['en cola', 'lenta']
+    assert progreso in ([], [(1, 2)]) # El progreso de una tarea ya cancelada no se entrega
+    assert not runner.busy
+    runner.shutdown()
+
+def test_on_change_follows_the_active_task():
+    raiz, runner = _runner()
+    cambios = []
+    runner.on_change = cambios.append
+    task = runner.submit("Única", lambda: None)
+    raiz.bombear(runner)
+    assert cambios == [task, None]
+    runner.shutdown()
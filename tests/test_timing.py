@@ -0,0 +1,79 @@
+import threading
+import time
+
+import pytest
+
+import timing
+
+
+@pytest.fixture
+def perfil(tmp_path):
+    path = str(tmp_path / 'apm_profile.jsonl')
+    timing.enable(path)
+    yield path
+    timing.disable()
+
+def test_percentil_interpolates():
+    assert timing.percentil([], 50) == 0.0
+    assert timing.percentil([7], 99) == 7
+    valores = [5, 1, 4, 2, 3] # Sin ordenar
+    assert timing.percentil(valores, 0) == 1 and timing.percentil(valores, 100) == 5
+    assert timing.percentil(valores, 50) == 3
+    assert timing.percentil(valores, 95) == pytest.approx(4.8)
+    assert valores == [5, 1, 4, 2, 3]
+
+def test_disabled_spans_write_nothing(tmp_path):
+    assert not timing.enabled()
+    with timing.span('nada') as medida:
+        medida.count('filas')
+        medida.set(x=1)
+    timing.count('global')
+    timing.record('nada', time.perf_counter())
+    assert list(tmp_path.iterdir()) == []
+
+def test_spans_counters_and_records(perfil):
+    @timing.timed('prueba.decorada')
+    def decorada():
+        timing.count('filas', 2) # Va al span abierto por @timed
+        return 'ok'
+
+    with timing.span('prueba.exterior', modo='a') as medida:
+        assert decorada() == 'ok'
+        medida.set(snapshot=True)
+    with pytest.raises(KeyError):
+        with timing.span('prueba.exterior'):
+            raise KeyError()
+    hilo = threading.Thread(target=timing.record, args=('prueba.otro_hilo', time.perf_counter()), kwargs={'n': 3},
+                            name='medidor')
+    hilo.start()
+    hilo.join()
+    timing.count('sin_span')
+    timing.disable() # Escribe los contadores globales y cierra el archivo
+
+    registros = list(timing.read_records(perfil))
+    por_nombre = {}
+    for registro in registros:
+        por_nombre.setdefault(registro['span'], []).append(registro)
+    decorado, = por_nombre['prueba.decorada']
+    assert decorado['parent'] == 'prueba.exterior' and decorado['counters'] == {'filas': 2}
+    correcto, fallido = por_nombre['prueba.exterior']
+    assert correcto['attrs'] == {'modo': 'a', 'snapshot': True} and correcto['parent'] is None
+    assert fallido['error'] == 'KeyError'
+    otro, = por_nombre['prueba.otro_hilo']
+    assert otro['thread'] == 'medidor' and otro['attrs'] == {'n': 3}
+    assert por_nombre[None][0]['counters'] == {'sin_span': 1}
+
+    resumen, contadores = timing.summarize(registros, prefijo='prueba.ext')
+    assert list(resumen) == ['prueba.exterior'] and contadores == {'sin_span': 1}
+    fila = resumen['prueba.exterior']
+    assert fila['n'] == 2 and fila['errores'] == 1
+    assert fila['max'] == max(correcto['ms'], fallido['ms'])
+    assert fila['p50'] == pytest.approx(fila['media'])
+
+def test_summarize_skips_damaged_lines(tmp_path):
+    path = tmp_path / 'apm_profile.jsonl'
+    path.write_text('{"span": "a", "ms": 1.0, "counters": {"n": 1}}\n{"span": "a", "ms": 3.0, "coun\n'
+                    '{"span": "a", "ms": 5.0, "counters": {"n": 2}}\n', encoding='utf-8')
+    resumen, contadores = timing.summarize(timing.read_records(str(path)))
+    assert resumen['a']['n'] == 2 and resumen['a']['total'] == 6.0 and resumen['a']['counters'] == {'n': 3}
+    assert resumen['a']['p50'] == 3.0 and contadores == {}
@@ -0,0 +1,47 @@
+import threading
+
+from usb_watcher import FakeMountTable, UsbWatcher, parse_mountinfo
+
+
+def _unidad(tmp_path, nombre, con_clave):
+    punto = tmp_path / nombre
+    punto.mkdir()
+    if con_clave:
+        (punto / 'clave.key').write_bytes(b'x')
+    return (f'/dev/{nombre}1', str(punto), 'rw')
+
+def test_insert_and_remove_key_drive(tmp_path):
+    otra = _unidad(tmp_path, 'sdb', con_clave=False)
+    usb = _unidad(tmp_path, 'sdc', con_clave=True)
+    tabla = FakeMountTable([otra])
+    watcher = UsbWatcher(tabla)
+    assert watcher.find_key() is None
+
+    # Se inserta el USB con la clave: se detecta sin reiniciar el vigilante
+    tabla.set([otra, usb])
+    key_path = watcher.find_key()
+    assert key_path == str(tmp_path / 'sdc' / 'clave.key')
+    watcher.watch_key(key_path)
+    assert watcher.key_present()
+
+    retirada, cambios = threading.Event(), []
+    watcher.on_key_removed = lambda ruta: retirada.set()
+    watcher.on_change = cambios.append
+    watcher.start()
+    try:
+        # Se retira otra unidad: no es la de la clave, no hay aviso
+        tabla.set([usb])
+        assert not retirada.wait(1)
+        # Se retira la unidad de la clave
+        tabla.set([])
+        assert retirada.wait(2)
+        assert not watcher.key_present()
+        assert cambios[-1] == []
+    finally:
+        watcher.stop()
+
+def test_parse_mountinfo_unescapes_paths():
+    linea = '36 25 8:33 / /media/user/MI\\040USB rw,nosuid shared:1 - vfat /dev/sdc1 rw\n'
+    (particion,) = parse_mountinfo(linea)
+    assert particion.device == '/dev/sdc1'
+    assert particion.mountpoint == '/media/user/MI USB'
@@ -0,0 +1,109 @@
+import json
+import os
+import threading
+import time
+
+import pytest
+
+import face_engine
+import users
+import utils
+
+
+@pytest.fixture
+def registro(tmp_path):
+    return users.UserRegistry(str(tmp_path / 'trainer' / 'users.json'))
+
+def test_first_user_keeps_legacy_files_and_later_users_get_their_own(registro):
+    primero = registro.add('Ana')
+    assert primero['label'] == face_engine.USER_LABEL
+    assert primero['vault'] == users.VAULT_POR_DEFECTO and primero['master'] == users.MASTER_POR_DEFECTO
+    assert primero['faces'] == face_engine.USER_FACES_PATH
+
+    segundo = registro.add(' Pedro ')
+    tercero = registro.add('Luis')
+    assert segundo['name'] == 'Pedro'
+    assert segundo['label'] == users.ETIQUETA_NUEVOS and tercero['label'] == users.ETIQUETA_NUEVOS + 1
+    assert segundo['vault'] == f"passwordsList.{segundo['label']}.csv"
+    assert segundo['master'] == f"master.{segundo['label']}.key"
+    assert len({u['faces'] for u in registro.users()}) == 3
+    assert registro.names() == {primero['label']: 'Ana', segundo['label']: 'Pedro', tercero['label']: 'Luis'}
+
+def test_names_must_be_unique_and_not_empty(registro):
+    registro.add('Ana')
+    with pytest.raises(ValueError):
+        registro.add('Ana')
+    with pytest.raises(ValueError):
+        registro.add('   ')
+    assert len(registro) == 1
+
+def test_registry_is_saved_and_reloaded(registro):
+    ana = registro.add('Ana')
+    pedro = registro.add('Pedro')
+    copia = users.UserRegistry(registro.path)
+    assert copia.users() == registro.users()
+    assert copia.by_name('Pedro') == pedro and copia.by_name('Nadie') is None
+
+    assert copia.remove(pedro['label']) and not copia.remove(pedro['label'])
+    assert pedro['label'] not in users.UserRegistry(registro.path)
+    assert ana['label'] in users.UserRegistry(registro.path)
+    # Las etiquetas siguen a la mayor registrada: al borrar la última, la siguiente vuelve a quedar libre
+    assert copia.add('Luis')['label'] == users.ETIQUETA_NUEVOS
+
+def test_entries_are_copies(registro):
+    ana = registro.add('Ana')
+    ana['vault'] = 'otro.csv'
+    registro.get(ana['label'])['name'] = 'Otra'
+    assert registro.get(ana['label'])['vault'] == users.VAULT_POR_DEFECTO
+    assert registro.by_name('Ana') is not None
+
+def test_old_registry_without_master_field(registro):
+    os.makedirs(os.path.dirname(registro.path))
+    with open(registro.path, 'w', encoding='utf-8') as f:
+        json.dump({'users': [{'label': face_engine.USER_LABEL, 'name': 'Ana', 'vault': 'passwordsList.csv', 'faces': 'a.npz'},
+                             {'label': 1000000, 'name': 'Pedro', 'vault': 'p.csv', 'faces': 'p.npz'}]}, f)
+    registro.load()
+    assert [u['master'] for u in registro.users()] == ['master.key', 'master.1000000.key']
+
+def test_migrate_legacy_username(registro, tmp_path):
+    username_path = str(tmp_path / 'username.dat')
+    assert users.migrate_legacy(registro, username_path) is None # Instalación nueva: no hay nada que migrar
+    with open(username_path, 'w') as f:
+        f.write('Ana\n')
+    usuario = users.migrate_legacy(registro, username_path)
+    assert usuario['name'] == 'Ana' and usuario['label'] == face_engine.USER_LABEL
+    assert users.migrate_legacy(registro, username_path) is None and len(registro) == 1 # Solo la primera vez
+
+def test_face_model_holds_every_registered_user(registro, monkeypatch):
+    ana, pedro = registro.add('Ana'), registro.add('Pedro')
+    cargados = []
+    monkeypatch.setattr(utils, '_registro', registro)
+    monkeypatch.setattr(utils, '_reconocedor', None)
+    monkeypatch.setattr(face_engine, 'load_recognizer', lambda usuarios: cargados.append(usuarios) or object())
+    recognizer = utils.load_face_recognizer()
+    # Un solo modelo con los dos: la cara de Pedro nunca se predice como la de Ana
+    assert cargados == [[(ana['label'], ana['faces']), (pedro['label'], pedro['faces'])]]
+    assert utils.load_face_recognizer() is recognizer and len(cargados) == 1
+
+def test_registry_is_created_and_migrated_once_across_threads(registro, monkeypatch):
+    migraciones = []
+
+    def crear():
+        time.sleep(0.01) # Deja que los demás hilos lleguen mientras se crea y se migra
+        return registro
+
+    def migrar(reg):
+        time.sleep(0.01)
+        migraciones.append(reg)
+
+    monkeypatch.setattr(utils, '_registro', None)
+    monkeypatch.setattr(users, 'UserRegistry', crear)
+    monkeypatch.setattr(users, 'migrate_legacy', migrar)
+    vistos = []
+    # Cada hilo anota el registro que recibe y si ya estaba migrado en ese momento
+    hilos = [threading.Thread(target=lambda: vistos.append((utils.user_registry(), len(migraciones)))) for _ in range(8)]
+    for hilo in hilos:
+        hilo.start()
+    for hilo in hilos:
+        hilo.join()
+    assert migraciones == [registro] and vistos == [(registro, 1)] * 8
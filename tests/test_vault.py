@@ -0,0 +1,141 @@
+import os
+
+import pytest
+from cryptography.fernet import Fernet
+
+import utils
+from conftest import filas_cifradas
+from crypto_engine import is_fernet_file, is_stream_file, stream_generation
+from vault import BinaryVault, CsvRowsReader, Vault, write_binary_vault
+
+
+def test_journal_replay_after_crash(tmp_path, clave):
+    path = str(tmp_path / 'passwordsList.csv')
+    filas = filas_cifradas(clave, 5)
+    vault = Vault(path, clave)
+    vault.put_many(filas)
+    vault.enable_journal(Fernet(clave), compactar_cada=float('inf'))
+    vault.put('nuevo.com', 'u', 'p')
+    vault.put('site0.com', 'u0', 'p0')
+    vault.delete('site1.com')
+    # "Corte de luz": no se compacta ni se cierra, y el último registro queda a medias
+    with open(path + '.journal', 'ab') as f:
+        f.write(b'gAAAAABincompleto')
+
+    recuperado = Vault(path, clave)
+    recuperado.enable_journal(Fernet(clave))
+    assert recuperado.get('nuevo.com') == ('u', 'p')
+    assert recuperado.get('site0.com') == ('u0', 'p0')
+    assert recuperado.get('site1.com') is None
+    assert len(recuperado) == 5
+    # El journal dañado se compacta en el archivo base, que sigue cifrado
+    assert is_stream_file(path)
+    assert dict((s, (u, p)) for s, u, p in Vault(path, clave).items()) == dict((s, (u, p)) for s, u, p in recuperado.items())
+
+def test_journal_compacts_at_threshold(tmp_path, clave):
+    path = str(tmp_path / 'passwordsList.csv')
+    vault = Vault(path)
+    vault.enable_journal(Fernet(clave), compactar_cada=3)
+    for i in range(3):
+        vault.put(f'site{i}.com', 'u', 'p')
+        vault.save()
+    assert vault.journal.count == 0 # Al llegar al umbral se vuelca en el CSV y se vacía
+    assert len(Vault(path)) == 3
+
+#-------------------------------------------------------------------------------------------------------------------------------
+
+def test_binary_snapshot_round_trip(tmp_path, clave):
+    path = str(tmp_path / 'passwordsList.csv.vault')
+    filas = filas_cifradas(clave, 50)
+    write_binary_vault(path, filas, clave, b'1234567')
+    snapshot = BinaryVault(path, clave)
+    try:
+        assert len(snapshot) == 50
+        assert snapshot.generation == b'1234567'
+        assert snapshot.sites() == [site for site, _, _ in filas] # Orden de visualización
+        assert snapshot.get('site7.com') == filas[7][1:]
+        assert snapshot.get('noexiste.com') is None and 'site7.com' in snapshot
+    finally:
+        snapshot.close()
+    with pytest.raises(ValueError):
+        BinaryVault(path, Fernet.generate_key()) # Otra clave: ni el índice ni los nombres se pueden leer
+
+def test_binary_snapshot_rejects_other_files(tmp_path, clave):
+    path = tmp_path / 'passwordsList.csv.vault'
+    path.write_bytes(b'SITE,USER,PASSWORD\n' * 10)
+    with pytest.raises(ValueError):
+        BinaryVault(str(path), clave)
+
+def test_old_fernet_file_is_never_read_as_plaintext(tmp_path, clave):
+    path = str(tmp_path / 'passwordsList.csv')
+    filas = filas_cifradas(clave, 10)
+    csv_texto = b''.join(iter(lambda r=CsvRowsReader(filas): r.read(4096), b''))
+    with open(path, 'wb') as f:
+        f.write(Fernet(clave).encrypt(csv_texto)) # Formato de versiones anteriores
+    assert is_fernet_file(path)
+
+    with pytest.raises(ValueError):
+        Vault(path) # Sin clave no se puede leer: antes se leía como un CSV sin filas
+    assert list(Vault(path, clave).items()) == filas
+
+def test_stream_file_needs_the_key(tmp_path, clave):
+    path = str(tmp_path / 'passwordsList.csv')
+    Vault(path, clave).put_many(filas_cifradas(clave, 3))
+    assert is_stream_file(path)
+    with pytest.raises(ValueError):
+        Vault(path) # Igual que con el formato anterior: nunca se lee como un CSV en claro
+    assert len(Vault(path, clave)) == 3
+
+def test_new_and_reset_files_are_encrypted_at_rest(tmp_path, clave, monkeypatch):
+    clave_path = str(tmp_path / 'clave.key')
+    with open(clave_path, 'wb') as f:
+        f.write(clave)
+    path = str(tmp_path / 'passwordsList.csv')
+    try:
+        utils.ensure_passwords_file(path, clave_path)
+        assert is_stream_file(path) and len(Vault(path, clave)) == 0
+
+        # Clave nueva: el archivo se vacía cifrado con ella y se borra lo que dependía de la anterior
+        Vault(path, clave).put_many(filas_cifradas(clave, 3))
+        with open(path + '.journal', 'wb') as f:
+            f.write(b'gAAAAABanterior')
+        nueva_path = str(tmp_path / 'nueva.key')
+        nueva = Fernet.generate_key()
+        with open(nueva_path, 'wb') as f:
+            f.write(nueva)
+        utils.reset_passwords_file(path, nueva_path)
+        assert is_stream_file(path) and len(Vault(path, nueva)) == 0
+        assert not os.path.exists(path + '.journal')
+
+        monkeypatch.setattr(utils, 'CIFRADO_EN_REPOSO', False)
+        claro = str(tmp_path / 'claro.csv')
+        utils.ensure_passwords_file(claro)
+        with open(claro, 'r', encoding='utf-8') as f:
+            assert f.read() == 'SITE,USER,PASSWORD\n'
+    finally:
+        utils.olvidar_clave()
+
+def test_cifrar_csv_migrates_old_fernet_file(tmp_path, clave):
+    clave_path = str(tmp_path / 'clave.key')
+    with open(clave_path, 'wb') as f:
+        f.write(clave)
+    path = str(tmp_path / 'passwordsList.csv')
+    filas = filas_cifradas(clave, 10)
+    csv_texto = b''.join(iter(lambda r=CsvRowsReader(filas): r.read(4096), b''))
+    with open(path, 'wb') as f:
+        f.write(Fernet(clave).encrypt(csv_texto))
+
+    utils.cifrar_csv(path, clave_path) # Lo que hace el gestor al cerrar
+    assert is_stream_file(path)
+    assert list(Vault(path, clave).items()) == filas
+    snapshot = utils.open_snapshot(path, clave_path)
+    try:
+        assert len(snapshot) == 10 and snapshot.generation == stream_generation(path)
+    finally:
+        snapshot.close()
+
+    # Volver a cifrar un archivo ya cifrado no cambia nada
+    generacion = stream_generation(path)
+    utils.cifrar_csv(path, clave_path)
+    assert stream_generation(path) == generacion
+    assert list(Vault(path, clave).items()) == filas
@@ -0,0 +1,283 @@
+"""
+Medición de tiempos por etapas (desbloqueo, carga de contraseñas, reconocimiento facial...). Se activa
+con la variable de entorno APM_PROFILE ('1' escribe en apm_profile.jsonl; cualquier otro valor es la
+ruta del archivo). Desactivado, span() devuelve un objeto vacío compartido y casi no cuesta nada.
+
+Cada span escrito es una línea JSON con su nombre, duración, span padre, hilo, atributos y contadores.
+Resumen con percentiles:
+    python timing.py [apm_profile.jsonl] [--prefix unlock.] [--sort p95]
+"""
+import argparse
+import atexit
+import functools
+import json
+import os
+import threading
+import time
+
+
+VARIABLE_ENTORNO = 'APM_PROFILE'
+ARCHIVO_POR_DEFECTO = 'apm_profile.jsonl'
+PERCENTILES = (50, 95, 99)
+
+
+#-------------------------------------------------------------------------------------------------------------------------------
+
+def _ruta_entorno():
+    valor = os.environ.get(VARIABLE_ENTORNO, '').strip()
+    if valor.lower() in ('', '0', 'false', 'no', 'off'):
+        return None
+    return ARCHIVO_POR_DEFECTO if valor.lower() in ('1', 'true', 'yes', 'on') else valor
+
+_ruta = _ruta_entorno() # None = desactivado
+_archivo = None
+_lock = threading.Lock()
+_local = threading.local() # Pila de spans abiertos de cada hilo
+_contadores = {} # Contadores sin ningún span abierto: se escriben juntos en flush()
+
+def _pila():
+    pila = getattr(_local, 'pila', None)
+    if pila is None:
+        pila = _local.pila = []
+    return pila
+
+def _escribir(registro):
+    global _archivo
+    linea = json.dumps(registro, ensure_ascii=False, default=str) + '\n'
+    with _lock:
+        if _ruta is None:
+            return
+        if _archivo is None:
+            _archivo = open(_ruta, 'a', encoding='utf-8')
+        _archivo.write(linea)
+        _archivo.flush() # Una línea entera por escritura: si se cierra mal solo se pierde la última
+
+#-------------------------------------------------------------------------------------------------------------------------------
+
+class _SpanNulo:
+    """Lo que devuelve span() con la medición desactivada: no mide ni escribe nada."""
+
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def count(self, nombre, n=1):
+        pass
+
+    def set(self, **atributos):
+        pass
+
+_NULO = _SpanNulo()
+
+class Span:
+    """Etapa medida. Al salir del 'with' se escribe su duración con los atributos y contadores acumulados."""
+
+    __slots__ = ('nombre', 'atributos', 'contadores', 'padre', '_t0', '_ts')
+
+    def __init__(self, nombre, atributos):
+        self.nombre = nombre
+        self.atributos = atributos
+        self.contadores = {}
+        self.padre = None
+
+    def __enter__(self):
+        pila = _pila()
+        self.padre = pila[-1].nombre if pila else None
+        pila.append(self)
+        self._ts = time.time()
+        self._t0 = time.perf_counter()
+        return self
+
+    def __exit__(self, tipo, exc, tb):
+        ms = (time.perf_counter() - self._t0) * 1000
+        pila = _pila()
+        if pila and pila[-1] is self:
+            pila.pop()
+        registro = {'ts': round(self._ts, 3), 'span': self.nombre, 'ms': round(ms, 3), 'parent': self.padre,
+                    'thread': threading.current_thread().name, 'pid': os.getpid()}
+        if self.atributos:
+            registro['attrs'] = self.atributos
+        if self.contadores:
+            registro['counters'] = self.contadores
+        if tipo is not None:
+            registro['error'] = tipo.__name__
+        _escribir(registro)
+        return False
+
+    def count(self, nombre, n=1):
+        self.contadores[nombre] = self.contadores.get(nombre, 0) + n
+
+    def set(self, **atributos):
+        self.atributos.update(atributos)
+
+#-------------------------------------------------------------------------------------------------------------------------------
+
+"""Función que indica si la medición está activada"""
+def enabled():
+    return _ruta is not None
+
+"""Función para activar la medición desde el código (benchmarks), escribiendo en 'path'"""
+def enable(path=ARCHIVO_POR_DEFECTO):
+    global _ruta
+    disable()
+    _ruta = path
+
+"""Función para desactivar la medición y cerrar el archivo (se escriben antes los contadores pendientes)"""
+def disable():
+    global _ruta, _archivo
+    flush()
+    with _lock:
+        if _archivo is not None:
+            _archivo.close()
+            _archivo = None
+        _ruta = None
+
+"""
+Función que abre un span: 'with timing.span("unlock.decrypt", rows=n) as s: ... s.count("rows")'.
+Los atributos y contadores se guardan con la duración en el JSONL.
+"""
+def span(nombre, **atributos):
+    if _ruta is None:
+        return _NULO
+    return Span(nombre, atributos)
+
+"""
+Función para escribir una etapa ya medida por fuera (p.ej. una que empieza en un hilo y termina en otro),
+a partir del instante de inicio con time.perf_counter().
+"""
+def record(nombre, inicio, **atributos):
+    if _ruta is None:
+        return
+    ms = (time.perf_counter() - inicio) * 1000
+    registro = {'ts': round(time.time() - ms / 1000, 3), 'span': nombre, 'ms': round(ms, 3), 'parent': None,
+                'thread': threading.current_thread().name, 'pid': os.getpid()}
+    if atributos:
+        registro['attrs'] = atributos
+    _escribir(registro)
+
+"""Función para sumar 'n' a un contador del span abierto en este hilo (o a los globales si no hay ninguno)"""
+def count(nombre, n=1):
+    if _ruta is None:
+        return
+    pila = _pila()
+    if pila:
+        pila[-1].count(nombre, n)
+        return
+    with _lock:
+        _contadores[nombre] = _contadores.get(nombre, 0) + n
+
+"""Función para escribir los contadores globales acumulados (se llama sola al salir del proceso)"""
+def flush():
+    with _lock:
+        if not _contadores:
+            return
+        contadores = dict(_contadores)
+        _contadores.clear()
+    _escribir({'ts': round(time.time(), 3), 'span': None, 'counters': contadores,
+               'thread': threading.current_thread().name, 'pid': os.getpid()})
+
+atexit.register(flush)
+
+"""Decorador que mide cada llamada a la función como un span (por defecto con el nombre 'modulo.funcion')"""
+def timed(nombre=None):
+    def decorador(func):
+        etiqueta = nombre or f'{func.__module__}.{func.__name__}'
+
+        @functools.wraps(func)
+        def envoltorio(*args, **kwargs):
+            if _ruta is None:
+                return func(*args, **kwargs)
+            with Span(etiqueta, {}):
+                return func(*args, **kwargs)
+        return envoltorio
+    return decorador
+
+#-------------------------------------------------------------------------------------------------------------------------------
+
+"""Generador de los registros de un archivo JSONL de tiempos (las líneas dañadas se saltan)"""
+def read_records(path):
+    with open(path, 'r', encoding='utf-8') as f:
+        for linea in f:
+            try:
+                yield json.loads(linea)
+            except ValueError:
+                continue
+
+"""Función para calcular un percentil (0-100) de una lista de valores, interpolando"""
+def percentil(valores, p):
+    if not valores:
+        return 0.0
+    ordenados = sorted(valores)
+    k = (len(ordenados) - 1) * p / 100
+    i = int(k)
+    j = min(i + 1, len(ordenados) - 1)
+    return ordenados[i] + (ordenados[j] - ordenados[i]) * (k - i)
+
+"""
+Función que agrupa los registros por span. Devuelve (resumen, contadores): por cada span, número de
+llamadas, errores, total, media, percentiles y máximo en ms, y la suma de sus contadores.
+"""
+def summarize(registros, prefijo=''):
+    duraciones, errores, contadores_span, contadores = {}, {}, {}, {}
+    for registro in registros:
+        nombre = registro.get('span')
+        if nombre is None:
+            for c, n in registro.get('counters', {}).items():
+                contadores[c] = contadores.get(c, 0) + n
+            continue
+        if not nombre.startswith(prefijo):
+            continue
+        duraciones.setdefault(nombre, []).append(registro['ms'])
+        if 'error' in registro:
+            errores[nombre] = errores.get(nombre, 0) + 1
+        suma = contadores_span.setdefault(nombre, {})
+        for c, n in registro.get('counters', {}).items():
+            suma[c] = suma.get(c, 0) + n
+
+    resumen = {}
+    for nombre, ms in duraciones.items():
+        fila = {'n': len(ms), 'errores': errores.get(nombre, 0), 'total': sum(ms), 'media': sum(ms) / len(ms), 'max': max(ms)}
+        for p in PERCENTILES:
+            fila[f'p{p}'] = percentil(ms, p)
+        fila['counters'] = contadores_span[nombre]
+        resumen[nombre] = fila
+    return resumen, contadores
+
+"""Función para mostrar por consola el resumen de summarize(), ordenado por la columna indicada"""
+def print_summary(resumen, contadores=None, orden='total'):
+    cabeceras = ['span', 'n', 'errores', 'total ms', 'media ms'] + [f'p{p} ms' for p in PERCENTILES] + ['max ms', 'contadores']
+    filas = []
+    for nombre, fila in sorted(resumen.items(), key=lambda kv: kv[1][orden], reverse=True):
+        filas.append([nombre, fila['n'], fila['errores'], f"{fila['total']:.1f}", f"{fila['media']:.2f}"]
+                     + [f"{fila[f'p{p}']:.2f}" for p in PERCENTILES] + [f"{fila['max']:.2f}"]
+                     + [', '.join(f'{c}={n}' for c, n in sorted(fila['counters'].items()))])
+    anchos = [max(len(str(x)) for x in col) for col in zip(cabeceras, *filas)]
+    print('  '.join(str(c).ljust(a) for c, a in zip(cabeceras, anchos)))
+    for fila in filas:
+        print('  '.join(str(c).ljust(a) for c, a in zip(fila, anchos)))
+    if contadores:
+        print('\nContadores globales: ' + ', '.join(f'{c}={n}' for c, n in sorted(contadores.items())))
+
+#-------------------------------------------------------------------------------------------------------------------------------
+
+def main():
+    parser = argparse.ArgumentParser(description="Resumen con percentiles de los tiempos registrados con APM_PROFILE")
+    parser.add_argument('path', nargs='?', default=_ruta or ARCHIVO_POR_DEFECTO, help="Archivo JSONL de tiempos")
+    parser.add_argument('--prefix', default='', help="Solo los spans cuyo nombre empieza así (p.ej. 'unlock.')")
+    parser.add_argument('--sort', default='total', choices=['n', 'total', 'media', 'max'] + [f'p{p}' for p in PERCENTILES])
+    args = parser.parse_args()
+
+    if not os.path.exists(args.path):
+        parser.error(f"No existe {args.path}: ejecuta el gestor con {VARIABLE_ENTORNO}=1 para generarlo.")
+    resumen, contadores = summarize(read_records(args.path), args.prefix)
+    if not resumen and not contadores:
+        print(f"No hay spans en {args.path}.")
+        return
+    print_summary(resumen, contadores, args.sort)
+
+if __name__ == '__main__':
+    main()
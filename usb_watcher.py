@@ -0,0 +1,227 @@
+import os
+import re
+import select
+import sys
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+
+NOMBRE_CLAVE = 'clave.key'
+MOUNTINFO = '/proc/self/mountinfo'
+INTERVALO = 2.0 # Segundos entre enumeraciones cuando el sistema no avisa de los cambios (Windows/macOS)
+RAICES_EXTRAIBLES = ('/media/', '/run/media/') # Donde montan los USB automáticamente las distribuciones Linux
+
+Particion = namedtuple('Particion', ['device', 'mountpoint', 'opts'])
+
+
+#-------------------------------------------------------------------------------------------------------------------------------
+
+class PsutilMountTable:
+    """Tabla de montajes con psutil (Windows/macOS). No hay eventos: se vuelve a enumerar cada 'intervalo'."""
+
+    def __init__(self, intervalo=INTERVALO):
+        self.intervalo = intervalo
+        self._ultima = None
+
+    def partitions(self):
+        import psutil # Importación diferida: solo se carga si se enumeran unidades
+
+        self._ultima = time.monotonic()
+        return [Particion(p.device, p.mountpoint, p.opts) for p in psutil.disk_partitions(all=False)
+                if 'removable' in p.opts.lower()] # Filtrar unidades extraíbles
+
+    def wait(self, timeout):
+        """Devuelve True si la tabla puede haber cambiado desde la última enumeración."""
+        if self._ultima is None:
+            return True
+        restante = self.intervalo - (time.monotonic() - self._ultima)
+        if restante > 0:
+            if not timeout:
+                return False
+            time.sleep(min(restante, timeout))
+        return time.monotonic() - self._ultima >= self.intervalo
+
+    def close(self):
+        pass
+
+#-------------------------------------------------------------------------------------------------------------------------------
+
+def _desescapar(campo):
+    # mountinfo escapa espacios, tabuladores, saltos y barras invertidas en octal (\040)
+    return re.sub(r'\\([0-7]{3})', lambda m: chr(int(m.group(1), 8)), campo)
+
+"""Función para parsear /proc/self/mountinfo en una lista de Particion"""
+def parse_mountinfo(texto):
+    particiones = []
+    for linea in texto.splitlines():
+        campos = linea.split()
+        if '-' not in campos:
+            continue
+        separador = campos.index('-')
+        mountpoint, opts = _desescapar(campos[4]), campos[5]
+        device = _desescapar(campos[separador + 2]) if len(campos) > separador + 2 else ''
+        particiones.append(Particion(device, mountpoint, opts))
+    return particiones
+
+"""Función para saber si un dispositivo de bloque es extraíble (/sys/block/<disco>/removable)"""
+def es_extraible(particion, sys_block='/sys/block'):
+    if not particion.device.startswith('/dev/'):
+        return False
+    nombre = os.path.basename(particion.device)
+    # sdb1 -> sdb; mmcblk0p1 -> mmcblk0 y nvme0n1p2 -> nvme0n1 (el número de partición va tras una 'p')
+    disco = re.sub(r'p\d+$', '', nombre) if re.match(r'(mmcblk|nvme|loop)', nombre) else re.sub(r'\d+$', '', nombre)
+    for candidato in (disco, nombre):
+        try:
+            with open(os.path.join(sys_block, candidato, 'removable')) as f:
+                if f.read().strip() == '1':
+                    return True
+        except OSError:
+            pass
+    # Algunos lectores USB no marcan 'removable'; los montajes automáticos van a /media o /run/media
+    return particion.mountpoint.startswith(RAICES_EXTRAIBLES)
+
+#-------------------------------------------------------------------------------------------------------------------------------
+
+class MountinfoTable:
+    """
+    Tabla de montajes de Linux. El kernel marca /proc/self/mountinfo con POLLPRI cuando se monta
+    o desmonta algo, así que se espera a ese evento en lugar de volver a enumerar periódicamente.
+    """
+
+    def __init__(self, path=MOUNTINFO, sys_block='/sys/block'):
+        self.path = path
+        self.sys_block = sys_block
+        self._archivo = open(path, 'r')
+        self._poll = select.poll()
+        self._poll.register(self._archivo, select.POLLPRI | select.POLLERR)
+        self._leida = False
+
+    def partitions(self):
+        # Leer el archivo desde el principio también rearma el aviso de cambios
+        self._archivo.seek(0)
+        texto = self._archivo.read()
+        self._leida = True
+        return [p for p in parse_mountinfo(texto) if es_extraible(p, self.sys_block)]
+
+    def wait(self, timeout):
+        if not self._leida:
+            return True
+        return bool(self._poll.poll(0 if not timeout else int(timeout * 1000)))
+
+    def close(self):
+        self._archivo.close()
+
+#-------------------------------------------------------------------------------------------------------------------------------
+
+class FakeMountTable:
+    """Tabla de montajes para pruebas: las particiones se cambian con set() y eso cuenta como evento."""
+
+    def __init__(self, particiones=()):
+        self._particiones = [Particion(*p) for p in particiones]
+        self._cambio = threading.Event()
+        self._cambio.set()
+
+    def set(self, particiones):
+        self._particiones = [Particion(*p) for p in particiones]
+        self._cambio.set()
+
+    def partitions(self):
+        self._cambio.clear()
+        return list(self._particiones)
+
+    def wait(self, timeout):
+        return self._cambio.wait(timeout) if timeout else self._cambio.is_set()
+
+    def close(self):
+        pass
+
+"""Función que elige la tabla de montajes según el sistema"""
+def default_mount_table():
+    if sys.platform.startswith('linux') and os.path.exists(MOUNTINFO):
+        return MountinfoTable()
+    return PsutilMountTable()
+
+#-------------------------------------------------------------------------------------------------------------------------------
+
+class UsbWatcher:
+    """
+    Unidades USB y ubicación del archivo de clave, en caché. Solo se vuelven a enumerar cuando la
+    tabla de montajes avisa de un cambio; con start() un hilo espera esos avisos y, si desaparece la
+    unidad que tenía la clave, llama a on_key_removed(ruta de la clave).
+    """
+
+    def __init__(self, tabla=None, nombre_clave=NOMBRE_CLAVE):
+        self.tabla = tabla if tabla is not None else default_mount_table()
+        self.nombre_clave = nombre_clave
+        self.on_change = None # Callback(lista de unidades) tras un cambio
+        self.on_key_removed = None # Callback(ruta de la clave) si desaparece la unidad con la clave
+        self.key_path = None # Clave en uso (la que se vigila)
+        self._unidades = None
+        self._lock = threading.Lock()
+        self._parar = threading.Event()
+        self._hilo = None
+
+    def _enumerar(self):
+        unidades = [p.mountpoint for p in self.tabla.partitions()]
+        with self._lock:
+            self._unidades = unidades
+        return unidades
+
+    def drives(self):
+        """Puntos de montaje de las unidades extraíbles (de caché mientras no haya cambios)."""
+        if self._unidades is None or (self._hilo is None and self.tabla.wait(0)):
+            return self._enumerar()
+        with self._lock:
+            return list(self._unidades)
+
+    def find_keys(self, workers=None):
+        """Busca el archivo de clave en todas las unidades a la vez (una unidad lenta no retrasa a las demás)."""
+        unidades = self.drives()
+        if not unidades:
+            return []
+        rutas = [os.path.join(u, self.nombre_clave) for u in unidades]
+        with ThreadPoolExecutor(max_workers=workers or len(rutas)) as pool:
+            existe = list(pool.map(os.path.isfile, rutas))
+        return [r for r, e in zip(rutas, existe) if e]
+
+    def find_key(self):
+        """Ruta de la primera clave encontrada (en el orden de las unidades) o None."""
+        claves = self.find_keys()
+        return claves[0] if claves else None
+
+    def watch_key(self, key_path):
+        """Indica qué clave se está usando, para avisar si su unidad desaparece."""
+        self.key_path = os.path.abspath(key_path) if key_path else None
+
+    def key_present(self):
+        """True si la unidad de la clave vigilada sigue montada."""
+        if self.key_path is None:
+            return False
+        return any(self.key_path.startswith(os.path.join(os.path.abspath(u), '')) for u in self.drives())
+
+    def start(self):
+        if self._hilo is None:
+            self.drives()
+            self._hilo = threading.Thread(target=self._run, daemon=True, name="usb-watcher")
+            self._hilo.start()
+        return self
+
+    def _run(self):
+        while not self._parar.is_set():
+            if not self.tabla.wait(0.5):
+                continue
+            antes = self.key_present()
+            unidades = self._enumerar()
+            if self.on_change is not None:
+                self.on_change(unidades)
+            if antes and not self.key_present() and self.on_key_removed is not None:
+                self.on_key_removed(self.key_path)
+
+    def stop(self):
+        self._parar.set()
+        if self._hilo is not None:
+            self._hilo.join(timeout=2)
+            self._hilo = None
+        self.tabla.close()
@@ -0,0 +1,115 @@
+import json
+import os
+import threading
+
+import face_engine
+import storage
+
+
+REGISTRY_PATH = 'trainer/users.json'
+ETIQUETA_NUEVOS = 1000000 # Las caras de referencia usan su número de archivo (6 dígitos): los usuarios van por encima
+VAULT_POR_DEFECTO = 'passwordsList.csv'
+MASTER_POR_DEFECTO = 'master.key'
+
+
+#-------------------------------------------------------------------------------------------------------------------------------
+
+def _master_por_defecto(label):
+    # El primer usuario conserva el master.key de siempre; cada usuario nuevo tiene el suyo
+    return MASTER_POR_DEFECTO if label == face_engine.USER_LABEL else f'master.{label}.key'
+
+#-------------------------------------------------------------------------------------------------------------------------------
+
+class UserRegistry:
+    """
+    Registro de usuarios del reconocimiento facial: etiqueta del modelo LBPH -> nombre, archivo de
+    contraseñas, recortes de cara y archivo de clave maestra. Se guarda en un JSON pequeño que se
+    reescribe de forma atómica.
+    """
+
+    def __init__(self, path=REGISTRY_PATH):
+        self.path = path
+        self._usuarios = {} # etiqueta -> {'label', 'name', 'vault', 'faces', 'master'}
+        self._lock = threading.Lock()
+        self.load()
+
+    def load(self):
+        with self._lock:
+            self._usuarios = {}
+            if not os.path.exists(self.path):
+                return
+            with open(self.path, 'r', encoding='utf-8') as f:
+                for usuario in json.load(f).get('users', []):
+                    usuario.setdefault('master', _master_por_defecto(usuario['label']))
+                    self._usuarios[usuario['label']] = usuario
+
+    def _guardar(self):
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        with storage.atomic_write(self.path, 'w', encoding='utf-8') as f:
+            json.dump({'users': sorted(self._usuarios.values(), key=lambda u: u['label'])}, f, ensure_ascii=False, indent=1)
+
+    def add(self, name, vault=None, faces=None):
+        """Registra un usuario con la siguiente etiqueta libre y devuelve su entrada. Los nombres no se repiten."""
+        name = name.strip()
+        with self._lock:
+            if not name or any(u['name'] == name for u in self._usuarios.values()):
+                raise ValueError(f"Ya hay un usuario llamado '{name}'." if name else "El nombre de usuario está vacío.")
+            if not self._usuarios:
+                # El primer usuario conserva la etiqueta, las caras y el vault de siempre
+                label = face_engine.USER_LABEL
+                vault, faces = vault or VAULT_POR_DEFECTO, faces or face_engine.USER_FACES_PATH
+            else:
+                label = max(ETIQUETA_NUEVOS, max(self._usuarios) + 1)
+                vault = vault or f'passwordsList.{label}.csv'
+                faces = faces or os.path.join(os.path.dirname(face_engine.USER_FACES_PATH), f'user_faces.{label}.npz')
+            usuario = {'label': label, 'name': name, 'vault': vault, 'faces': faces, 'master': _master_por_defecto(label)}
+            self._usuarios[label] = usuario
+            self._guardar()
+            return dict(usuario)
+
+    def remove(self, label):
+        """Borra un usuario del registro (sus caras y su vault se quedan en disco). Devuelve True si existía."""
+        with self._lock:
+            if self._usuarios.pop(label, None) is None:
+                return False
+            self._guardar()
+            return True
+
+    def get(self, label):
+        usuario = self._usuarios.get(label)
+        return dict(usuario) if usuario is not None else None
+
+    def by_name(self, name):
+        for usuario in self.users():
+            if usuario['name'] == name:
+                return usuario
+        return None
+
+    def users(self):
+        """Lista de usuarios ordenada por etiqueta."""
+        with self._lock:
+            return [dict(self._usuarios[label]) for label in sorted(self._usuarios)]
+
+    def names(self):
+        """Diccionario etiqueta -> nombre (lo que necesita la verificación facial)."""
+        with self._lock:
+            return {label: usuario['name'] for label, usuario in self._usuarios.items()}
+
+    def __contains__(self, label):
+        return label in self._usuarios
+
+    def __len__(self):
+        return len(self._usuarios)
+
+#-------------------------------------------------------------------------------------------------------------------------------
+
+"""
+Función que crea el registro a partir del nombre guardado por versiones anteriores ('username.dat'),
+si aún no existe: ese usuario pasa a ser el primero, con sus caras y su vault de siempre.
+"""
+def migrate_legacy(registro, username_path='username.dat'):
+    if len(registro) or not os.path.exists(username_path):
+        return None
+    with open(username_path, 'r') as f:
+        nombre = f.read().strip()
+    return registro.add(nombre) if nombre else None
@@ -1,44 +1,123 @@
-import pandas as pd
 import os
-import hashlib
+import csv
+import io
+import itertools
+from concurrent.futures import ThreadPoolExecutor
 from cryptography.fernet import Fernet
-import cv2
-import psutil
-import numpy as np
+import face_engine
+import kdf
+import bulk_io
+import rekey
+import face_verify
+import frame_source
 import time
-from PIL import Image
+import threading
+import timing
+import storage
+import users
+from key_manager import KeyManager
+from usb_watcher import UsbWatcher
+from vault import Vault, get_vault, BinaryVault, write_binary_vault
+from search import SearchIndex
+from crypto_engine import (encrypt_many, decrypt_many, encrypt_stream, decrypt_stream, decrypt_lines, is_stream_file, is_fernet_file,
+                           decrypt_fernet_file, stream_generation)
 
 
 RUTA_CLAVE = './clave.key'
 MASTER_KEY = './master.key'
+USAR_JOURNAL = True # Las altas/bajas se añaden a un journal en lugar de reescribir el CSV
+USAR_SNAPSHOT = True # Al cifrar se guarda un vault binario para desbloquear sin descifrar el CSV
+LOTE_MASIVO = 4096 # Filas por lote al importar/exportar o guardar muchas contraseñas
+CIFRADO_EN_REPOSO = True # El CSV nunca se descifra en disco: el vault lee y escribe directamente el contenedor cifrado
 
 
 #------------------------------------------------------------------------------------------------------------------------------
 
-"""Cargar la clave de cifrado desde un archivo"""
-def cargar_clave(path=RUTA_CLAVE):
-    with open(path, 'rb') as f:
-        return f.read()
+_claves = KeyManager() # Clave de la sesión: el USB solo se lee la primera vez o si el archivo cambia
+
+"""Cargar la clave de cifrado desde un archivo (se lee del USB una vez por sesión)"""
+def cargar_clave(path=None, permitir_ausente=False):
+    return _claves.key(path or RUTA_CLAVE, permitir_ausente)
+
+"""Obtener el objeto Fernet (o MultiFernet) de la sesión, sin volver a leer ni construir nada"""
+def cargar_fernet(path=None, permitir_ausente=False):
+    return _claves.fernet(path or RUTA_CLAVE, permitir_ausente)
+
+"""Función que indica si hay una clave de sesión en memoria (p.ej. para cifrar al bloquear con el USB ya retirado)"""
+def session_key_loaded():
+    return _claves.loaded
+
+"""Olvidar la clave de la sesión (al bloquear o cerrar la aplicación)"""
+def olvidar_clave():
+    _claves.wipe()
     
 #------------------------------------------------------------------------------------------------------------------------------
 
+"""
+Función para obtener el vault de un archivo, activando el journal si está habilitado. Con el cifrado
+en reposo el vault usa la clave de la sesión (la de 'clave_path' o la ya cargada) para leer y escribir el archivo.
+"""
+@timing.timed('vault.open')
+def open_vault(filename='passwordsList.csv', fernet=None, clave_path=None):
+    clave = cargar_clave(clave_path or _claves.path, permitir_ausente=True) if CIFRADO_EN_REPOSO else None
+    vault = get_vault(filename, clave)
+    if USAR_JOURNAL and vault.journal is None:
+        vault.enable_journal(fernet or cargar_fernet())
+    return vault
+
+"""
+Función para reservar el archivo de contraseñas para esta instancia del gestor durante toda la sesión.
+Lanza VaultLockedError si otra instancia ya lo tiene abierto.
+"""
+def reservar_archivo(filename='passwordsList.csv'):
+    storage.writer_lock(filename).acquire(timeout=0)
+
+"""Función para liberar el archivo de contraseñas al cerrar la aplicación"""
+def liberar_archivo(filename='passwordsList.csv'):
+    storage.writer_lock(filename).release()
+
+#------------------------------------------------------------------------------------------------------------------------------
+
+_indices_busqueda = {} # Ruta absoluta del CSV -> SearchIndex construido en esta sesión
+
+"""
+Función para construir el índice de búsqueda de un vault (Vault o BinaryVault). Los usuarios
+se descifran en paralelo una sola vez; después el índice se mantiene al guardar y borrar.
+"""
+@timing.timed('search.build_index')
+def build_search_index(filename, vault, clave, workers=None):
+    filas = list(vault.items())
+    usuarios = decrypt_many(clave, [user for _, user, _ in filas], workers=workers, ignorar_errores=True)
+    indice = SearchIndex()
+    indice.add_many((site, user) for (site, _, _), user in zip(filas, usuarios))
+    _indices_busqueda[os.path.abspath(filename)] = indice
+    return indice
+
+"""Función para descartar el índice de búsqueda (contiene usuarios en claro) al bloquear"""
+def drop_search_index(filename='passwordsList.csv'):
+    _indices_busqueda.pop(os.path.abspath(filename), None)
+
+def _actualizar_indice(filename, site, user, borrar=False):
+    indice = _indices_busqueda.get(os.path.abspath(filename))
+    if indice is None:
+        return
+    if borrar:
+        indice.remove(site)
+    else:
+        indice.add(site, user)
+
+#------------------------------------------------------------------------------------------------------------------------------
+
 """Funcion para guardar contraseñas en un archivo CSV cifradas"""
 def save_passwords_to_csv(site, user, password, fernet, filename='passwordsList.csv'):
     password_cifrada = fernet.encrypt(password.encode()).decode()
     user_cifrado = fernet.encrypt(user.encode()).decode()
-    nueva_fila = {'SITE': site, 'USER': user_cifrado, 'PASSWORD': password_cifrada}
-
-    if os.path.exists(filename):
-        ensure_passwords_file('passwordsList.csv')
-        df = pd.read_csv(filename)
-        if site in df['SITE'].values:
-            df.loc[df['SITE'] == site, ['USER', 'PASSWORD']] = [user_cifrado, password_cifrada]
-        else:
-            df = pd.concat([df, pd.DataFrame([nueva_fila])], ignore_index=True)
-    else:
-        df = pd.DataFrame([nueva_fila])
 
-    df.to_csv(filename, index=False)
+    ensure_passwords_file(filename)
+    vault = open_vault(filename, fernet)
+    vault.put(site, user_cifrado, password_cifrada)
+    vault.save()
+    _actualizar_indice(filename, site, user)
     print(f"Contraseña guardada para el sitio '{site}'.")
     return True
 
@@ -47,14 +126,11 @@ def save_passwords_to_csv(site, user, password, fernet, filename='passwordsList.
 """Funcion para consultar contraseñas"""
 def consult_passwords(site, filename='passwordsList.csv'):
     if os.path.exists(filename):
-        ensure_passwords_file('passwordsList.csv')
-        df = pd.read_csv(filename)
-        if site in df['SITE'].values:
-            row = df[df['SITE'] == site].iloc[0]
-            user_cifrado = row['USER']
-            password_cifrada = row['PASSWORD']
-            clave = cargar_clave(RUTA_CLAVE)
-            fernet = Fernet(clave)
+        ensure_passwords_file(filename)
+        entrada = open_vault(filename).get(site)
+        if entrada is not None:
+            user_cifrado, password_cifrada = entrada
+            fernet = cargar_fernet()
             user = fernet.decrypt(user_cifrado.encode()).decode()
             password = fernet.decrypt(password_cifrada.encode()).decode()
             return {'SITE': site, 'USER': user, 'PASSWORD': password}
@@ -64,23 +140,165 @@ def consult_passwords(site, filename='passwordsList.csv'):
 
 #------------------------------------------------------------------------------------------------------------------------------
 
-"""Funcion para asegurar que el archivo de contraseñas existe y tiene los encabezados correctos"""
-def ensure_passwords_file(filename='passwordsList.csv'):
-    if not os.path.exists(filename) or os.stat(filename).st_size == 0:
-        # Crear archivo con encabezados
-        with open(filename, 'w') as f:
+def _lotes(iterable, n):
+    it = iter(iterable)
+    while True:
+        lote = list(itertools.islice(it, n))
+        if not lote:
+            return
+        yield lote
+
+"""
+Funcion para guardar muchas contraseñas de golpe. 'entradas' puede ser un generador de (site, user,
+password) en claro: se cifran por lotes en paralelo (sin tener todo el texto en claro en memoria) y
+se escriben una sola vez al final.
+"""
+@timing.timed('bulk.save_many')
+def save_many_passwords(entradas, clave, filename='passwordsList.csv', workers=None, tam_lote=LOTE_MASIVO, progreso=None):
+    indice = _indices_busqueda.get(os.path.abspath(filename))
+    cifradas, usuarios = [], []
+    with ThreadPoolExecutor(max_workers=workers or os.cpu_count() or 1) as pool:
+        for lote in _lotes(entradas, tam_lote):
+            campos = [valor for _, user, password in lote for valor in (user, password)]
+            tokens = encrypt_many(clave, campos, pool=pool)
+            cifradas.extend((site, tokens[2 * i], tokens[2 * i + 1]) for i, (site, _, _) in enumerate(lote))
+            if indice is not None:
+                usuarios.extend((site, user) for site, user, _ in lote)
+            if progreso is not None:
+                progreso(len(cifradas), None)
+
+    ensure_passwords_file(filename)
+    vault = open_vault(filename, Fernet(clave))
+    vault.put_many(cifradas)
+    if indice is not None:
+        indice.add_many(usuarios)
+    print(f"{len(cifradas)} contraseñas guardadas.")
+    return len(cifradas)
+
+#------------------------------------------------------------------------------------------------------------------------------
+
+"""
+Generador de todas las contraseñas como diccionarios {'SITE', 'USER', 'PASSWORD'}, descifradas por
+lotes en paralelo. Los campos corruptos valen None.
+"""
+def iter_all_passwords(filename='passwordsList.csv', clave_path=None, workers=None, tam_lote=LOTE_MASIVO):
+    if not os.path.exists(filename):
+        print("El archivo de contraseñas no existe.")
+        return
+    ensure_passwords_file(filename)
+    clave = cargar_clave(clave_path)
+    filas = open_vault(filename, cargar_fernet(clave_path)).items()
+    with ThreadPoolExecutor(max_workers=workers or os.cpu_count() or 1) as pool:
+        for lote in _lotes(filas, tam_lote):
+            campos = [token for _, user, password in lote for token in (user, password)]
+            claros = decrypt_many(clave, campos, ignorar_errores=True, pool=pool)
+            for i, (site, _, _) in enumerate(lote):
+                yield {'SITE': site, 'USER': claros[2 * i], 'PASSWORD': claros[2 * i + 1]}
+
+"""Funcion para consultar todas las contraseñas descifrándolas en paralelo"""
+def consult_all_passwords(filename='passwordsList.csv', clave_path=None, workers=None):
+    return list(iter_all_passwords(filename, clave_path, workers))
+
+#------------------------------------------------------------------------------------------------------------------------------
+
+"""
+Función para importar un volcado de contraseñas (CSV o JSON de Chrome, Firefox o Bitwarden; ver
+bulk_io). Se lee en streaming, se descartan los SITE que ya existen (o se sobrescriben) y los repetidos
+dentro del volcado, y todo se guarda con una sola escritura. Devuelve estadísticas con filas/s.
+"""
+@timing.timed('bulk.import')
+def import_passwords(path, formato=None, filename='passwordsList.csv', clave_path=None, sobrescribir=False,
+                     workers=None, progreso=None):
+    inicio = time.perf_counter()
+    stats = {'formato': formato or bulk_io.detect_format(path), 'leidas': 0, 'invalidas': 0, 'duplicadas': 0}
+    ensure_passwords_file(filename)
+    vault = open_vault(filename, cargar_fernet(clave_path))
+    vistos = set()
+
+    def nuevas():
+        for site, user, password in bulk_io.read_entries(path, stats['formato'], stats):
+            # El índice por SITE del vault dice en O(1) si ya existe, sin descifrar nada
+            if site in vistos or (not sobrescribir and site in vault):
+                stats['duplicadas'] += 1
+                continue
+            vistos.add(site)
+            yield site, user, password
+
+    stats['importadas'] = save_many_passwords(nuevas(), cargar_clave(clave_path), filename, workers, progreso=progreso)
+    stats['duracion'] = time.perf_counter() - inicio
+    stats['filas_s'] = stats['leidas'] / stats['duracion'] if stats['duracion'] else 0.0
+    print(f"Importadas {stats['importadas']} de {stats['leidas']} filas ({stats['duplicadas']} repetidas, "
+          f"{stats['invalidas']} sin sitio o contraseña) en {stats['duracion']:.2f} s.")
+    return stats
+
+"""
+Función para exportar todas las contraseñas EN CLARO a un volcado del formato indicado ('chrome',
+'firefox', 'bitwarden', 'bitwarden-json', 'apm' o 'apm-json'). Devuelve estadísticas con filas/s.
+"""
+@timing.timed('bulk.export')
+def export_passwords(path, formato='chrome', filename='passwordsList.csv', clave_path=None, workers=None):
+    inicio = time.perf_counter()
+    stats = {'formato': formato, 'corruptas': 0}
+
+    def entradas():
+        for fila in iter_all_passwords(filename, clave_path, workers):
+            if fila['USER'] is None or fila['PASSWORD'] is None:
+                stats['corruptas'] += 1
+                continue
+            yield fila['SITE'], fila['USER'], fila['PASSWORD']
+
+    stats['exportadas'] = bulk_io.write_entries(path, entradas(), formato)
+    stats['duracion'] = time.perf_counter() - inicio
+    stats['filas_s'] = stats['exportadas'] / stats['duracion'] if stats['duracion'] else 0.0
+    print(f"Exportadas {stats['exportadas']} contraseñas a {path} en {stats['duracion']:.2f} s.")
+    return stats
+
+#------------------------------------------------------------------------------------------------------------------------------
+
+def _escribir_vacio(filename, clave):
+    # Solo los encabezados; con clave, ya dentro de un contenedor cifrado (nunca queda un CSV en claro)
+    if clave is None:
+        with storage.atomic_write(filename, 'w') as f:
             f.write('SITE,USER,PASSWORD\n')
+    else:
+        with storage.atomic_write(filename, 'wb') as f:
+            encrypt_stream(io.BytesIO(b'SITE,USER,PASSWORD\n'), f, clave)
+
+"""
+Funcion para asegurar que el archivo de contraseñas existe y tiene los encabezados correctos. Con el
+cifrado en reposo se crea como contenedor cifrado vacío (con la clave de la sesión o la de 'clave_path').
+"""
+def ensure_passwords_file(filename='passwordsList.csv', clave_path=None):
+    if not os.path.exists(filename) or os.stat(filename).st_size == 0:
+        clave = cargar_clave(clave_path or _claves.path, permitir_ausente=True) if CIFRADO_EN_REPOSO else None
+        with storage.writer_lock(filename):
+            _escribir_vacio(filename, clave)
+
+"""
+Función para vaciar el archivo de contraseñas al generar una clave nueva (lo guardado ya no se puede
+descifrar). Se reescribe de forma atómica con el bloqueo de escritura (cifrado con la clave nueva si el
+cifrado en reposo está activo) y se borran el journal, el snapshot y los restos de una rotación, que
+siguen cifrados con la clave descartada.
+"""
+def reset_passwords_file(filename='passwordsList.csv', clave_path=None):
+    clave = cargar_clave(clave_path) if CIFRADO_EN_REPOSO else None
+    with storage.writer_lock(filename):
+        _escribir_vacio(filename, clave)
+        for sufijo in ('.journal', '.vault', rekey.SUFIJO_CHECKPOINT, rekey.SUFIJO_LOTES, rekey.SUFIJO_TMP):
+            if os.path.exists(filename + sufijo):
+                os.remove(filename + sufijo)
+    drop_search_index(filename)
 
 #------------------------------------------------------------------------------------------------------------------------------
 
 """Funcion para eliminar una contraseña"""
 def delete_password(site, filename='passwordsList.csv'):
     if os.path.exists(filename):
-        ensure_passwords_file('passwordsList.csv')
-        df = pd.read_csv(filename)
-        if site in df['SITE'].values:
-            df = df[df['SITE'] != site]
-            df.to_csv(filename, index=False)
+        ensure_passwords_file(filename)
+        vault = open_vault(filename)
+        if vault.delete(site):
+            vault.save()
+            _actualizar_indice(filename, site, None, borrar=True)
             print(f"Contraseña eliminada para el sitio '{site}'.")
             return True
         else:
@@ -102,25 +320,32 @@ def create_key(path='clave.key'):
 
 #------------------------------------------------------------------------------------------------------------------------------
 
-"""Funcion para generar una clave maestra"""
-def create_master_key(password, path='./master.key'):
-    hashed_password = hashlib.sha256(password.encode()).hexdigest()
-    with open(path, 'w') as f:
+"""Función para escribir el hash de la clave maestra sin dejar nunca el archivo a medias"""
+def _guardar_master_key(hashed_password, path):
+    with storage.atomic_write(path, 'w', sync=True) as f:
         f.write(hashed_password)
+
+#------------------------------------------------------------------------------------------------------------------------------
+
+"""Funcion para generar una clave maestra (KDF calibrada para tardar ~kdf.OBJETIVO_MS en esta máquina)"""
+@timing.timed('master_key.create')
+def create_master_key(password, path='./master.key'):
+    hashed_password = kdf.hash_password(password)
+    _guardar_master_key(hashed_password, path)
     MASTER_KEY = path
     print(f"Clave generada y guardada en {MASTER_KEY}.")
 
 #------------------------------------------------------------------------------------------------------------------------------
 
 """Funcion para modificar la clave maestra"""
+@timing.timed('master_key.modify')
 def modify_master_key(new_password, path=MASTER_KEY):
-    # Calcular el hash SHA-256 de la nueva contraseña
-    hashed_password = hashlib.sha256(new_password.encode()).hexdigest()
+    # Derivar el hash de la nueva contraseña con sal nueva y parámetros recalibrados
+    hashed_password = kdf.hash_password(new_password)
     
     # Escribir (sobrescribir) el hash en el archivo
     try:
-        with open(path, 'w') as f:
-            f.write(hashed_password)
+        _guardar_master_key(hashed_password, path)
         print(f"Clave maestra actualizada correctamente en '{path}'.")
     except Exception as e:
         print(f"Error al modificar la clave maestra: {e}")
@@ -129,9 +354,8 @@ def modify_master_key(new_password, path=MASTER_KEY):
 #------------------------------------------------------------------------------------------------------------------------------
 
 """Funcion para validar la clave maestra"""
+@timing.timed('master_key.validate')
 def validate_master_key(in_password, path=MASTER_KEY):
-    hashed_in_password = hashlib.sha256(in_password.encode()).hexdigest()
-
     if not os.path.exists(path):
         print("El archivo con la clave maestra no existe.")
         return False
@@ -140,37 +364,128 @@ def validate_master_key(in_password, path=MASTER_KEY):
         with open(path, 'r') as f:
             stored_hash = f.read().strip()
 
-        return hashed_in_password == stored_hash
+        if not kdf.verify_password(in_password, stored_hash):
+            return False
     except Exception as e:
         print(f"Error al validar la clave maestra: {e}")
         return False
 
+    # Migración transparente: un master.key antiguo (SHA-256 sin sal) o con coste insuficiente se
+    # regenera con la KDF actual ahora que conocemos la contraseña
+    if kdf.needs_rehash(stored_hash):
+        try:
+            _guardar_master_key(kdf.hash_password(in_password), path)
+            print("Clave maestra migrada a la KDF actual.")
+        except Exception as e:
+            print(f"No se pudo migrar la clave maestra: {e}")
+    return True
+
 #------------------------------------------------------------------------------------------------------------------------------
 
-"""Función para cifrar el archivo CSV de contraseñas"""
-def cifrar_csv(filename='passwordsList.csv', clave_path=RUTA_CLAVE):
-    # Cargar la clave de cifrado
-    clave = cargar_clave(clave_path)
-    fernet = Fernet(clave)
-    
-    # Leer el contenido del CSV como texto
-    with open(filename, 'rb') as file:
-        contenido = file.read()
-    
-    # Cifrar el contenido
-    contenido_cifrado = fernet.encrypt(contenido)
-    
-    # Sobrescribir el archivo con el contenido cifrado
-    with open(filename, 'wb') as file:
-        file.write(contenido_cifrado)
+def _snapshot_al_dia(filename, clave, generacion):
+    try:
+        snapshot = BinaryVault(filename + '.vault', clave)
+    except Exception:
+        return False
+    try:
+        return snapshot.generation == generacion
+    finally:
+        snapshot.close()
+
+"""
+Función para cifrar el archivo CSV de contraseñas. Con el cifrado en reposo el archivo ya está
+cifrado: solo se vuelca el journal y se rehace el snapshot si ha quedado desfasado. Un archivo del
+formato anterior (un único token Fernet) se migra al contenedor por segmentos.
+"""
+@timing.timed('vault.encrypt_file')
+def cifrar_csv(filename='passwordsList.csv', clave_path=None):
+    # Cargar la clave de cifrado (la de la sesión sirve aunque se haya retirado el USB: hay que cifrar igual)
+    clave = cargar_clave(clave_path, permitir_ausente=True)
+    fernet = cargar_fernet(clave_path, permitir_ausente=True)
+
+    with storage.writer_lock(filename):
+        if os.path.exists(filename) and is_fernet_file(filename):
+            # Formato de versiones anteriores: se pasa al contenedor sin tratar nunca el token como CSV en claro
+            with storage.atomic_write(filename, 'wb') as fout:
+                encrypt_stream(io.BytesIO(decrypt_fernet_file(filename, clave)), fout, clave)
+            print(f"Archivo {filename} migrado al formato por segmentos.")
+
+        # Volcar el journal pendiente en el CSV para que no quede nada fuera del archivo cifrado
+        if USAR_JOURNAL and os.path.exists(filename + '.journal'):
+            vault = open_vault(filename, fernet, clave_path)
+            vault.compact()
+            vault.close()
+
+        # Ya cifrado (en reposo o recién migrado): solo falta rehacer el snapshot si está desfasado
+        if os.path.exists(filename) and is_stream_file(filename):
+            generacion = stream_generation(filename)
+            if USAR_SNAPSHOT and not _snapshot_al_dia(filename, clave, generacion):
+                vault = get_vault(filename, clave) if CIFRADO_EN_REPOSO else Vault(filename, clave)
+                write_binary_vault(filename + '.vault', list(vault.items()), clave, generacion)
+            return
+
+        # Cogemos las entradas antes de cifrar para poder escribir después el snapshot binario
+        vault = get_vault(filename, clave if CIFRADO_EN_REPOSO else None)
+        entradas = list(vault.items()) if USAR_SNAPSHOT else None
+
+        # Cifrar por segmentos hacia un temporal (fsync + rename): la memoria no depende del tamaño del archivo
+        with open(filename, 'rb') as fin, storage.atomic_write(filename, 'wb') as fout:
+            encrypt_stream(fin, fout, clave)
+
+        # Snapshot de solo lectura ligado a esta versión del archivo cifrado (desbloqueo instantáneo)
+        if USAR_SNAPSHOT:
+            write_binary_vault(filename + '.vault', entradas, clave, stream_generation(filename))
     
     print(f"Archivo {filename} cifrado exitosamente.")
 
 #-------------------------------------------------------------------------------------------------------------------------------
 
+"""
+Función para abrir el snapshot binario (mmap) del archivo cifrado sin descifrarlo.
+Devuelve None si no existe, no corresponde a la versión actual del archivo o la clave no es válida.
+"""
+@timing.timed('vault.open_snapshot')
+def open_snapshot(filename='passwordsList.csv', clave_path=None):
+    snapshot = filename + '.vault'
+    generacion = stream_generation(filename)
+    if not USAR_SNAPSHOT or generacion is None or not os.path.exists(snapshot):
+        return None
+    try:
+        vault = BinaryVault(snapshot, cargar_clave(clave_path))
+    except Exception as e:
+        print(f"No se pudo abrir el snapshot {snapshot}: {e}")
+        return None
+    if vault.generation != generacion:
+        # El CSV se ha vuelto a cifrar después de escribir el snapshot: está desfasado
+        vault.close()
+        return None
+    return vault
+
+#-------------------------------------------------------------------------------------------------------------------------------
+
 """Función para descifrar el archivo CSV de contraseñas"""
-def descifrar_csv(filename='passwordsList.csv', clave_path=RUTA_CLAVE):
+@timing.timed('vault.decrypt_file')
+def descifrar_csv(filename='passwordsList.csv', clave_path=None):
     clave = cargar_clave(clave_path)
+
+    if not is_stream_file(filename):
+        return _descifrar_csv_fernet(filename, clave)
+
+    # El contenido descifrado solo sustituye al archivo cuando todos los segmentos se han autenticado
+    try:
+        with storage.writer_lock(filename), open(filename, 'rb') as fin, storage.atomic_write(filename, 'wb') as fout:
+            for segmento in decrypt_stream(fin, clave):
+                fout.write(segmento)
+    except Exception as e:
+        print("Error al descifrar:", e)
+        return
+    
+    print(f"Archivo {filename} descifrado exitosamente.")
+
+#-------------------------------------------------------------------------------------------------------------------------------
+
+"""Función para descifrar archivos en el formato antiguo (un único token Fernet con todo el CSV)"""
+def _descifrar_csv_fernet(filename, clave):
     fernet = Fernet(clave)
 
     with open(filename, 'rb') as file:
@@ -183,203 +498,267 @@ def descifrar_csv(filename='passwordsList.csv', clave_path=RUTA_CLAVE):
         return
 
     # Guardar el contenido descifrado como texto
-    with open(filename, 'w', encoding='utf-8') as file:
+    with storage.writer_lock(filename), storage.atomic_write(filename, 'w', encoding='utf-8') as file:
         file.write(contenido)
     
     print(f"Archivo {filename} descifrado exitosamente.")
 
+#-------------------------------------------------------------------------------------------------------------------------------
+
+"""
+Función para rotar la clave del USB (ver rekey.rotate_key). El archivo de contraseñas tiene que estar
+cifrado. Hasta que se bloquee la sesión la clave anterior se sigue aceptando para descifrar, así los
+tokens que la interfaz ya tenía cargados siguen funcionando.
+"""
+@timing.timed('rekey.rotate')
+def rotar_clave(filename='passwordsList.csv', clave_path=None, **opciones):
+    clave_path = clave_path or RUTA_CLAVE
+    anterior = cargar_clave(clave_path)
+    with storage.writer_lock(filename):
+        stats = rekey.rotate_key(filename, clave_path, anterior, snapshot=USAR_SNAPSHOT, **opciones)
+    if stats['completada']:
+        _claves.add_previous(anterior)
+        print(f"Clave de {filename} rotada: {stats['filas']} entradas.")
+    return stats
+
+"""Función para terminar al arrancar una rotación de clave que se cortó en el cambio final de archivos"""
+@timing.timed('rekey.recover')
+def recuperar_rotacion(filename='passwordsList.csv', clave_path=None):
+    with storage.writer_lock(filename):
+        return rekey.recover(filename, clave_path or RUTA_CLAVE)
+
+"""Función para que el journal (y el archivo, con cifrado en reposo) del vault abierto use la clave actual (tras rotarla)"""
+def reset_journal_key(filename='passwordsList.csv', clave_path=None):
+    vault = get_vault(filename, cargar_clave(clave_path) if CIFRADO_EN_REPOSO else None)
+    if vault.journal is not None:
+        vault.journal.fernet = cargar_fernet(clave_path)
+
+#-------------------------------------------------------------------------------------------------------------------------------
+
+"""Generador de filas (SITE, USER, PASSWORD) de un CSV cifrado, sin descifrarlo entero ni tocar el disco"""
+def iter_encrypted_csv(filename='passwordsList.csv', clave_path=None):
+    clave = cargar_clave(clave_path)
+    with open(filename, 'rb') as fin:
+        reader = csv.reader(decrypt_lines(fin, clave))
+        next(reader, None) # Saltamos la cabecera
+        for row in reader:
+            yield row
+
 #------------------------------------------------------------------------------------------------------------------------------
 
-"""Función para capturar imágenes de la cara del usuario y guardarlas en un directorio"""
-def create_dataset(face_detector):
-    # Crear el directorio para guardar las imágenes si no existe
-    if not os.path.exists('faces'):
-        os.makedirs('faces')
+"""
+Función para capturar la cara del usuario. Los recortes se guardan en memoria y, al terminar, se
+quedan los 'muestras' mejores (nítidos y variados) en un único archivo (face_engine.USER_FACES_PATH).
+'source' es cualquier fuente de frame_source (por defecto, la cámara: la reproducción es solo para benchmarks)
+y 'cancelado' (threading.Event) / 'progreso' (callable) permiten a la GUI abortar y seguir la captura.
+Devuelve estadísticas de la captura (frames, latencia de detección, tiempo total).
+"""
+@timing.timed('face.capture')
+def create_dataset(face_detector, source=None, muestras=face_engine.MUESTRAS_USUARIO, candidatos=100, mostrar=True,
+                   user_faces_path=face_engine.USER_FACES_PATH, cancelado=None, progreso=None):
+    import cv2 # Importación diferida: OpenCV solo se carga si se usa el reconocimiento facial
 
     # Iniciar la captura de video
-    cam = cv2.VideoCapture(0, cv2.CAP_DSHOW)
-    cam.set(3, 640) 
-    cam.set(4, 480) 
-
+    cam = source if source is not None else frame_source.CameraSource()
 
     print("\n Inicializando captura de cara. Mira a la cámara y espera ...")
 
-    # Inicializar el contador de imágenes capturadas
-    count = 0
+    # Recortes capturados (candidatos); se eligen los mejores al final
+    recortes = []
+    frames = 0
+    detecciones = []
+    inicio = time.perf_counter()
 
     while True:
         ret, img = cam.read()
         if not ret:
             print("Error: No se pudo capturar la imagen de la cámara.")
             break
+        frames += 1
             
         # Convertir la imagen a escala de grises (es mejor para el reconocimiento)
+        t0 = time.perf_counter()
         gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
         
         # Detectar caras en la imagen
         faces = face_detector.detectMultiScale(gray, 1.3, 5)
+        detecciones.append(time.perf_counter() - t0)
 
-        for (x, y, w, h) in faces:
-            # Dibujar un rectángulo alrededor de la cara
+        if len(faces):
+            # Nos quedamos con la cara más grande: las de fondo no son del usuario
+            x, y, w, h = max(faces, key=lambda c: c[2] * c[3])
             cv2.rectangle(img, (x, y), (x + w, y + h), (255, 0, 0), 2)
-            count += 1
-
-            # Guardar la imagen de la cara capturada en la carpeta 'faces'
-            cv2.imwrite(os.path.join("faces", f"User.1.{count}.jpg"), gray[y:y+h, x:x+w])
+            recortes.append(gray[y:y+h, x:x+w].copy())
+            if progreso is not None:
+                progreso(len(recortes), candidatos)
 
             # Mostrar la imagen en una ventana
-            cv2.imshow('image', img)
+            if mostrar:
+                cv2.imshow('image', img)
 
-        # Esperar 100 ms o hasta que se presione la tecla ESC
-        k = cv2.waitKey(100) & 0xff
-        if k == 27: # Tecla ESC para salir
+        if len(recortes) >= candidatos:
+            break
+        if cancelado is not None and cancelado.is_set(): # Cancelado desde la GUI: no se guarda nada
+            recortes = []
             break
-        elif count >= 50: # Tomar 50 muestras de la cara y salir
+        # Esperar 50 ms o hasta que se presione la tecla ESC
+        if mostrar and (cv2.waitKey(50) & 0xff) == 27: # Tecla ESC para salir
             break
 
     print("\n Saliendo del programa y limpiando...")
-    cam.release()
-    cv2.destroyAllWindows()
+    if source is None:
+        cam.release()
+    if mostrar:
+        cv2.destroyAllWindows()
+
+    t0 = time.perf_counter()
+    with timing.span('face.select_crops', candidatos=len(recortes)):
+        guardados = len(face_engine.store_user_faces(recortes, muestras, user_faces_path)) if recortes else 0
+    t_seleccion = time.perf_counter() - t0
+    timing.count('frames', frames)
+
+    duracion = time.perf_counter() - inicio
+    return {
+        'candidatos': len(recortes),
+        'muestras': guardados,
+        'frames': frames,
+        'duracion': duracion,
+        'seleccion': t_seleccion,
+        'fps': frames / duracion if duracion else 0.0,
+        'deteccion_p50_ms': timing.percentil(detecciones, 50) * 1000,
+        'deteccion_p95_ms': timing.percentil(detecciones, 95) * 1000,
+    }
+
+#------------------------------------------------------------------------------------------------------------------------------
+
+_registro = None
+_registro_lock = threading.Lock() # La GUI y los workers pueden pedirlo a la vez: migrate_legacy solo debe correr una vez
+
+"""
+Función para obtener el registro de usuarios del reconocimiento facial (uno por proceso). La primera
+vez se registra el usuario único de versiones anteriores ('username.dat'), con sus caras y su vault.
+"""
+def user_registry():
+    global _registro
+    if _registro is None:
+        with _registro_lock:
+            if _registro is None:
+                registro = users.UserRegistry()
+                users.migrate_legacy(registro)
+                _registro = registro # Se publica ya migrado: nadie ve el registro a medias
+    return _registro
+
+"""Función para registrar un usuario nuevo (con su etiqueta, su archivo de caras y su archivo de contraseñas)"""
+def add_face_user(name):
+    usuario = user_registry().add(name)
+    print(f"Usuario '{usuario['name']}' registrado con la etiqueta {usuario['label']}.")
+    return usuario
+
+def _usuarios_modelo():
+    return [(u['label'], u['faces']) for u in user_registry().users()]
 
 #------------------------------------------------------------------------------------------------------------------------------
 
 """Funcion para entrenar el reconocedor de caras usando las imágenes capturadas y un dataset de caras"""
+@timing.timed('face.train')
 def train_face_recognizer():
-    # Ruta a la carpeta con las imágenes de las caras
-    path = 'faces'
-
-    # Crear el reconocedor usando el algoritmo LBPH
-    recognizer = cv2.face.LBPHFaceRecognizer_create()
-    detector = cv2.CascadeClassifier("haarcascade_frontalface_default.xml")
-
-    # Función para obtener las imágenes y las etiquetas
-    def getImagesAndLabels(path):
-        imagePaths = [os.path.join(path, f) for f in os.listdir(path)]
-        faceSamples = []
-        ids = []
-
-        for imagePath in imagePaths:
-            # Abrir la imagen y convertirla a escala de grises
-            PIL_img = Image.open(imagePath).convert('L') 
-            img_numpy = np.array(PIL_img, 'uint8')
-
-            # Extraer el ID de usuario del nombre del archivo
-            filename = os.path.basename(imagePath)  
-
-            if filename.startswith("User"):
-                # Caso especial: 
-                id = int(os.path.split(imagePath)[-1].split(".")[1])
-            else:
-                # En cualquier otro caso, usamos el nombre del archivo (sin extensión)
-                id_str = os.path.splitext(filename)[0]  
-                id = int(id_str)   
-                
-            # Detectar la cara en la imagen
-            faces = detector.detectMultiScale(img_numpy)
-
-            for (x, y, w, h) in faces:
-                faceSamples.append(img_numpy[y:y+h, x:x+w])
-                ids.append(id)
-
-        return faceSamples, ids
-
+    # Los recortes de las imágenes de referencia se cachean: solo se procesan las capturas nuevas
     print("\n Entrenando el modelo con las caras. Esto puede tardar unos segundos. Espera...")
-    faces, ids = getImagesAndLabels(path)
-    recognizer.train(faces, np.array(ids))
+    _, n_caras = face_engine.train_face_recognizer('faces', 'trainer/trainer.yml', usuarios=_usuarios_modelo())
 
-    # Crear la carpeta 'trainer' si no existe
-    if not os.path.exists('trainer'):
-        os.makedirs('trainer')
+    print(f"\n {n_caras} caras entrenadas. Saliendo del programa.")
 
-    # Guardar el modelo entrenado
-    recognizer.write('trainer/trainer.yml')
+#------------------------------------------------------------------------------------------------------------------------------
 
-    print(f"\n {len(np.unique(ids))} caras entrenadas. Saliendo del programa.")
+_reconocedor = None # Reconocedor con todos los usuarios ya cargado en esta sesión
+_reconocedor_lock = threading.Lock()
+
+"""
+Funcion para actualizar el reconocedor con las nuevas capturas de un usuario (por defecto, el primero)
+sin reentrenar las caras de referencia. Devuelve el reconocedor con todos los usuarios registrados.
+"""
+@timing.timed('face.enroll')
+def update_face_recognizer(etiqueta=None):
+    global _reconocedor
+    print("\n Actualizando el modelo con las nuevas capturas del usuario...")
+    usuario = user_registry().get(etiqueta) if etiqueta is not None else None
+    faces_path = usuario['faces'] if usuario is not None else face_engine.USER_FACES_PATH
+    etiqueta = usuario['label'] if usuario is not None else face_engine.USER_LABEL
+    usuarios = _usuarios_modelo() or [(etiqueta, faces_path)]
+    recognizer = face_engine.enroll_user(path='faces', user_faces_path=faces_path, usuarios=usuarios)
+    with _reconocedor_lock:
+        _reconocedor = recognizer
+    print("\n Modelo actualizado.")
+    return recognizer
 
 #------------------------------------------------------------------------------------------------------------------------------
 
-"""Función para verificar el rostro del usuario usando la cámara """
-def verify_face(username, faceCascade, recognizer):
-    font = cv2.FONT_HERSHEY_SIMPLEX
-    names = ['None', username] 
-    cam = cv2.VideoCapture(00, cv2.CAP_DSHOW)
-    cam.set(3, 640) 
-    cam.set(4, 480) 
-    minW = 0.1 * cam.get(3)
-    minH = 0.1 * cam.get(4)
-    
-    recognized_id = 0 
-    recognized_time = None
+"""
+Funcion para cargar el reconocedor entrenado (modelo base + usuarios, o trainer.yml completo). Es un
+único modelo con todos los usuarios registrados: al verificar a uno, la cara de otro usuario se predice
+con la etiqueta de ese otro y no se acepta (con un modelo por usuario podría confundirse con él).
+"""
+@timing.timed('face.load_model')
+def load_face_recognizer():
+    global _reconocedor
+    with _reconocedor_lock:
+        if _reconocedor is None:
+            _reconocedor = face_engine.load_recognizer(usuarios=_usuarios_modelo())
+        return _reconocedor
 
-    while True:
-        ret, img = cam.read()
-        if not ret:
-            print("Error: No se pudo acceder a la cámara.")
-            break
-
-        gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-        faces = faceCascade.detectMultiScale(
-            gray,
-            scaleFactor=1.2,
-            minNeighbors=5,
-            minSize=(int(minW), int(minH)),
-        )
-
-        for (x, y, w, h) in faces:
-            cv2.rectangle(img, (x, y), (x + w, y + h), (0, 255, 0), 2)
-            id, confidence = recognizer.predict(gray[y:y+h, x:x+w])
-            
-            confidence_threshold = 60
-
-            #Comprueba si la confianza es suficientemente buena (valor bajo) Y si el ID es el correcto (1)
-            if confidence < confidence_threshold and id == 1:
-                id_name = names[id] # Asigna nombre de usuario
-                
-                # Si es la primera vez que te reconoce, guarda el tiempo
-                if recognized_time is None:
-                    recognized_time = time.time()
-                    recognized_id = 1 # Guarda el ID correcto para devolverlo al final
-            else:
-                # Si la confianza es mala (valor alto) o el ID no es 1, es un desconocido
-                id_name = "Unknown"
-                recognized_id = 0 
-
-            # Mostrar el nombre 
-            cv2.putText(img, str(id_name), (x + 5, y - 5), font, 1, (255, 255, 255), 2)
-
-        cv2.imshow('camera', img)
-
-        # Si han pasado 3 segundos desde un reconocimiento exitoso, salimos
-        if recognized_time is not None and (time.time() - recognized_time) >= 3:
-            print(f"\nUsuario {username} reconocido. Cerrando...")
-            break
+#------------------------------------------------------------------------------------------------------------------------------
 
-        k = cv2.waitKey(10) & 0xff 
-        if k == 27: # Salir con la tecla ESC
-            recognized_id = 0 # Si el usuario sale manualmente, no se considera exitoso
-            break
+"""
+Función para verificar la cara de un usuario. 'usuarios' es un diccionario etiqueta -> nombre con los
+usuarios aceptados (o un nombre, para el usuario único); el reconocedor debe tener a todos los usuarios
+registrados para que solo se acepte la etiqueta predicha si es una de ellas. La captura va en su propio
+hilo y la detección se limita a la zona de la última cara (ver face_verify). Devuelve la etiqueta reconocida o 0.
+"""
+@timing.timed('face.verify')
+def verify_face(usuarios, faceCascade, recognizer, source=None, mostrar=True, **opciones):
+    cam = source if source is not None else frame_source.CameraSource()
+    try:
+        recognized_id, stats = face_verify.verify(usuarios, faceCascade, recognizer, cam, mostrar=mostrar, **opciones)
+    finally:
+        if source is None:
+            cam.release()
 
     print("\n Saliendo del programa.")
-    cam.release()
-    cv2.destroyAllWindows()
+    face_verify.print_stats(stats)
+    for contador in ('frames_procesados', 'frames_descartados', 'predicts', 'detecciones_roi', 'detecciones_completas'):
+        timing.count(contador, stats[contador])
     
     # Devuelve el ID solo si el reconocimiento fue exitoso y continuo
     return recognized_id
 #------------------------------------------------------------------------------------------------------------------------------
 
-"""Función para detectar unidades USB conectadas"""
+_usb = None
+
+"""Función para obtener el vigilante de unidades USB (uno por proceso, con la enumeración en caché)"""
+def usb_watcher():
+    global _usb
+    if _usb is None:
+        _usb = UsbWatcher()
+    return _usb
+
+"""Función para detectar unidades USB conectadas (solo se vuelven a enumerar si cambian los montajes)"""
+@timing.timed('usb.detect')
 def detectar_usb():
-    usb_paths = []
-    partitions = psutil.disk_partitions(all=False)
-    for p in partitions:
-        if 'removable' in p.opts.lower():  # Filtrar unidades extraíbles
-            usb_paths.append(p.device)
-    return usb_paths
+    return usb_watcher().drives()
+
+"""Función para buscar 'clave.key' en todas las unidades USB a la vez. Devuelve la ruta o None"""
+@timing.timed('usb.find_key')
+def buscar_clave_usb():
+    return usb_watcher().find_key()
 
 #------------------------------------------------------------------------------------------------------------------------------
 
 """Funcion para borrar las antiguas imágenes de usuario en la carpeta 'faces'"""
 def delete_user_images(folder="faces"):
+    # Recortes del usuario ya filtrados (formato actual)
+    if os.path.exists(face_engine.USER_FACES_PATH):
+        os.remove(face_engine.USER_FACES_PATH)
+
     if not os.path.exists(folder):
         print(f"La carpeta '{folder}' no existe.")
         return
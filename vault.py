@@ -0,0 +1,527 @@
+import base64
+import csv
+import hashlib
+import hmac
+import io
+import itertools
+import json
+import mmap
+import os
+import struct
+import threading
+from collections import OrderedDict
+
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+
+import storage
+import timing
+from crypto_engine import derive_subkey, decrypt_lines, encrypt_stream, is_stream_file, is_fernet_file, decrypt_fernet_file
+
+
+COLUMNAS = ['SITE', 'USER', 'PASSWORD']
+COMPACTAR_CADA = 500 # Número de registros en el journal que disparan la compactación
+
+# Formato binario (snapshot de solo lectura que se guarda junto al CSV cifrado):
+# cabecera | índice ordenado por HMAC(SITE) | orden de visualización | nombres cifrados | registros
+MAGIC_BINARIO = b'APMV'
+VERSION_BINARIO = 2
+_CABECERA = struct.Struct('>4sBI7s16sQQQQ') # magic, versión, nº entradas, generación, comprobación de clave, offsets de índice/orden/nombres/registros
+_ENTRADA = struct.Struct('>16sIHQII') # HMAC del SITE, offset nombre, longitud nombre, offset registro, longitud USER, longitud PASSWORD
+_ORDEN = struct.Struct('>I')
+_SIN_GENERACION = bytes(7)
+
+#-------------------------------------------------------------------------------------------------------------------------------
+
+class Journal:
+    """
+    Registro de solo-añadido con las mutaciones del vault. Cada línea es un
+    token Fernet con una operación en JSON, así que escribir una entrada cuesta
+    O(1) y un corte a mitad de escritura solo puede dañar el último registro.
+    """
+
+    def __init__(self, path, fernet, sync=True):
+        self.path = path
+        self.fernet = fernet
+        self.sync = sync # fsync tras cada registro para que sobreviva a un corte de luz
+        self.count = 0 # Registros pendientes de compactar
+        self._f = None
+
+    def append(self, op, site, user=None, password=None):
+        """Añade una operación ('put' o 'del') al final del journal."""
+        registro = json.dumps({'op': op, 'site': site, 'user': user, 'password': password})
+        token = self.fernet.encrypt(registro.encode())
+        if self._f is None:
+            self._f = open(self.path, 'ab')
+        self._f.write(token + b'\n')
+        self._f.flush()
+        if self.sync:
+            os.fsync(self._f.fileno())
+        self.count += 1
+
+    def replay(self, entries):
+        """
+        Aplica sobre 'entries' todas las operaciones guardadas en el journal.
+        Devuelve False si encontró un registro dañado.
+        """
+        self.count = 0
+        if not os.path.exists(self.path):
+            return True
+        with open(self.path, 'rb') as f:
+            for linea in f:
+                try:
+                    registro = json.loads(self.fernet.decrypt(linea.strip()))
+                except Exception:
+                    # Registro incompleto (corte a mitad de escritura): lo ignoramos y paramos aquí
+                    print(f"Registro dañado en {self.path}, se descarta el resto del journal.")
+                    return False
+                if registro['op'] == 'put':
+                    entries[registro['site']] = (registro['user'], registro['password'])
+                else:
+                    entries.pop(registro['site'], None)
+                self.count += 1
+        return True
+
+    def truncate(self):
+        """Vacía el journal una vez que su contenido ya está en el archivo base."""
+        self.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        self.count = 0
+
+    def close(self):
+        if self._f is not None:
+            self._f.close()
+            self._f = None
+
+
+#-------------------------------------------------------------------------------------------------------------------------------
+
+class CsvRowsReader:
+    """Adaptador con read(n) que va serializando filas a CSV según se piden (para encrypt_stream)."""
+
+    def __init__(self, filas, filas_por_bloque=256):
+        self._filas = iter(filas)
+        self.filas_por_bloque = filas_por_bloque
+        self._buffer = bytearray()
+        self._texto = io.StringIO()
+        self._writer = csv.writer(self._texto)
+        self._writer.writerow(COLUMNAS)
+
+    def _rellenar(self):
+        for fila in itertools.islice(self._filas, self.filas_por_bloque):
+            self._writer.writerow(fila)
+        texto = self._texto.getvalue()
+        self._texto.seek(0)
+        self._texto.truncate()
+        self._buffer += texto.encode('utf-8')
+        return bool(texto)
+
+    def read(self, n):
+        while len(self._buffer) < n and self._rellenar():
+            pass
+        datos = bytes(self._buffer[:n])
+        del self._buffer[:n]
+        return datos
+
+#-------------------------------------------------------------------------------------------------------------------------------
+
+class Vault:
+    """
+    Almacén de contraseñas en memoria. Lee el CSV una sola vez y mantiene un
+    índice por SITE, de forma que consultar, añadir o borrar una entrada no
+    requiere volver a parsear el archivo. Es seguro usarlo desde varios hilos
+    (la GUI lee mientras un worker escribe). Con 'clave' el archivo base está
+    cifrado en reposo (contenedor por segmentos): se lee y se escribe cifrado,
+    sin que el CSV en claro llegue nunca al disco.
+    """
+
+    def __init__(self, filename='passwordsList.csv', clave=None):
+        self.filename = filename
+        self.clave = clave
+        self._escritor = storage.writer_lock(filename) # Un solo proceso escribiendo el archivo
+        self._entries = {} # SITE -> (USER cifrado, PASSWORD cifrada), mantiene el orden de inserción
+        self._firma = None # (mtime, tamaño) del archivo la última vez que lo leímos/escribimos
+        self.journal = None # Journal activo, si se ha habilitado el modo journal
+        self.compactar_cada = COMPACTAR_CADA
+        self._lock = threading.RLock() # Protege el índice, el journal y la escritura del CSV
+        self.load()
+
+    def _firma_archivo(self):
+        """Devuelve una firma barata del archivo para detectar cambios externos."""
+        try:
+            st = os.stat(self.filename)
+        except FileNotFoundError:
+            return None
+        return (st.st_mtime_ns, st.st_size)
+
+    def load(self):
+        """Carga (o recarga) el archivo CSV completo en el índice."""
+        with self._lock, timing.span('vault.load') as medida:
+            entries = {} # Se construye aparte para que los lectores sin lock nunca vean un índice a medias
+            if os.path.exists(self.filename) and os.stat(self.filename).st_size > 0:
+                if is_stream_file(self.filename):
+                    # Sin clave tampoco se puede leer como texto: un CSV vacío acabaría sustituyendo al cifrado
+                    if self.clave is None:
+                        raise ValueError(f"{self.filename} está cifrado: hace falta la clave para abrirlo.")
+                    medida.set(cifrado=True)
+                    with open(self.filename, 'rb') as f:
+                        self._leer_filas(csv.reader(decrypt_lines(f, self.clave)), entries)
+                elif is_fernet_file(self.filename):
+                    # Formato de versiones anteriores: nunca se lee como texto (se perdería todo al reescribirlo)
+                    if self.clave is None:
+                        raise ValueError(f"{self.filename} está cifrado en el formato anterior: descífralo antes de abrirlo.")
+                    medida.set(cifrado=True, formato_anterior=True)
+                    contenido = decrypt_fernet_file(self.filename, self.clave).decode('utf-8')
+                    self._leer_filas(csv.reader(io.StringIO(contenido, newline='')), entries)
+                else:
+                    with open(self.filename, 'r', newline='', encoding='utf-8') as f:
+                        self._leer_filas(csv.reader(f), entries)
+            self._entries = entries
+            self._firma = self._firma_archivo()
+            if self.journal is not None:
+                self._replay_journal()
+            medida.count('filas', len(self._entries))
+
+    def _leer_filas(self, reader, entries):
+        next(reader, None) # Saltamos la cabecera
+        for row in reader:
+            if len(row) < 3:
+                continue
+            site, user, password = row[0], row[1], row[2]
+            entries[site] = (user, password)
+
+    def enable_journal(self, fernet, compactar_cada=COMPACTAR_CADA, sync=True):
+        """
+        Activa el modo journal: las mutaciones se añaden a '<archivo>.journal'
+        y el CSV base solo se reescribe al compactar.
+        """
+        with self._lock:
+            self.journal = Journal(self.filename + '.journal', fernet, sync=sync)
+            self.compactar_cada = compactar_cada
+            self._replay_journal()
+
+    def _replay_journal(self):
+        """Aplica el journal sobre el índice; si está dañado lo compacta para no añadir detrás de basura."""
+        if not self.journal.replay(self._entries):
+            self.compact()
+
+    def refresh(self):
+        """Recarga el índice solo si el archivo ha cambiado fuera de esta instancia (p.ej. cifrar_csv)."""
+        with self._lock:
+            if self._firma_archivo() != self._firma:
+                self.load()
+
+    def save(self):
+        """
+        Hace persistentes los cambios. En modo journal ya están en disco, así que
+        solo se compacta al superar el umbral; si no, se reescribe el CSV.
+        """
+        with self._lock:
+            if self.journal is not None:
+                if self.journal.count >= self.compactar_cada:
+                    self.compact()
+                return
+            self._write_base()
+
+    def compact(self):
+        """Vuelca el estado actual en el CSV base y vacía el journal."""
+        with self._lock, self._escritor:
+            self._write_base()
+            if self.journal is not None:
+                self.journal.truncate()
+
+    def _write_base(self):
+        """
+        Escribe el índice completo en el archivo base de forma atómica (temporal + fsync + rename),
+        cifrado si el vault tiene clave.
+        """
+        with self._lock, self._escritor, timing.span('vault.write_base', cifrado=self.clave is not None, filas=len(self._entries)):
+            filas = ([site, user, password] for site, (user, password) in self._entries.items())
+            if self.clave is not None:
+                with storage.atomic_write(self.filename, 'wb') as f:
+                    encrypt_stream(CsvRowsReader(filas), f, self.clave)
+            else:
+                with storage.atomic_write(self.filename, 'w', newline='', encoding='utf-8') as f:
+                    writer = csv.writer(f)
+                    writer.writerow(COLUMNAS)
+                    writer.writerows(filas)
+            self._firma = self._firma_archivo()
+
+    def close(self):
+        with self._lock:
+            if self.journal is not None:
+                self.journal.close()
+
+    def get(self, site):
+        """Devuelve (USER cifrado, PASSWORD cifrada) para un SITE o None en O(1)."""
+        return self._entries.get(site)
+
+    def put(self, site, user_cifrado, password_cifrada):
+        """Añade o actualiza una entrada (y la registra en el journal si está activo)."""
+        with self._lock, self._escritor:
+            self._entries[site] = (user_cifrado, password_cifrada)
+            if self.journal is not None:
+                self.journal.append('put', site, user_cifrado, password_cifrada)
+
+    def put_many(self, entradas):
+        """
+        Añade o actualiza muchas entradas (site, USER cifrado, PASSWORD cifrada) y las
+        persiste con una sola escritura del CSV base, sin pasar registro a registro por el journal.
+        """
+        with self._lock:
+            for site, user_cifrado, password_cifrada in entradas:
+                self._entries[site] = (user_cifrado, password_cifrada)
+            self.compact()
+
+    def delete(self, site):
+        """Elimina una entrada. Devuelve True si existía."""
+        with self._lock, self._escritor:
+            if self._entries.pop(site, None) is None:
+                return False
+            if self.journal is not None:
+                self.journal.append('del', site)
+            return True
+
+    def items(self):
+        """Itera sobre (SITE, USER cifrado, PASSWORD cifrada) en orden de inserción."""
+        with self._lock:
+            entradas = list(self._entries.items())
+        for site, (user, password) in entradas:
+            yield site, user, password
+
+    def sites(self):
+        with self._lock:
+            return list(self._entries.keys())
+
+    def __contains__(self, site):
+        return site in self._entries
+
+    def __len__(self):
+        return len(self._entries)
+
+#-------------------------------------------------------------------------------------------------------------------------------
+
+class DecryptCache:
+    """
+    Caché LRU acotada de tokens Fernet ya descifrados. Permite descifrar cada
+    campo solo cuando hace falta y limita cuántos textos en claro quedan en memoria.
+    """
+
+    def __init__(self, fernet, maxsize=256):
+        self.fernet = fernet
+        self.maxsize = maxsize
+        self._cache = OrderedDict()
+
+    def decrypt(self, token):
+        """Descifra un token (str) usando la caché. Lanza excepción si el token no es válido."""
+        valor = self._cache.get(token)
+        if valor is not None:
+            self._cache.move_to_end(token)
+            timing.count('decrypt_cache.hit')
+            return valor
+        timing.count('decrypt_cache.miss')
+        valor = self.fernet.decrypt(token.encode()).decode()
+        self._cache[token] = valor
+        if len(self._cache) > self.maxsize:
+            self._cache.popitem(last=False)
+        return valor
+
+    def clear(self):
+        """Olvida todos los valores descifrados (al bloquear o cerrar)."""
+        self._cache.clear()
+
+    def __len__(self):
+        return len(self._cache)
+
+#-------------------------------------------------------------------------------------------------------------------------------
+
+class BinaryVault:
+    """
+    Lector de vaults en formato binario a través de mmap. Abrirlo no lee más que
+    la cabecera: buscar un SITE es una búsqueda binaria sobre el HMAC del nombre y
+    listar solo descifra los nombres que se piden, así que el coste de abrirlo no
+    depende del número de entradas. Los nombres van cifrados con AES-GCM y los
+    tokens Fernet se guardan en bruto (sin base64) y se reconstruyen al leerlos.
+    """
+
+    def __init__(self, filename, clave):
+        self.filename = filename
+        self._f = open(filename, 'rb')
+        try:
+            self._mm = mmap.mmap(self._f.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            self._f.close() # Archivo vacío
+            raise ValueError(f"{filename} no es un vault binario compatible.")
+        self._clave_indice = derive_subkey(clave, b'apm-index-v1')
+        self._aes = AESGCM(derive_subkey(clave, b'apm-names-v1'))
+        (magic, version, self._count, self.generation, comprobacion,
+         self._index_off, self._order_off, self._names_off, self._records_off) = _CABECERA.unpack_from(self._mm, 0)
+        if magic != MAGIC_BINARIO or version != VERSION_BINARIO:
+            self.close()
+            raise ValueError(f"{filename} no es un vault binario compatible.")
+        if not hmac.compare_digest(comprobacion, _hmac_site(self._clave_indice, MAGIC_BINARIO)):
+            self.close()
+            raise ValueError(f"La clave no corresponde al vault {filename}.")
+
+    def _entrada(self, i):
+        return _ENTRADA.unpack_from(self._mm, self._index_off + i * _ENTRADA.size)
+
+    def _nombre(self, entrada):
+        inicio = self._names_off + entrada[1]
+        bloque = self._mm[inicio:inicio + entrada[2]]
+        return self._aes.decrypt(bloque[:12], bloque[12:], entrada[0]).decode('utf-8')
+
+    def _buscar(self, site):
+        """Búsqueda binaria del HMAC del SITE en el índice. Devuelve la entrada o None."""
+        objetivo = _hmac_site(self._clave_indice, site.encode('utf-8'))
+        lo, hi = 0, self._count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            entrada = self._entrada(mid)
+            if entrada[0] == objetivo:
+                return entrada
+            if entrada[0] < objetivo:
+                lo = mid + 1
+            else:
+                hi = mid
+        return None
+
+    def _tokens(self, entrada):
+        inicio = self._records_off + entrada[3]
+        user = self._mm[inicio:inicio + entrada[4]]
+        password = self._mm[inicio + entrada[4]:inicio + entrada[4] + entrada[5]]
+        return base64.urlsafe_b64encode(user).decode(), base64.urlsafe_b64encode(password).decode()
+
+    def get(self, site):
+        """Devuelve (USER cifrado, PASSWORD cifrada) para un SITE o None, igual que Vault.get."""
+        entrada = self._buscar(site)
+        return self._tokens(entrada) if entrada is not None else None
+
+    def site_at(self, posicion):
+        """SITE que ocupa una posición en el orden de visualización (el mismo que el del CSV)."""
+        (i,) = _ORDEN.unpack_from(self._mm, self._order_off + posicion * _ORDEN.size)
+        return self._nombre(self._entrada(i))
+
+    def site_view(self):
+        """Secuencia perezosa de SITE: solo se descifran los nombres a los que se accede."""
+        return _SiteView(self)
+
+    def sites(self):
+        return [self.site_at(p) for p in range(self._count)]
+
+    def items(self):
+        for p in range(self._count):
+            (i,) = _ORDEN.unpack_from(self._mm, self._order_off + p * _ORDEN.size)
+            entrada = self._entrada(i)
+            yield (self._nombre(entrada), *self._tokens(entrada))
+
+    def __contains__(self, site):
+        return self._buscar(site) is not None
+
+    def __len__(self):
+        return self._count
+
+    def close(self):
+        self._mm.close()
+        self._f.close()
+
+class _SiteView:
+    """Vista indexable (len, [i]) sobre los SITE de un BinaryVault."""
+
+    def __init__(self, vault):
+        self._vault = vault
+
+    def __len__(self):
+        return len(self._vault)
+
+    def __getitem__(self, posicion):
+        if not 0 <= posicion < len(self._vault):
+            raise IndexError(posicion)
+        return self._vault.site_at(posicion)
+
+#-------------------------------------------------------------------------------------------------------------------------------
+
+def _hmac_site(clave_indice, nombre):
+    return hmac.new(clave_indice, nombre, hashlib.sha256).digest()[:16]
+
+"""
+Función para escribir un vault binario a partir de tuplas (SITE, USER cifrado, PASSWORD cifrada).
+'generacion' identifica la versión del CSV cifrado de la que se sacó (ver crypto_engine.stream_generation).
+"""
+def write_binary_vault(filename, entradas, clave, generacion=None):
+    clave_indice = derive_subkey(clave, b'apm-index-v1')
+    aes = AESGCM(derive_subkey(clave, b'apm-names-v1'))
+
+    filas = []
+    for site, user, password in entradas:
+        nombre = site.encode('utf-8')
+        clave_hmac = _hmac_site(clave_indice, nombre)
+        nonce = os.urandom(12)
+        # El HMAC va como dato asociado: un nombre no se puede mover a otra entrada del índice
+        filas.append((clave_hmac, nonce + aes.encrypt(nonce, nombre, clave_hmac),
+                      base64.urlsafe_b64decode(user), base64.urlsafe_b64decode(password)))
+
+    # El índice se ordena por HMAC; 'orden' conserva la posición original de cada fila
+    por_hmac = sorted(range(len(filas)), key=lambda i: filas[i][0])
+    posicion_en_indice = [0] * len(filas)
+    indice = bytearray()
+    nombres = bytearray()
+    registros = bytearray()
+    for pos, i in enumerate(por_hmac):
+        clave_hmac, nombre, user, password = filas[i]
+        posicion_en_indice[i] = pos
+        indice += _ENTRADA.pack(clave_hmac, len(nombres), len(nombre), len(registros), len(user), len(password))
+        nombres += nombre
+        registros += user + password
+    orden = b''.join(_ORDEN.pack(pos) for pos in posicion_en_indice)
+
+    index_off = _CABECERA.size
+    order_off = index_off + len(indice)
+    names_off = order_off + len(orden)
+    records_off = names_off + len(nombres)
+    cabecera = _CABECERA.pack(MAGIC_BINARIO, VERSION_BINARIO, len(filas), generacion or _SIN_GENERACION,
+                              _hmac_site(clave_indice, MAGIC_BINARIO), index_off, order_off, names_off, records_off)
+    with storage.atomic_write(filename, 'wb') as f:
+        f.write(cabecera)
+        f.write(indice)
+        f.write(orden)
+        f.write(nombres)
+        f.write(registros)
+    return len(filas)
+
+#-------------------------------------------------------------------------------------------------------------------------------
+
+"""Función para convertir el CSV de contraseñas (ya descifrado) al formato binario"""
+def convert_csv_to_binary(csv_filename, bin_filename, clave):
+    n = write_binary_vault(bin_filename, Vault(csv_filename).items(), clave)
+    print(f"{n} entradas convertidas de {csv_filename} a {bin_filename}.")
+    return n
+
+#-------------------------------------------------------------------------------------------------------------------------------
+
+_vaults = {}
+_vaults_lock = threading.Lock()
+
+"""
+Devuelve la instancia de Vault asociada a un archivo, recargándola si el archivo cambió. Con 'clave'
+el archivo está cifrado en reposo (y se actualiza la clave de la instancia, p.ej. tras rotarla).
+"""
+def get_vault(filename='passwordsList.csv', clave=None):
+    key = os.path.abspath(filename)
+    with _vaults_lock:
+        vault = _vaults.get(key)
+        if vault is None:
+            vault = Vault(filename, clave)
+            _vaults[key] = vault
+            return vault
+    if clave is not None:
+        vault.clave = clave
+    vault.refresh()
+    return vault
+
+
+if __name__ == "__main__":
+    # Uso: python vault.py passwordsList.csv passwordsList.vault ruta/a/clave.key
+    import sys
+    with open(sys.argv[3], 'rb') as f:
+        convert_csv_to_binary(sys.argv[1], sys.argv[2], f.read())